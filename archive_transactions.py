@@ -0,0 +1,26 @@
+"""Move transactions older than the hot window into compressed monthly archives.
+
+Run nightly from cron. History APIs read the archive transparently when a
+query reaches past the hot window, so the hot ``transactions`` collection and
+its indexes only ever hold recent rows.
+
+Usage:
+    python archive_transactions.py [--older-than-days 90] [--batch-size 1000]
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from main2 import TransactionArchive, TRANSACTION_HOT_DAYS
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old transactions")
+    parser.add_argument('--older-than-days', type=int, default=TRANSACTION_HOT_DAYS)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    
+    cutoff = datetime.utcnow() - timedelta(days=args.older_than_days)
+    moved = TransactionArchive.archive_older_than(cutoff, args.batch_size)
+    print(f"Archived {moved} transactions created before {cutoff.isoformat()}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""End-of-day balance snapshot export for compliance.
+
+Writes one row per account (phone_number, name, balance, created_at,
+is_active) as gzip-compressed CSV parts plus a ``manifest.json`` listing each
+part with its row count, size and SHA-256, and the totals.
+
+Users are partitioned by ``_id`` range and each partition is streamed by its
+own process with its own MongoDB connection, a projection and batched
+cursor, so memory stays bounded at any number of accounts. Balances include
+hot-account stripes and are written in major units (e.g. ``1500.50``).
+
+Rows reflect each account as its partition reads it; ``started_at`` and
+``finished_at`` in the manifest bound when that was.
+
+Usage:
+    python export_snapshot.py --output snapshots/2024-01-31 [--workers 8] [--partitions 64]
+"""
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict
+
+from main2 import (
+    users_collection, partition_id_ranges, id_range_filter, WalletManager, StripedBalance, Money,
+    DATABASE_NAME
+)
+
+COLUMNS = ['phone_number', 'name', 'balance', 'created_at', 'is_active']
+USER_FIELDS = {
+    '_id': 0, 'phone_number': 1, 'name': 1, 'balance': 1, 'created_at': 1, 'is_active': 1,
+    'striped': 1, 'stripe_count': 1, 'fold_tokens': 1
+}
+
+class HashingWriter(io.RawIOBase):
+    """File wrapper that hashes and counts the bytes written through it"""
+    
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        self.bytes += len(data)
+        return self.f.write(data)
+
+def export_partition(index: int, lower, upper, output: str, batch_size: int) -> Dict:
+    """Stream one _id range to a gzip CSV part"""
+    started = time.monotonic()
+    name = f"part-{index:05d}.csv.gz"
+    path = os.path.join(output, name)
+    rows = 0
+    total_balance = 0
+    
+    cursor = users_collection.find(
+        id_range_filter(lower, upper), USER_FIELDS
+    ).sort('_id', 1).batch_size(batch_size)
+    
+    with open(path + '.tmp', 'wb') as raw:
+        hashing = HashingWriter(raw)
+        with gzip.GzipFile(filename='', mode='wb', fileobj=hashing, mtime=0) as gz, \
+                io.TextIOWrapper(gz, encoding='utf-8', newline='') as text:
+            writer = csv.writer(text)
+            writer.writerow(COLUMNS)
+            for user in cursor:
+                balance = WalletManager.get_balance(user) if StripedBalance.is_striped(user) else user['balance']
+                created_at = user.get('created_at')
+                writer.writerow([
+                    user['phone_number'],
+                    user.get('name', ''),
+                    Money.format(balance),
+                    created_at.isoformat() if created_at else '',
+                    'true' if user.get('is_active', True) else 'false'
+                ])
+                rows += 1
+                total_balance += balance
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(path + '.tmp', path)
+    
+    return {
+        'file': name,
+        'rows': rows,
+        'bytes': hashing.bytes,
+        'sha256': hashing.sha256.hexdigest(),
+        'total_balance': Money.format(total_balance),
+        'seconds': round(time.monotonic() - started, 3)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Export an account balance snapshot")
+    parser.add_argument('--output', required=True, help="Directory for the parts and manifest")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--partitions', type=int, default=None,
+                        help="Number of _id ranges (default: 4 per worker)")
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+    
+    os.makedirs(args.output, exist_ok=True)
+    if os.path.exists(os.path.join(args.output, 'manifest.json')):
+        parser.error(f"{args.output} already holds a snapshot")
+    
+    started_at = datetime.utcnow()
+    started = time.monotonic()
+    ranges = partition_id_ranges(users_collection, args.partitions or args.workers * 4) or [(None, None)]
+    
+    # Spawn so every worker opens its own MongoDB connection
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as pool:
+        futures = [pool.submit(export_partition, i, lower, upper, args.output, args.batch_size)
+                   for i, (lower, upper) in enumerate(ranges)]
+        parts = [future.result() for future in futures]
+    
+    total_minor = sum(Money.to_minor(part['total_balance']) for part in parts)
+    manifest = {
+        'database': DATABASE_NAME,
+        'columns': COLUMNS,
+        'format': 'csv+gzip',
+        'started_at': started_at.isoformat(),
+        'finished_at': datetime.utcnow().isoformat(),
+        'rows': sum(part['rows'] for part in parts),
+        'total_balance': Money.format(total_minor),
+        'parts': parts
+    }
+    
+    # Written last so a manifest only ever describes complete parts
+    manifest_path = os.path.join(args.output, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    
+    print(f"Exported {manifest['rows']} accounts in {len(parts)} parts "
+          f"in {time.monotonic() - started:.1f}s (manifest: {manifest_path})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Gunicorn configuration for main2.
+
+    gunicorn -c gunicorn_conf.py main2:app
+
+Workers default to gevent green threads. Each worker runs one event loop, so
+one per core is enough and each can hold ``worker_connections`` requests in
+flight, most of them waiting on MongoDB or the SMS gateway. gevent patches
+the standard library before main2 is imported, so pymongo, africastalking
+(through requests), the background threads and their locks and queues all
+yield to other requests instead of blocking. main2 hands journal fsyncs to
+real threads (``run_in_thread``).
+
+Set ``GUNICORN_WORKER_CLASS=gthread`` for the thread-per-request model, with
+more processes and ``GUNICORN_THREADS`` threads each.
+
+The app must not be preloaded: every worker opens its own MongoDB client
+after the patching, and runs ``initialize_app`` once it has loaded. That
+opens the worker's connections before it accepts requests, and starts the
+rest of the warm-up (``main2.WarmUp``) and the registered-number filter
+build in the background. Point load balancer readiness probes at ``/ready``,
+which turns 200 once both are done, and liveness probes at ``/health``.
+
+Environment:
+    PORT                       listen port (default 5000)
+    GUNICORN_WORKER_CLASS      gevent (default) or gthread
+    GUNICORN_WORKERS           worker processes (default: cores for gevent, 2 x cores + 1 for gthread)
+    GUNICORN_CONNECTIONS       in-flight requests per gevent worker (default 1000)
+    GUNICORN_THREADS           threads per gthread worker (default 8)
+    MONGO_MAX_POOL_SIZE        MongoDB connections per worker (default 100); the server sees workers x this
+    MONGO_MIN_POOL_SIZE        connections each worker opens during warm-up and keeps (default 10)
+"""
+import multiprocessing
+import os
+
+CORES = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+
+if worker_class == 'gevent':
+    workers = int(os.environ.get('GUNICORN_WORKERS', CORES))
+    worker_connections = int(os.environ.get('GUNICORN_CONNECTIONS', 1000))
+else:
+    workers = int(os.environ.get('GUNICORN_WORKERS', CORES * 2 + 1))
+    threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+preload_app = False
+# USSD gateways give up after a few seconds; MongoDB operations carry their
+# own deadline well inside this. Worker boot must also finish within it; only
+# opening connections blocks it, bounded by the MongoDB connect timeouts
+timeout = 30
+graceful_timeout = 10
+keepalive = 5
+
+def post_worker_init(worker):
+    """Create indexes, open connections and start main2's background threads, before the worker accepts requests"""
+    import main2
+    main2.initialize_app()
@@ -0,0 +1,329 @@
+"""Local write-ahead journal with group commit.
+
+Records are appended to segmented files as CRC-framed entries::
+
+    [length: u32][crc32: u32][seq: u64][payload: length bytes]
+
+The CRC covers the sequence number and the payload. Each segment
+``<first_seq>.log`` has a companion ``<first_seq>.idx`` holding the file
+offset of every record as a big-endian u64, which is memory-mapped for
+reads so replay can seek straight to a sequence number.
+
+Concurrent ``append`` calls are group-committed: a single writer thread
+gathers whatever is queued (up to ``max_batch`` records, waiting at most
+``max_delay`` seconds after the first one), writes the batch and issues
+one fsync before waking every caller in it.
+
+If writing or syncing a batch fails, the batch is cut off the segment again
+and its sequence numbers are reused, so a record whose ``append`` raised is
+never replayed and leaves no gap below the applied watermark. If even that
+cut fails, the journal refuses all further appends.
+
+Consumers call ``mark_applied`` once a record's effects are stored
+elsewhere; the contiguous applied watermark is persisted so ``replay``
+only returns records that may not have been applied. Segments wholly
+below the watermark are deleted.
+
+On open, the tail of the last segment is validated and any torn or
+corrupt record (and everything after it) is truncated away.
+"""
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('>IIQ')
+INDEX_ENTRY = struct.Struct('>Q')
+APPLIED_FILE = 'applied'
+
+class JournalError(Exception):
+    """Raised when a record could not be made durable"""
+
+def _fsync_default(fd: int) -> None:
+    os.fsync(fd)
+
+class Journal:
+    """Append-only, segmented, CRC-framed journal with group commit"""
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024,
+                 max_batch: int = 256, max_delay: float = 0.002, fsync=_fsync_default):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # Overridable so cooperative servers can run fsync off the event loop
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+        self._applied = self._read_applied()
+        self._done = set()
+        self._applied_lock = threading.Lock()
+
+        self._segments = sorted(
+            int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log')
+        )
+        self._next_seq = self._recover()
+        self._open_active()
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._failed = None
+        self._writer = threading.Thread(target=self._write_loop, name='journal-writer', daemon=True)
+        self._writer.start()
+
+    # -- paths ---------------------------------------------------------------
+
+    def _log_path(self, first_seq: int) -> str:
+        return os.path.join(self.directory, f"{first_seq:020d}.log")
+
+    def _idx_path(self, first_seq: int) -> str:
+        return os.path.join(self.directory, f"{first_seq:020d}.idx")
+
+    # -- recovery ------------------------------------------------------------
+
+    def _read_applied(self) -> int:
+        try:
+            with open(os.path.join(self.directory, APPLIED_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    @staticmethod
+    def _scan(path: str) -> Iterator[Tuple[int, int, bytes]]:
+        """Yield (offset, seq, payload) for every valid record, stopping at the first bad one"""
+        with open(path, 'rb') as f:
+            offset = 0
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                length, crc, seq = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(header[8:] + payload) != crc:
+                    return
+                yield offset, seq, payload
+                offset += HEADER.size + length
+
+    def _recover(self) -> int:
+        """Validate the last segment, truncate a torn tail and rebuild its index"""
+        if not self._segments:
+            return max(self._applied + 1, 1)
+
+        first_seq = self._segments[-1]
+        path = self._log_path(first_seq)
+        end = 0
+        last_seq = first_seq - 1
+        offsets = []
+        for offset, seq, payload in self._scan(path):
+            offsets.append(offset)
+            end = offset + HEADER.size + len(payload)
+            last_seq = seq
+
+        if end < os.path.getsize(path):
+            logger.warning(f"Truncating torn journal tail in {path} at offset {end}")
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+                os.fsync(f.fileno())
+
+        with open(self._idx_path(first_seq), 'wb') as f:
+            for offset in offsets:
+                f.write(INDEX_ENTRY.pack(offset))
+            os.fsync(f.fileno())
+
+        return max(last_seq + 1, self._applied + 1)
+
+    def _open_active(self) -> None:
+        if not self._segments:
+            self._segments.append(self._next_seq)
+        first_seq = self._segments[-1]
+        self._log = open(self._log_path(first_seq), 'ab')
+        self._idx = open(self._idx_path(first_seq), 'ab')
+
+    def _roll(self) -> None:
+        """Start a new segment at the next sequence number"""
+        self._log.close()
+        self._idx.close()
+        self._segments.append(self._next_seq)
+        self._open_active()
+
+    # -- writing -------------------------------------------------------------
+
+    def append(self, payload: bytes, timeout: float = None) -> int:
+        """Append a record and block until it is durable; returns its sequence number"""
+        if self._closed:
+            raise JournalError("Journal is closed")
+        if self._failed:
+            raise JournalError(f"Journal is unusable: {self._failed}")
+        waiter = {'payload': payload, 'event': threading.Event(), 'seq': None, 'error': None}
+        self._queue.put(waiter)
+        if not waiter['event'].wait(timeout):
+            raise JournalError("Timed out waiting for journal commit")
+        if waiter['error']:
+            raise JournalError(str(waiter['error']))
+        return waiter['seq']
+
+    def _gather(self) -> list:
+        """Block for the first record, then collect more until the batch is full or the delay passes"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch and batch[-1] is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = self._gather()
+            if any(w is None for w in batch):
+                batch = [w for w in batch if w is not None]
+                stop = True
+            else:
+                stop = False
+            if batch:
+                self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch: list) -> None:
+        first_seq = self._next_seq
+        log_start = idx_start = None
+        try:
+            if self._failed:
+                raise JournalError(f"Journal is unusable: {self._failed}")
+            if self._log.tell() >= self.segment_bytes:
+                self._roll()
+            log_start, idx_start = self._log.tell(), self._idx.tell()
+            position = log_start
+            frames = []
+            offsets = []
+            for waiter in batch:
+                seq = self._next_seq
+                self._next_seq += 1
+                body = struct.pack('>Q', seq) + waiter['payload']
+                header = HEADER.pack(len(waiter['payload']), zlib.crc32(body), seq)
+                frames.append(header + waiter['payload'])
+                offsets.append(INDEX_ENTRY.pack(position))
+                position += HEADER.size + len(waiter['payload'])
+                waiter['seq'] = seq
+            self._log.write(b''.join(frames))
+            self._log.flush()
+            self.fsync(self._log.fileno())
+            # The index is rebuilt from the log on recovery, so it is not fsynced
+            self._idx.write(b''.join(offsets))
+            self._idx.flush()
+        except Exception as e:
+            logger.error(f"Journal commit failed: {e}")
+            self._next_seq = first_seq
+            if log_start is None:
+                self._failed = self._failed or e
+            else:
+                self._rollback(log_start, idx_start)
+            for waiter in batch:
+                waiter['seq'] = None
+                waiter['error'] = e
+        for waiter in batch:
+            waiter['event'].set()
+
+    def _rollback(self, log_end: int, idx_end: int) -> None:
+        """Cut a failed batch off the active segment so it is never replayed"""
+        first_seq = self._segments[-1]
+        try:
+            for f in (self._log, self._idx):
+                try:
+                    # Closing drops anything still buffered; the file is cut below anyway
+                    f.close()
+                except OSError:
+                    pass
+            for path, end in ((self._log_path(first_seq), log_end), (self._idx_path(first_seq), idx_end)):
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+                    self.fsync(f.fileno())
+            self._open_active()
+        except Exception as e:
+            logger.error(f"Journal rollback failed; refusing further appends: {e}")
+            self._failed = e
+
+    # -- reading -------------------------------------------------------------
+
+    def _segment_records(self, first_seq: int, from_seq: int) -> Iterator[Tuple[int, bytes]]:
+        start = 0
+        idx_path = self._idx_path(first_seq)
+        if from_seq > first_seq and os.path.getsize(idx_path) >= (from_seq - first_seq + 1) * INDEX_ENTRY.size:
+            with open(idx_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+                start, = INDEX_ENTRY.unpack_from(index, (from_seq - first_seq) * INDEX_ENTRY.size)
+        with open(self._log_path(first_seq), 'rb') as f:
+            f.seek(start)
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                length, crc, seq = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(header[8:] + payload) != crc:
+                    return
+                if seq >= from_seq:
+                    yield seq, payload
+
+    def replay(self) -> Iterator[Tuple[int, bytes]]:
+        """Records after the applied watermark, in sequence order"""
+        from_seq = self._applied + 1
+        for i, first_seq in enumerate(self._segments):
+            next_first = self._segments[i + 1] if i + 1 < len(self._segments) else None
+            if next_first is not None and next_first <= from_seq:
+                continue
+            yield from self._segment_records(first_seq, from_seq)
+
+    # -- applied watermark ---------------------------------------------------
+
+    def mark_applied(self, seq: int) -> None:
+        """Record that a record's effects are stored; advances the contiguous watermark"""
+        with self._applied_lock:
+            self._done.add(seq)
+            advanced = False
+            while self._applied + 1 in self._done:
+                self._applied += 1
+                self._done.discard(self._applied)
+                advanced = True
+            if advanced:
+                self._write_applied()
+
+    def _write_applied(self) -> None:
+        path = os.path.join(self.directory, APPLIED_FILE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(self._applied))
+        # Not fsynced: replaying an already-applied record is harmless
+        os.replace(tmp, path)
+        self._purge()
+
+    def _purge(self) -> None:
+        """Delete segments whose records are all applied (never the active one)"""
+        while len(self._segments) > 1 and self._segments[1] <= self._applied + 1:
+            first_seq = self._segments.pop(0)
+            for path in (self._log_path(first_seq), self._idx_path(first_seq)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def close(self) -> None:
+        """Flush pending appends and stop the writer"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+        self._log.close()
+        self._idx.close()
@@ -1,17 +1,34 @@
 import os
 import re
 import logging
+import math
+import copy
+import fcntl
 import hashlib
+import json
+import queue
 import secrets
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from decimal import Decimal, InvalidOperation
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from typing import Dict, Optional, Tuple, Any
 from functools import wraps
 from dotenv import load_dotenv
 
-from flask import Flask, request, jsonify, Response
-from pymongo import MongoClient, DESCENDING
-from pymongo.errors import PyMongoError, DuplicateKeyError
+from flask import Flask, request, jsonify, Response, has_request_context
+import pymongo
+from pymongo import MongoClient, DESCENDING, ReturnDocument, ReadPreference, WriteConcern
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import (
+    PyMongoError, DuplicateKeyError, BulkWriteError, CollectionInvalid, WriteError,
+    ConnectionFailure, ExecutionTimeout
+)
 import africastalking
 
 load_dotenv()
@@ -38,13 +55,345 @@ AFRICASTALKING_USERNAME = os.environ.get('AFRICASTALKING_USERNAME', 'sandbox')
 AFRICASTALKING_API_KEY = os.environ.get('AFRICASTALKING_API_KEY', 'your_api_key_here')
 AFRICASTALKING_SHORTCODE = os.environ.get('AFRICASTALKING_SHORTCODE', '428')
 
-# Transaction limits
-MIN_TRANSACTION_AMOUNT = Decimal('1.00')
-MAX_TRANSACTION_AMOUNT = Decimal('100000.00')
-DAILY_TRANSACTION_LIMIT = Decimal('200000.00')
+# Money is stored as integer minor units (cents); see the Money class below
+MINOR_UNITS_PER_MAJOR = 100
+# Filter on every balance $inc: a legacy double (major units) balance must be
+# migrated by migrate_money.py before integer minor units are added to it
+MINOR_UNIT_BALANCE = {'$not': {'$type': 'double'}}
+
+# Transaction limits (minor units)
+MIN_TRANSACTION_AMOUNT = 100            # KSH 1.00
+MAX_TRANSACTION_AMOUNT = 10_000_000     # KSH 100,000.00
+DAILY_TRANSACTION_LIMIT = 20_000_000    # KSH 200,000.00
+
+# Transaction types that take money out of an account
+DEBIT_TRANSACTION_TYPES = ('withdraw', 'send')
+
+# Consecutive failed PIN attempts before the account locks
+MAX_PIN_ATTEMPTS = 3
+
+# Input formats, compiled at import rather than on a worker's first request
+NON_DIGITS = re.compile(r'[^\d]')
+PIN_FORMAT = re.compile(r'^\d{4}$')
 
 # Session timeout (in minutes)
 SESSION_TIMEOUT = 10
+# expires_at is refreshed by session writes that happen anyway; on its own it
+# is only rewritten once fewer than this many minutes remain
+SESSION_REFRESH_MARGIN = float(os.environ.get('SESSION_REFRESH_MARGIN', 5))
+
+# Stateless mode rebuilds session state from the USSD text chain instead of
+# reading and writing sessions_collection on every hop
+USSD_STATELESS_MODE = os.environ.get('USSD_STATELESS_MODE', 'false').lower() == 'true'
+STATELESS_MEMO_SIZE = int(os.environ.get('STATELESS_MEMO_SIZE', 10000))
+STATELESS_RESULT_TTL = 24 * 3600     # seconds a sensitive hop's outcome is kept for resent hops
+
+# Registration steps kept in session data (the main menu uses the session step)
+REGISTRATION_STEPS = ('registration', 'pin_setup', 'pin_confirm')
+# Steps that move money, create accounts or change credentials; these only
+# ever run on the hop that submits them, at most once per session and chain
+SENSITIVE_STEPS = ('pin_confirm', 'send_money_pin', 'deposit_confirm', 'change_pin_confirm')
+
+# Double-entry ledger
+SYSTEM_CASH_ACCOUNT = 'system:cash'          # counter-account for deposits and withdrawals
+SYSTEM_OPENING_ACCOUNT = 'system:opening'    # counter-account for pre-ledger opening balances
+# Checkpoints are taken this many seconds in the past so that in-flight
+# entries with a slightly older created_at never land behind a checkpoint
+LEDGER_CHECKPOINT_LAG = int(os.environ.get('LEDGER_CHECKPOINT_LAG', 60))
+LEDGER_REPAIR_INTERVAL = int(os.environ.get('LEDGER_REPAIR_INTERVAL', 60))  # seconds between sweeps for unposted journals
+LEDGER_REPAIR_OVERLAP = 300          # seconds each sweep re-reads before the previous one
+
+# Hot-account striping: credits to flagged accounts are spread over N sub-balances
+BALANCE_STRIPE_COUNT = int(os.environ.get('BALANCE_STRIPE_COUNT', 8))
+STRIPE_COMPACT_INTERVAL = int(os.environ.get('STRIPE_COMPACT_INTERVAL', 30))  # seconds
+CREDIT_TRANSACTION_TYPES = ('deposit', 'receive')
+
+# Transaction archival: rows older than the hot window move to monthly,
+# block-compressed archive collections
+TRANSACTION_HOT_DAYS = int(os.environ.get('TRANSACTION_HOT_DAYS', 90))
+ARCHIVE_COMPRESSOR = os.environ.get('ARCHIVE_COMPRESSOR', 'zstd')
+ARCHIVE_COLLECTION_PREFIX = 'transactions_archive_'
+ARCHIVE_CATALOG_TTL = 300            # seconds the archive catalog is cached per process
+
+# Write-ahead journal for transfers: when set, transfer intents are made
+# durable locally (one fsync per group commit) and applied to MongoDB
+# asynchronously, with replay on startup
+MONEY_JOURNAL_DIR = os.environ.get('MONEY_JOURNAL_DIR', '')
+JOURNAL_GROUP_COMMIT_MS = float(os.environ.get('JOURNAL_GROUP_COMMIT_MS', 2))
+JOURNAL_MAX_SLOTS = 64               # one journal directory per worker process
+APPLIED_TXN_MEMORY = 100             # transaction IDs remembered per account for idempotent replay
+JOURNAL_APPLY_MAX_ATTEMPTS = 8       # failed applies, outside MongoDB outages, before an intent is dead-lettered
+# update_balance failures that retrying will not clear
+PERMANENT_BALANCE_FAILURES = ("Insufficient balance", "User not found", "Account temporarily unavailable")
+
+# Coalesce concurrent transaction inserts into one insert_many; a window of
+# 0 disables batching
+TXN_BATCH_WINDOW_MS = float(os.environ.get('TXN_BATCH_WINDOW_MS', 2))
+TXN_BATCH_MAX_DOCS = int(os.environ.get('TXN_BATCH_MAX_DOCS', 100))
+
+# Compact summaries of the latest transactions kept on the user document
+# for the history menu
+RECENT_ACTIVITY_SIZE = 5
+
+# History menu paging: pages are cut to fit one USSD screen and the next
+# page is prefetched while the user reads the current one
+USSD_MAX_CHARS = 182
+HISTORY_FETCH_SIZE = 6               # rows read per page query; the screen shows as many as fit
+HISTORY_NEXT_OPTION = '98'
+HISTORY_PREFETCH_WORKERS = 4
+HISTORY_PREFETCH_CACHE_SIZE = 1000
+
+# Field projections for user and session reads, so each step transfers and
+# decodes only the fields it uses
+BALANCE_FIELDS = {'phone_number': 1, 'balance': 1, 'striped': 1, 'stripe_count': 1, 'fold_tokens': 1,
+                  'held_transfers': 1}
+# Server-side total of the holds on a user document
+HELD_TRANSFERS_TOTAL = {'$ifNull': [{'$sum': '$held_transfers.amount'}, 0]}
+USER_AUTH_FIELDS = {'phone_number': 1, 'pin_hash': 1, 'is_locked': 1, 'failed_pin_attempts': 1}
+USER_PROFILE_FIELDS = {**BALANCE_FIELDS, 'name': 1, 'is_active': 1, 'created_at': 1}
+USER_HOP_FIELDS = {**BALANCE_FIELDS, **USER_AUTH_FIELDS, 'name': 1, 'created_at': 1, 'recent_activity': 1}
+SESSION_FIELDS = {'_id': 0, 'session_id': 1, 'phone_number': 1, 'data': 1, 'step': 1, 'expires_at': 1}
+
+# Concurrent identical user/session lookups share one query. Results may
+# also be cached per process for a short TTL (seconds; 0 disables): user
+# documents carry balances so their TTL defaults to off, while existence
+# checks are cached once positive since users are never deleted
+USER_LOOKUP_TTL = float(os.environ.get('USER_LOOKUP_TTL', 0))
+USER_EXISTS_TTL = float(os.environ.get('USER_EXISTS_TTL', 30))
+SINGLE_FLIGHT_CACHE_SIZE = 10000
+
+# In-memory Bloom filter of registered phone numbers; a negative answer
+# skips the user lookup. Sized for BLOOM_EXPECTED_USERS at
+# BLOOM_FALSE_POSITIVE_RATE (5M numbers at 1% is about 6 MB per worker)
+BLOOM_EXPECTED_USERS = int(os.environ.get('BLOOM_EXPECTED_USERS', 5_000_000))
+BLOOM_FALSE_POSITIVE_RATE = float(os.environ.get('BLOOM_FALSE_POSITIVE_RATE', 0.01))
+BLOOM_SYNC_INTERVAL = 30             # seconds between pulls of users registered by other workers
+BLOOM_MISS_SYNC_INTERVAL = 1         # a miss triggers a pull at most this often
+BLOOM_SYNC_OVERLAP = 60              # seconds re-read on each pull to cover clock skew
+BLOOM_REBUILD_INTERVAL = 6 * 3600    # full rebuild, resizing for growth
+BLOOM_BUILD_BATCH = 10000            # numbers read per cursor batch and hashed together off the event loop
+
+# MongoDB fail-fast settings. Request-path operations get a deadline well
+# inside the USSD gateway timeout; after MONGO_BREAKER_FAILURES consecutive
+# outage errors the circuit opens and requests fail fast (with a read-only
+# cached balance over USSD) until a background ping succeeds
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 2000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 2000))
+MONGO_OP_DEADLINE_MS = int(os.environ.get('MONGO_OP_DEADLINE_MS', 3000))
+MONGO_BREAKER_FAILURES = int(os.environ.get('MONGO_BREAKER_FAILURES', 5))
+MONGO_PROBE_INTERVAL = 2             # seconds between recovery pings while the circuit is open
+DEGRADED_CACHE_SIZE = 100000         # users whose last known balance is kept per process
+SERVICE_UNAVAILABLE_RESPONSE = "END Service temporarily unavailable. Please try again later."
+
+# Connections each worker process may open to MongoDB; with green-thread
+# workers, requests beyond this queue for a free connection. The minimum is
+# opened during warm-up and kept open
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 10))
+
+# Boot warm-up (see WarmUp), started by initialize_app. Only opening
+# connections blocks boot, which must finish well inside the worker timeout
+WARMUP_ENABLED = os.environ.get('WARMUP_ENABLED', 'true').lower() == 'true'
+WARMUP_INDEX_SCAN_LIMIT = int(os.environ.get('WARMUP_INDEX_SCAN_LIMIT', 100000))  # entries read per hot index
+WARMUP_RETRY_INTERVAL = 5            # seconds between retries of failed warm-up steps
+WARMUP_PHONE_NUMBER = os.environ.get('WARMUP_PHONE_NUMBER', '+254700000000')
+
+# Green-thread workers (gunicorn -k gevent, see gunicorn_conf.py) patch the
+# standard library before this module is imported, which makes MongoDB, SMS
+# (requests) and lock, queue and sleep calls cooperative. Blocking system
+# calls still stall every request in the process and go through run_in_thread
+gevent_monkey = sys.modules.get('gevent.monkey')
+COOPERATIVE = bool(gevent_monkey and gevent_monkey.is_module_patched('socket'))
+
+def run_in_thread(fn, *args):
+    """Call ``fn`` on a real OS thread when serving from green threads"""
+    if COOPERATIVE:
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+class ServiceUnavailable(PyMongoError):
+    """Raised instead of calling MongoDB while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Opens after consecutive outage errors; a background probe closes it"""
+    
+    def __init__(self, failure_threshold: int, probe, probe_interval: float):
+        self.failure_threshold = failure_threshold
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+    
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+    
+    @staticmethod
+    def is_outage(error: Exception) -> bool:
+        """Errors meaning MongoDB is unreachable or too slow, not that a write was refused"""
+        return isinstance(error, (ConnectionFailure, ExecutionTimeout)) or bool(getattr(error, 'timeout', False))
+    
+    def record_success(self) -> None:
+        self.failures = 0
+    
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold or self.opened_at:
+                return
+            self.opened_at = datetime.utcnow()
+        logger.error(f"MongoDB circuit opened after {self.failures} consecutive failures")
+        threading.Thread(target=self._probe_loop, name='mongo-probe', daemon=True).start()
+    
+    def _probe_loop(self) -> None:
+        while True:
+            threading.Event().wait(self.probe_interval)
+            try:
+                self.probe()
+            except Exception:
+                continue
+            with self._lock:
+                logger.info(f"MongoDB circuit closed; open since {self.opened_at.isoformat()}")
+                self.opened_at = None
+                self.failures = 0
+            return
+
+class ResilientCursor:
+    """Cursor proxy keeping a find or aggregate under the breaker and its deadline.
+
+    A find sends its query, and every cursor its getMores, only while being
+    iterated, so each ``next`` runs under ``pymongo.timeout`` with whatever
+    is left of the deadline taken when the cursor was created. Chained
+    cursor methods (``sort``, ``limit``, ...) return the proxy.
+    """
+    
+    def __init__(self, cursor, breaker: 'CircuitBreaker', deadline_at: Optional[float]):
+        self._cursor = cursor
+        self._breaker = breaker
+        self._deadline_at = deadline_at
+    
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+        
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self._cursor else result
+        return chained
+    
+    def __iter__(self) -> 'ResilientCursor':
+        return self
+    
+    def __next__(self):
+        if self._breaker.is_open:
+            raise ServiceUnavailable("MongoDB unavailable; cursor not advanced")
+        try:
+            if self._deadline_at is None:
+                document = next(self._cursor)
+            else:
+                # pymongo.timeout(0) would mean no timeout at all
+                with pymongo.timeout(max(self._deadline_at - time.monotonic(), 0.001)):
+                    document = next(self._cursor)
+        except StopIteration:
+            self._breaker.record_success()
+            raise
+        except PyMongoError as e:
+            if self._breaker.is_outage(e):
+                self._breaker.record_failure()
+            raise
+        self._breaker.record_success()
+        return document
+    
+    next = __next__
+
+class ResilientCollection:
+    """Collection proxy adding the circuit breaker and request deadlines.
+
+    Operations raise ServiceUnavailable at once while the circuit is open.
+    Inside a Flask request each one runs under ``pymongo.timeout``, and so
+    does iterating the cursors find and aggregate return (see
+    ResilientCursor), so a worker never waits on MongoDB for longer than
+    MONGO_OP_DEADLINE_MS per operation; batch jobs and background threads
+    keep unbounded operations unless they set their own ``pymongo.timeout``.
+    """
+    
+    GUARDED = {
+        'find', 'find_one', 'find_one_and_update', 'insert_one', 'insert_many', 'update_one', 'update_many',
+        'replace_one', 'delete_one', 'delete_many', 'aggregate', 'count_documents',
+        'estimated_document_count', 'distinct', 'bulk_write'
+    }
+    
+    def __init__(self, collection, breaker: CircuitBreaker):
+        self._collection = collection
+        self._breaker = breaker
+    
+    def with_options(self, **kwargs) -> 'ResilientCollection':
+        return ResilientCollection(self._collection.with_options(**kwargs), self._breaker)
+    
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in ResilientCollection.GUARDED:
+            return attr
+        
+        def guarded(*args, **kwargs):
+            if self._breaker.is_open:
+                raise ServiceUnavailable(f"MongoDB unavailable; {self._collection.name}.{name} not attempted")
+            deadline = MONGO_OP_DEADLINE_MS / 1000 if has_request_context() and MONGO_OP_DEADLINE_MS else None
+            deadline_at = time.monotonic() + deadline if deadline else None
+            if name == 'find':
+                # Creating a find cursor does no I/O; the query runs on iteration
+                cursor = attr(*args, **kwargs)
+                if deadline:
+                    cursor = cursor.max_time_ms(MONGO_OP_DEADLINE_MS)
+                return ResilientCursor(cursor, self._breaker, deadline_at)
+            try:
+                if deadline:
+                    with pymongo.timeout(deadline):
+                        result = attr(*args, **kwargs)
+                else:
+                    result = attr(*args, **kwargs)
+            except PyMongoError as e:
+                if self._breaker.is_outage(e):
+                    self._breaker.record_failure()
+                raise
+            self._breaker.record_success()
+            if name == 'aggregate':
+                # Only the first batch came back with the command
+                result = ResilientCursor(result, self._breaker, deadline_at)
+            return result
+        return guarded
+
+def write_concern_from_env(prefix: str, w, j: bool) -> WriteConcern:
+    """Write concern from <prefix>_W (number or tag such as 'majority'; 0 is unacknowledged) and <prefix>_J"""
+    w = os.environ.get(f'{prefix}_W', str(w))
+    w = int(w) if w.isdigit() else w
+    j = os.environ.get(f'{prefix}_J', str(j)).lower() == 'true'
+    wtimeout = int(os.environ.get(f'{prefix}_WTIMEOUT_MS', 0)) or None
+    if w == 0:
+        return WriteConcern(w=0)
+    return WriteConcern(w=w, j=j, wtimeout=wtimeout)
+
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST
+}
+
+# Write concerns per kind of data: session churn is cheap to lose (a user
+# just redials), money must survive a failover. Set SESSION_WRITE_W=0 for
+# unacknowledged session writes
+SESSION_WRITE_CONCERN = write_concern_from_env('SESSION_WRITE', 1, False)
+MONEY_WRITE_CONCERN = write_concern_from_env('MONEY_WRITE', 'majority', True)
+
+# Reads that tolerate replication lag can go to secondaries; balance,
+# limit and authentication reads always use the primary
+HISTORY_READ_PREFERENCE = READ_PREFERENCES[os.environ.get('HISTORY_READ_PREFERENCE', 'primary')]
+STATS_READ_PREFERENCE = READ_PREFERENCES[os.environ.get('STATS_READ_PREFERENCE', 'primary')]
 
 # Initialize Africa's Talking
 try:
@@ -57,13 +406,40 @@ except Exception as e:
 
 # Initialize MongoDB
 try:
-    client = MongoClient(MONGODB_URI)
+    client = MongoClient(
+        MONGODB_URI,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE
+    )
     db = client[DATABASE_NAME]
+    mongo_breaker = CircuitBreaker(
+        MONGO_BREAKER_FAILURES, lambda: client.admin.command('ping'), MONGO_PROBE_INTERVAL
+    )
+    
+    def collection(name: str, write_concern: WriteConcern) -> ResilientCollection:
+        return ResilientCollection(db.get_collection(name, write_concern=write_concern), mongo_breaker)
     
     # Create collections with indexes
-    users_collection = db.users
-    transactions_collection = db.transactions
-    sessions_collection = db.sessions
+    users_collection = collection('users', MONEY_WRITE_CONCERN)
+    # Raw documents skip decoding entirely; used where only existence matters
+    raw_users_collection = users_collection.with_options(
+        codec_options=CodecOptions(document_class=RawBSONDocument)
+    )
+    transactions_collection = collection('transactions', MONEY_WRITE_CONCERN)
+    sessions_collection = collection('sessions', SESSION_WRITE_CONCERN)
+    ledger_entries_collection = collection('ledger_entries', MONEY_WRITE_CONCERN)
+    balance_checkpoints_collection = collection('balance_checkpoints', MONEY_WRITE_CONCERN)
+    balance_stripes_collection = collection('balance_stripes', MONEY_WRITE_CONCERN)
+    archive_catalog_collection = collection('transactions_archive_catalog', MONEY_WRITE_CONCERN)
+    stateless_results_collection = collection('stateless_results', MONEY_WRITE_CONCERN)
+    
+    # Views for reads that may be served by secondaries
+    history_transactions_collection = transactions_collection.with_options(read_preference=HISTORY_READ_PREFERENCE)
+    stats_users_collection = users_collection.with_options(read_preference=STATS_READ_PREFERENCE)
+    stats_transactions_collection = transactions_collection.with_options(read_preference=STATS_READ_PREFERENCE)
+    stats_balance_stripes_collection = balance_stripes_collection.with_options(read_preference=STATS_READ_PREFERENCE)
     
     # Create indexes
     users_collection.create_index("phone_number", unique=True)
@@ -72,9 +448,26 @@ try:
     transactions_collection.create_index([("user_id", 1), ("created_at", -1)])
     transactions_collection.create_index("transaction_id", unique=True)
     transactions_collection.create_index("created_at")
+    transactions_collection.create_index([("user_phone", 1), ("created_at", 1)])
+    transactions_collection.create_index([("user_phone", 1), ("created_at", -1), ("transaction_id", -1)])
+    transactions_collection.create_index("reference", sparse=True)
+    
+    # Index builds must be acknowledged even if session writes are not
+    db.sessions.create_index("session_id", unique=True)
+    db.sessions.create_index("expires_at", expireAfterSeconds=0)
+    
+    ledger_entries_collection.create_index([("journal_id", 1), ("account", 1), ("side", 1)], unique=True)
+    ledger_entries_collection.create_index([("account", 1), ("created_at", 1)])
+    ledger_entries_collection.create_index("created_at")
+    
+    balance_checkpoints_collection.create_index([("account", 1), ("as_of", -1)], unique=True)
     
-    sessions_collection.create_index("session_id", unique=True)
-    sessions_collection.create_index("expires_at", expireAfterSeconds=0)
+    balance_stripes_collection.create_index([("phone_number", 1), ("stripe", 1)], unique=True)
+    users_collection.create_index("striped", sparse=True)
+    
+    archive_catalog_collection.create_index("month", unique=True)
+    
+    stateless_results_collection.create_index("expires_at", expireAfterSeconds=0)
     
     logger.info("MongoDB connected and indexes created successfully")
     
@@ -82,12 +475,267 @@ except PyMongoError as e:
     logger.error(f"MongoDB connection failed: {e}")
     raise
 
+class Money:
+    """Integer minor-unit money helpers.
+
+    Balances and amounts are plain ints of minor units inside the ledger and
+    in MongoDB (int64), so arithmetic and ``$inc`` are exact. Decimal is only
+    used at the edges: parsing user input and formatting responses.
+    """
+    
+    @staticmethod
+    def to_minor(amount: Decimal) -> int:
+        """Convert a major-unit Decimal to minor units"""
+        minor = (Decimal(amount) * MINOR_UNITS_PER_MAJOR).quantize(Decimal('1'), rounding=ROUND_HALF_UP)
+        return int(minor)
+    
+    @staticmethod
+    def to_major(minor: int) -> Decimal:
+        """Convert minor units to a major-unit Decimal"""
+        return (Decimal(int(minor)) / MINOR_UNITS_PER_MAJOR).quantize(Decimal('0.01'))
+    
+    @staticmethod
+    def format(minor: int) -> str:
+        """Format minor units for display, e.g. 150050 -> '1500.50'"""
+        return f"{Money.to_major(minor):.2f}"
+
+class SingleFlight:
+    """Coalesces concurrent identical reads into one in-flight call.
+
+    ``do(key, fn)`` runs ``fn`` once for all callers that ask for the same
+    key while it is in flight; each gets its own deep copy of the result, so
+    callers can mutate what they get back. With a TTL, truthy results are
+    also kept for that long. Keys are tuples whose first element groups them
+    for ``forget``, e.g. ``(phone_number, projection)``.
+    """
+    
+    def __init__(self, max_cached: int = SINGLE_FLIGHT_CACHE_SIZE):
+        self.max_cached = max_cached
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._cache = OrderedDict()
+    
+    def do(self, key: tuple, fn, ttl: float = 0):
+        with self._lock:
+            if ttl:
+                cached = self._cache.get(key[0], {}).get(key)
+                if cached and cached[0] > time.monotonic():
+                    return copy.deepcopy(cached[1])
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'event': threading.Event(), 'result': None, 'error': None}
+        
+        if leader:
+            try:
+                call['result'] = fn()
+            except Exception as e:
+                call['error'] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                    if ttl and call['result'] and call['error'] is None:
+                        self._remember(key, call['result'], ttl)
+                call['event'].set()
+        else:
+            call['event'].wait()
+        
+        if call['error'] is not None:
+            raise call['error']
+        return copy.deepcopy(call['result'])
+    
+    def _remember(self, key: tuple, result, ttl: float) -> None:
+        group = self._cache.setdefault(key[0], {})
+        group[key] = (time.monotonic() + ttl, result)
+        self._cache.move_to_end(key[0])
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+    
+    def forget(self, group) -> None:
+        """Drop cached results for a key group after a write"""
+        with self._lock:
+            self._cache.pop(group, None)
+
+def projection_key(fields: Optional[Dict]) -> Optional[tuple]:
+    """Hashable form of a projection for single-flight keys"""
+    return tuple(sorted(fields.items())) if fields else None
+
+user_lookups = SingleFlight()
+session_lookups = SingleFlight()
+
+class PhoneBloomFilter:
+    """Bloom filter of registered, normalized phone numbers.
+
+    ``might_contain`` returning False means the number is definitely not
+    registered (as of the last sync); True means it probably is, wrong with
+    probability ``false_positive_rate`` once ``capacity`` numbers are in.
+    Bits are ``m = -n ln p / (ln 2)^2`` and probes ``k = (m / n) ln 2``,
+    derived from one 128-bit BLAKE2b digest by double hashing.
+
+    The filter is built by streaming ``users_collection`` at startup, takes
+    numbers registered by this worker immediately, and pulls users created
+    by other workers by ``created_at`` periodically and, at most once per
+    BLOOM_MISS_SYNC_INTERVAL, on a miss. Until the first build completes
+    every number is reported as possibly present, so lookups fall through
+    to MongoDB. Builds hash each batch on a real thread (``run_in_thread``),
+    so under gevent the event loop keeps serving requests while they run.
+    """
+    
+    def __init__(self, capacity: int = BLOOM_EXPECTED_USERS,
+                 false_positive_rate: float = BLOOM_FALSE_POSITIVE_RATE):
+        self.false_positive_rate = false_positive_rate
+        self.ready = False
+        self.count = 0
+        # (bits, m, k) swapped as one reference so readers never mix generations
+        self._filter = self._allocate(capacity)
+        self._lock = threading.Lock()
+        self._synced_until = None
+        self._last_sync = 0.0
+        self._sync_flight = SingleFlight()
+    
+    def _allocate(self, capacity: int) -> tuple:
+        capacity = max(capacity, 1000)
+        m = int(math.ceil(-capacity * math.log(self.false_positive_rate) / math.log(2) ** 2))
+        k = max(1, int(round(m / capacity * math.log(2))))
+        return bytearray((m + 7) // 8), m, k
+    
+    @staticmethod
+    def _probes(phone_number: str, m: int, k: int):
+        digest = hashlib.blake2b(phone_number.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % m for i in range(k))
+    
+    @staticmethod
+    def _set(bits: bytearray, m: int, k: int, phone_number: str) -> None:
+        for bit in PhoneBloomFilter._probes(phone_number, m, k):
+            bits[bit >> 3] |= 1 << (bit & 7)
+    
+    @staticmethod
+    def _set_many(bits: bytearray, m: int, k: int, phone_numbers: list) -> None:
+        for phone_number in phone_numbers:
+            PhoneBloomFilter._set(bits, m, k, phone_number)
+    
+    def _contains(self, phone_number: str) -> bool:
+        bits, m, k = self._filter
+        return all(bits[bit >> 3] & (1 << (bit & 7)) for bit in self._probes(phone_number, m, k))
+    
+    def add(self, phone_number: str) -> None:
+        """Record a newly registered number"""
+        # Bit updates are read-modify-write, so writers are serialized
+        with self._lock:
+            self._set(*self._filter, phone_number)
+            self.count += 1
+    
+    def might_contain(self, phone_number: str) -> bool:
+        """False only if the number is definitely not registered"""
+        if not self.ready or self._contains(phone_number):
+            return True
+        # Catch up on numbers registered by other workers before answering no
+        if time.monotonic() - self._last_sync >= BLOOM_MISS_SYNC_INTERVAL:
+            self.sync()
+            return self._contains(phone_number)
+        return False
+    
+    def build(self) -> None:
+        """Rebuild from all users, sized for the current population"""
+        started = datetime.utcnow()
+        capacity = max(BLOOM_EXPECTED_USERS, 2 * users_collection.estimated_document_count())
+        bits, m, k = self._allocate(capacity)
+        count = 0
+        batch = []
+        # Reads stay on this (possibly green) thread; only the hashing moves
+        for user in users_collection.find({}, {'_id': 0, 'phone_number': 1}).batch_size(BLOOM_BUILD_BATCH):
+            batch.append(user['phone_number'])
+            if len(batch) >= BLOOM_BUILD_BATCH:
+                run_in_thread(self._set_many, bits, m, k, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            run_in_thread(self._set_many, bits, m, k, batch)
+            count += len(batch)
+        
+        with self._lock:
+            self._filter = (bits, m, k)
+            self.count = count
+            self._synced_until = started
+            self.ready = True
+        # Picks up numbers added to the old filter while this one was built
+        self.sync()
+        logger.info(f"Phone Bloom filter built: {count} numbers, {len(bits) // 1024} KiB, k={k}")
+    
+    def sync(self) -> None:
+        """Add users created since the last sync"""
+        self._sync_flight.do(('sync',), self._sync)
+    
+    def _sync(self) -> None:
+        self._last_sync = time.monotonic()
+        since = self._synced_until - timedelta(seconds=BLOOM_SYNC_OVERLAP)
+        now = datetime.utcnow()
+        for user in users_collection.find({'created_at': {'$gte': since}}, {'_id': 0, 'phone_number': 1}):
+            if not self._contains(user['phone_number']):
+                self.add(user['phone_number'])
+        self._synced_until = now
+    
+    def start(self) -> threading.Thread:
+        """Build in the background, then keep the filter in sync"""
+        def run():
+            last_build = None
+            while True:
+                try:
+                    if last_build is None or time.monotonic() - last_build >= BLOOM_REBUILD_INTERVAL:
+                        self.build()
+                        last_build = time.monotonic()
+                    else:
+                        self.sync()
+                except Exception as e:
+                    logger.error(f"Phone Bloom filter refresh failed: {e}")
+                threading.Event().wait(BLOOM_SYNC_INTERVAL)
+        
+        thread = threading.Thread(target=run, name='phone-bloom-filter', daemon=True)
+        thread.start()
+        return thread
+
+phone_filter = PhoneBloomFilter()
+
+class SessionData(dict):
+    """Session ``data`` that remembers what the database holds.
+
+    ``update_session`` compares it with that stored copy and writes only the
+    keys that were added, changed or removed, plus the step if it moved.
+    """
+    
+    def __init__(self, data: Dict = None, step: str = None, expires_at: datetime = None):
+        super().__init__(data or {})
+        self.mark_stored(step, expires_at)
+    
+    def mark_stored(self, step: Optional[str], expires_at: Optional[datetime]) -> None:
+        """Record the current contents as stored"""
+        self.stored = copy.deepcopy(dict(self))
+        self.stored_step = step
+        self.expires_at = expires_at
+    
+    def changes(self, step: str = None) -> Tuple[Dict, Dict]:
+        """``$set`` and ``$unset`` fields for what differs from the stored copy"""
+        set_fields = {f"data.{key}": value for key, value in self.items()
+                      if key not in self.stored or self.stored[key] != value}
+        unset_fields = {f"data.{key}": '' for key in self.stored if key not in self}
+        if step and step != self.stored_step:
+            set_fields['step'] = step
+        return set_fields, unset_fields
+    
+    def expiring(self, now: datetime) -> bool:
+        """Whether expires_at is unknown or within SESSION_REFRESH_MARGIN"""
+        return self.expires_at is None or self.expires_at - now < timedelta(minutes=SESSION_REFRESH_MARGIN)
+
 class USSDSession:
     """Manages USSD session state"""
     
     @staticmethod
     def create_session(session_id: str, phone_number: str, data: Dict = None) -> bool:
         """Create a new session"""
+        if StatelessSessions.current(session_id):
+            return True
         try:
             session_data = {
                 'session_id': session_id,
@@ -104,30 +752,53 @@ class USSDSession:
             return False
     
     @staticmethod
-    def get_session(session_id: str) -> Optional[Dict]:
-        """Get session data"""
+    def get_session(session_id: str, fields: Dict = SESSION_FIELDS) -> Optional[Dict]:
+        """Get session data (only ``fields``; None for the whole document)"""
         try:
-            return sessions_collection.find_one({'session_id': session_id})
+            session = session_lookups.do(
+                (session_id, projection_key(fields)),
+                lambda: sessions_collection.find_one({'session_id': session_id}, fields)
+            )
+            if session is not None:
+                session['data'] = SessionData(session.get('data'), session.get('step'), session.get('expires_at'))
+            return session
         except Exception as e:
             logger.error(f"Failed to get session: {e}")
             return None
     
     @staticmethod
     def update_session(session_id: str, data: Dict, step: str = None) -> bool:
-        """Update session data"""
-        try:
-            update_data = {
-                'data': data,
-                'expires_at': datetime.utcnow() + timedelta(minutes=SESSION_TIMEOUT)
-            }
+        """Update session data, writing only what changed"""
+        stateless = StatelessSessions.current(session_id)
+        if stateless:
+            stateless['data'] = data
             if step:
-                update_data['step'] = step
-                
-            result = sessions_collection.update_one(
-                {'session_id': session_id},
-                {'$set': update_data}
-            )
-            return result.modified_count > 0
+                stateless['step'] = step
+            return True
+        try:
+            now = datetime.utcnow()
+            if isinstance(data, SessionData):
+                set_fields, unset_fields = data.changes(step)
+                if not (set_fields or unset_fields or data.expiring(now)):
+                    # Nothing changed and the session is not close to expiring
+                    return True
+            else:
+                set_fields, unset_fields = {'data': data}, {}
+                if step:
+                    set_fields['step'] = step
+            
+            # Any write also pushes expiry out, so it costs nothing extra
+            expires_at = now + timedelta(minutes=SESSION_TIMEOUT)
+            set_fields['expires_at'] = expires_at
+            update = {'$set': set_fields}
+            if unset_fields:
+                update['$unset'] = unset_fields
+            
+            result = sessions_collection.update_one({'session_id': session_id}, update)
+            if isinstance(data, SessionData):
+                data.mark_stored(step or data.stored_step, expires_at)
+            # Unacknowledged session writes report nothing back
+            return result.modified_count > 0 if result.acknowledged else True
         except Exception as e:
             logger.error(f"Failed to update session: {e}")
             return False
@@ -135,13 +806,858 @@ class USSDSession:
     @staticmethod
     def delete_session(session_id: str) -> bool:
         """Delete session"""
+        stateless = StatelessSessions.current(session_id)
+        if stateless:
+            stateless['deleted'] = True
+            return True
         try:
             result = sessions_collection.delete_one({'session_id': session_id})
-            return result.deleted_count > 0
+            return result.deleted_count > 0 if result.acknowledged else True
         except Exception as e:
             logger.error(f"Failed to delete session: {e}")
             return False
 
+class LedgerManager:
+    """Append-only double-entry ledger with periodic balance checkpoints.
+
+    Every money movement is a journal: two or more immutable entries sharing a
+    ``journal_id`` whose debits and credits sum to the same amount. Wallet
+    accounts are liabilities, so a credit increases the balance and a debit
+    decreases it. A balance at any point in time is the latest checkpoint at
+    or before that time plus the entries after it.
+
+    The transaction record that moves a balance carries the journal it
+    needs (``ledger``), written in the same insert. The journal is posted
+    right after; if that fails, ``repair_unposted`` finds the record without
+    entries and posts it, so a failed post is late rather than lost.
+    """
+    
+    @staticmethod
+    def post_journal(journal_id: str, postings: list, description: str = None) -> bool:
+        """Post a balanced journal.
+
+        ``postings`` is a list of ``(account, side, amount)`` tuples where side
+        is ``'debit'`` or ``'credit'`` and amount is in minor units.
+        """
+        try:
+            debits = sum(amount for _, side, amount in postings if side == 'debit')
+            credits = sum(amount for _, side, amount in postings if side == 'credit')
+            if debits != credits or debits <= 0:
+                logger.error(f"Refusing unbalanced journal {journal_id}: debits={debits} credits={credits}")
+                return False
+            
+            now = datetime.utcnow()
+            entries = [{
+                'journal_id': journal_id,
+                'account': account,
+                'side': side,
+                'amount': amount,
+                'description': description,
+                'created_at': now
+            } for account, side, amount in postings]
+            
+            # Unordered, so a retry of a partly posted journal still adds
+            # the legs that are missing
+            ledger_entries_collection.insert_many(entries, ordered=False)
+            return True
+        except DuplicateKeyError:
+            # Journal already posted; entries are immutable so this is a no-op
+            return LedgerManager.verify_journal(journal_id)
+        except BulkWriteError as e:
+            # insert_many reports duplicates as a bulk error; the journal is
+            # posted if what is now stored balances
+            if all(error.get('code') == 11000 for error in e.details.get('writeErrors', [])):
+                if LedgerManager.verify_journal(journal_id):
+                    return True
+                logger.error(f"Journal {journal_id} is stored unbalanced")
+                return False
+            logger.error(f"Failed to post journal {journal_id}: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"Failed to post journal {journal_id}: {e}")
+            return False
+    
+    @staticmethod
+    def post_transfer(journal_id: str, from_account: str, to_account: str, amount: int,
+                      description: str = None) -> bool:
+        """Post a two-legged journal moving ``amount`` from one account to another"""
+        return LedgerManager.post_journal(journal_id, [
+            (from_account, 'debit', amount),
+            (to_account, 'credit', amount)
+        ], description)
+    
+    @staticmethod
+    def post_recorded(ledger: Dict, amount: int) -> bool:
+        """Post the journal a transaction record carries"""
+        return LedgerManager.post_transfer(ledger['journal_id'], ledger['from'], ledger['to'], amount,
+                                           ledger.get('description'))
+    
+    @staticmethod
+    def repair_unposted(since: datetime) -> int:
+        """Post the journals of transaction records since ``since`` that have no entries"""
+        unposted = transactions_collection.aggregate([
+            {'$match': {'created_at': {'$gte': since}, 'ledger': {'$exists': True}}},
+            {'$lookup': {'from': ledger_entries_collection.name, 'localField': 'ledger.journal_id',
+                         'foreignField': 'journal_id', 'as': 'posted'}},
+            {'$match': {'posted': {'$size': 0}}},
+            {'$project': {'_id': 0, 'ledger': 1, 'amount': 1}}
+        ])
+        count = 0
+        for record in unposted:
+            if LedgerManager.post_recorded(record['ledger'], record['amount']):
+                count += 1
+        if count:
+            logger.warning(f"Posted {count} ledger journals that had failed")
+        return count
+    
+    @staticmethod
+    def start_repairer(interval: int = LEDGER_REPAIR_INTERVAL) -> threading.Thread:
+        """Run repair_unposted periodically on a daemon thread"""
+        def run():
+            # Older records are left to the checkpoint job's repair pass
+            since = datetime.utcnow() - timedelta(seconds=LEDGER_REPAIR_OVERLAP)
+            while True:
+                started = datetime.utcnow()
+                try:
+                    LedgerManager.repair_unposted(since)
+                    since = started - timedelta(seconds=LEDGER_REPAIR_OVERLAP)
+                except Exception as e:
+                    logger.error(f"Ledger repair error: {e}")
+                threading.Event().wait(interval)
+        
+        thread = threading.Thread(target=run, name='ledger-repairer', daemon=True)
+        thread.start()
+        return thread
+    
+    @staticmethod
+    def _sum_entries(account: str, after: Optional[datetime], until: datetime) -> int:
+        """Net credits minus debits for an account in (after, until]"""
+        created_at = {'$lte': until}
+        if after is not None:
+            created_at['$gt'] = after
+        
+        result = list(ledger_entries_collection.aggregate([
+            {'$match': {'account': account, 'created_at': created_at}},
+            {'$group': {
+                '_id': None,
+                'net': {'$sum': {'$cond': [
+                    {'$eq': ['$side', 'credit']}, '$amount', {'$multiply': ['$amount', -1]}
+                ]}}
+            }}
+        ]))
+        return result[0]['net'] if result else 0
+    
+    @staticmethod
+    def get_balance(account: str, as_of: datetime = None) -> int:
+        """Balance of an account at a point in time (default: now), in minor units"""
+        as_of = as_of or datetime.utcnow()
+        checkpoint = balance_checkpoints_collection.find_one(
+            {'account': account, 'as_of': {'$lte': as_of}},
+            sort=[('as_of', DESCENDING)]
+        )
+        base = checkpoint['balance'] if checkpoint else 0
+        after = checkpoint['as_of'] if checkpoint else None
+        return base + LedgerManager._sum_entries(account, after, as_of)
+    
+    @staticmethod
+    def create_checkpoint(account: str, as_of: datetime = None) -> Optional[Dict]:
+        """Record the account balance as of ``as_of`` (default: now minus the checkpoint lag)"""
+        try:
+            as_of = as_of or datetime.utcnow() - timedelta(seconds=LEDGER_CHECKPOINT_LAG)
+            checkpoint = {
+                'account': account,
+                'as_of': as_of,
+                'balance': LedgerManager.get_balance(account, as_of),
+                'created_at': datetime.utcnow()
+            }
+            balance_checkpoints_collection.insert_one(checkpoint)
+            return checkpoint
+        except DuplicateKeyError:
+            return balance_checkpoints_collection.find_one({'account': account, 'as_of': as_of})
+        except Exception as e:
+            logger.error(f"Failed to checkpoint {account}: {e}")
+            return None
+    
+    @staticmethod
+    def checkpoint_active_accounts(since: datetime, as_of: datetime = None) -> int:
+        """Checkpoint every account that has entries after ``since``"""
+        as_of = as_of or datetime.utcnow() - timedelta(seconds=LEDGER_CHECKPOINT_LAG)
+        accounts = ledger_entries_collection.aggregate([
+            {'$match': {'created_at': {'$gt': since, '$lte': as_of}}},
+            {'$group': {'_id': '$account'}}
+        ], allowDiskUse=True)
+        
+        count = 0
+        for row in accounts:
+            if LedgerManager.create_checkpoint(row['_id'], as_of):
+                count += 1
+        logger.info(f"Created {count} ledger checkpoints as of {as_of.isoformat()}")
+        return count
+    
+    @staticmethod
+    def verify_journal(journal_id: str) -> bool:
+        """Check that a journal's debits and credits balance"""
+        entries = list(ledger_entries_collection.find({'journal_id': journal_id}, {'side': 1, 'amount': 1}))
+        debits = sum(e['amount'] for e in entries if e['side'] == 'debit')
+        credits = sum(e['amount'] for e in entries if e['side'] == 'credit')
+        return bool(entries) and debits == credits
+    
+    @staticmethod
+    def post_opening_balance(account: str, balance: int) -> bool:
+        """Bring a pre-ledger account balance into the ledger.
+
+        ``balance`` is the account's current balance; the opening journal
+        covers whatever part of it the ledger does not already explain, so
+        accounts that transacted before the bootstrap ran come out right.
+        Posting it once per account is enforced by its journal ID.
+        """
+        journal_id = f"OPENING-{account}"
+        if ledger_entries_collection.find_one({'journal_id': journal_id}, {'_id': 1}):
+            return True
+        opening = balance - LedgerManager.get_balance(account)
+        if opening < 0:
+            logger.error(f"Ledger for {account} exceeds its balance by {-opening}; not posting an opening balance")
+            return False
+        if opening == 0:
+            return True
+        return LedgerManager.post_transfer(journal_id, SYSTEM_OPENING_ACCOUNT, account, opening, 'Opening balance')
+
+class StripedBalance:
+    """Sub-balance striping for hot payee accounts.
+
+    Accounts flagged with ``striped: True`` receive credits on one of
+    ``stripe_count`` documents in ``balance_stripes`` chosen by hashing the
+    transaction ID, so concurrent credits no longer serialise on the user
+    document. The spendable balance is the user document balance plus all
+    stripes. A compactor periodically folds the stripes back into the user
+    document; debits fold first when the main balance alone is short.
+
+    Folding is a three-step move guarded by a fold token so it is safe to
+    retry after a crash: the stripe amount is parked in ``pending``, the user
+    balance is incremented once per token, then ``pending`` is cleared.
+    """
+    
+    @staticmethod
+    def is_striped(user: Dict) -> bool:
+        """Whether credits to this user go to stripes"""
+        return bool(user and user.get('striped'))
+    
+    @staticmethod
+    def enable(phone_number: str, stripe_count: int = None) -> bool:
+        """Flag an account for striping"""
+        result = users_collection.update_one(
+            {'phone_number': phone_number},
+            {'$set': {'striped': True, 'stripe_count': stripe_count or BALANCE_STRIPE_COUNT}}
+        )
+        user_lookups.forget(phone_number)
+        return result.matched_count > 0
+    
+    @staticmethod
+    def credit(user: Dict, amount: int, key: str, idempotent: bool = False) -> None:
+        """Credit one stripe of a striped account (at most once per key if idempotent).
+
+        Stripes only ever hold minor units; the fold into the user document
+        is what refuses a legacy double balance.
+        """
+        stripe_count = user.get('stripe_count') or BALANCE_STRIPE_COUNT
+        stripe = zlib.crc32(key.encode()) % stripe_count
+        stripe_filter = {'phone_number': user['phone_number'], 'stripe': stripe}
+        update = {'$inc': {'balance': amount}}
+        if idempotent:
+            stripe_filter['applied_txns'] = {'$ne': key}
+            update['$push'] = {'applied_txns': {'$each': [key], '$slice': -APPLIED_TXN_MEMORY}}
+        try:
+            balance_stripes_collection.update_one(stripe_filter, update, upsert=True)
+        except DuplicateKeyError:
+            if not idempotent:
+                raise
+            # The stripe already recorded this key, so the upsert collided with it
+    
+    @staticmethod
+    def stripe_total(phone_number: str, fold_tokens: list = None) -> int:
+        """Sum of all stripes, counting parked amounts not yet applied to the user document"""
+        applied = set(fold_tokens or [])
+        total = 0
+        for stripe in balance_stripes_collection.find({'phone_number': phone_number}):
+            total += stripe.get('balance', 0)
+            if stripe.get('pending') and stripe.get('fold_token') not in applied:
+                total += stripe['pending']
+        return total
+    
+    @staticmethod
+    def get_balance(user: Dict) -> int:
+        """Spendable balance of a striped account"""
+        return user['balance'] + StripedBalance.stripe_total(user['phone_number'], user.get('fold_tokens'))
+    
+    @staticmethod
+    def _finish_fold(stripe: Dict) -> bool:
+        """Apply a parked stripe amount to the user document and clear it"""
+        token = stripe['fold_token']
+        result = users_collection.update_one(
+            {'phone_number': stripe['phone_number'], 'fold_tokens': {'$ne': token}, 'balance': MINOR_UNIT_BALANCE},
+            {
+                '$inc': {'balance': stripe['pending']},
+                '$push': {'fold_tokens': {'$each': [token], '$slice': -50}}
+            }
+        )
+        if not result.modified_count and not users_collection.find_one(
+                {'phone_number': stripe['phone_number'], 'fold_tokens': token}, {'_id': 1}):
+            # A legacy double balance: the amount stays parked until it is migrated
+            logger.error(f"Fold of {stripe['phone_number']} stripe {stripe.get('stripe')} refused: balance is not in minor units")
+            return False
+        balance_stripes_collection.update_one(
+            {'_id': stripe['_id'], 'fold_token': token},
+            {'$set': {'pending': 0}, '$unset': {'fold_token': ''}}
+        )
+        user_lookups.forget(stripe['phone_number'])
+        return True
+    
+    @staticmethod
+    def compact(phone_number: str) -> int:
+        """Fold all stripes of an account into the user document, returning the amount moved"""
+        moved = 0
+        for stripe in balance_stripes_collection.find({'phone_number': phone_number}):
+            try:
+                # Finish a fold interrupted by a crash before starting a new one
+                if stripe.get('pending'):
+                    if StripedBalance._finish_fold(stripe):
+                        moved += stripe['pending']
+                    continue
+                
+                amount = stripe.get('balance', 0)
+                if amount <= 0:
+                    continue
+                
+                token = secrets.token_hex(8)
+                parked = balance_stripes_collection.find_one_and_update(
+                    {'_id': stripe['_id'], 'balance': {'$gte': amount}, 'pending': {'$in': [0, None]}},
+                    {'$inc': {'balance': -amount}, '$set': {'pending': amount, 'fold_token': token}},
+                    return_document=ReturnDocument.AFTER
+                )
+                if not parked:
+                    continue  # another compactor got there first
+                
+                if StripedBalance._finish_fold(parked):
+                    moved += amount
+            except Exception as e:
+                logger.error(f"Stripe compaction failed for {phone_number}: {e}")
+        return moved
+    
+    @staticmethod
+    def compact_all() -> int:
+        """Fold the stripes of every striped account"""
+        total = 0
+        for user in users_collection.find({'striped': True}, {'phone_number': 1}):
+            total += StripedBalance.compact(user['phone_number'])
+        return total
+    
+    @staticmethod
+    def start_compactor(interval: int = STRIPE_COMPACT_INTERVAL) -> threading.Thread:
+        """Run compact_all periodically on a daemon thread"""
+        def run():
+            while True:
+                try:
+                    StripedBalance.compact_all()
+                except Exception as e:
+                    logger.error(f"Stripe compactor error: {e}")
+                threading.Event().wait(interval)
+        
+        thread = threading.Thread(target=run, name='stripe-compactor', daemon=True)
+        thread.start()
+        return thread
+
+class TransactionArchive:
+    """Time-partitioned cold storage for old transactions.
+
+    Each calendar month lives in its own ``transactions_archive_YYYYMM``
+    collection created with a block compressor, and
+    ``transactions_archive_catalog`` records which months exist and the time
+    range each one covers. History reads fall back to the archive only when
+    the hot collection cannot satisfy them, and then only to the months
+    that overlap the user's lifetime (from their ``created_at``), so a user
+    registered after the newest archived row never queries the archive.
+    The catalog is cached for ARCHIVE_CATALOG_TTL seconds, so rows archived
+    in that window may briefly be missing from history.
+    """
+    
+    _catalog = None
+    _catalog_lock = threading.Lock()
+    
+    @staticmethod
+    def collection_name(created_at: datetime) -> str:
+        """Archive collection holding a given timestamp"""
+        return f"{ARCHIVE_COLLECTION_PREFIX}{created_at.strftime('%Y%m')}"
+    
+    @staticmethod
+    def get_collection(name: str):
+        """Get (creating if needed) a compressed archive collection with its indexes"""
+        if name not in db.list_collection_names(filter={'name': name}):
+            try:
+                db.create_collection(
+                    name,
+                    storageEngine={'wiredTiger': {'configString': f'block_compressor={ARCHIVE_COMPRESSOR}'}}
+                )
+            except CollectionInvalid:
+                pass  # created concurrently
+        collection = ResilientCollection(db.get_collection(name, write_concern=MONEY_WRITE_CONCERN), mongo_breaker)
+        collection.create_index([("user_phone", 1), ("created_at", -1)])
+        collection.create_index("transaction_id", unique=True)
+        collection.create_index("reference", sparse=True)
+        return collection
+    
+    @staticmethod
+    def archive_older_than(cutoff: datetime, batch_size: int = 1000) -> int:
+        """Move hot transactions created before ``cutoff`` into the archive.
+
+        Each batch is copied before it is deleted, and duplicate inserts are
+        ignored, so an interrupted run can simply be restarted.
+        """
+        moved = 0
+        collections = {}
+        while True:
+            batch = list(transactions_collection.find(
+                {'created_at': {'$lt': cutoff}}
+            ).sort('created_at', 1).limit(batch_size))
+            if not batch:
+                break
+            
+            by_month = {}
+            for txn in batch:
+                by_month.setdefault(TransactionArchive.collection_name(txn['created_at']), []).append(txn)
+            
+            for name, docs in by_month.items():
+                if name not in collections:
+                    collections[name] = TransactionArchive.get_collection(name)
+                try:
+                    collections[name].insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                        raise
+                
+                archive_catalog_collection.update_one(
+                    {'month': name[len(ARCHIVE_COLLECTION_PREFIX):]},
+                    {
+                        '$set': {'collection': name},
+                        '$min': {'min_created_at': docs[0]['created_at']},
+                        '$max': {'max_created_at': docs[-1]['created_at']},
+                        '$inc': {'count': len(docs)}
+                    },
+                    upsert=True
+                )
+            
+            transactions_collection.delete_many({'_id': {'$in': [txn['_id'] for txn in batch]}})
+            moved += len(batch)
+        
+        with TransactionArchive._catalog_lock:
+            TransactionArchive._catalog = None
+        logger.info(f"Archived {moved} transactions older than {cutoff.isoformat()}")
+        return moved
+    
+    @staticmethod
+    def catalog() -> list:
+        """Catalog entries, oldest month first"""
+        with TransactionArchive._catalog_lock:
+            cached = TransactionArchive._catalog
+        if cached and time.monotonic() - cached[0] < ARCHIVE_CATALOG_TTL:
+            return cached[1]
+        entries = list(archive_catalog_collection.find({}, {'_id': 0}).sort('month', 1))
+        with TransactionArchive._catalog_lock:
+            TransactionArchive._catalog = (time.monotonic(), entries)
+        return entries
+    
+    @staticmethod
+    def _collections(before: datetime = None, since: datetime = None, newest_first: bool = True) -> list:
+        """Archive collections, optionally only those holding data in [since, before)"""
+        entries = [
+            entry for entry in TransactionArchive.catalog()
+            if not (before and entry['min_created_at'] >= before)
+            and not (since and entry['max_created_at'] < since)
+        ]
+        if newest_first:
+            entries.reverse()
+        return [ResilientCollection(db[entry['collection']], mongo_breaker) for entry in entries]
+    
+    @staticmethod
+    def find_recent(phone_number: str, limit: int, before: datetime = None, since: datetime = None) -> list:
+        """Newest archived transactions of a user created at ``since``, optionally older than ``before``"""
+        results = []
+        query = {'user_phone': phone_number}
+        if before:
+            query['created_at'] = {'$lt': before}
+        
+        for collection in TransactionArchive._collections(before, since):
+            if len(results) >= limit:
+                break
+            results.extend(collection.find(query, {'_id': 0}).sort('created_at', DESCENDING).limit(limit - len(results)))
+        return results
+    
+    @staticmethod
+    def iter_history(phone_number: str, projection: Dict = None):
+        """Stream a user's archived transactions oldest first"""
+        for collection in TransactionArchive._collections(newest_first=False):
+            yield from collection.find(
+                {'user_phone': phone_number}, projection
+            ).sort([('created_at', 1), ('transaction_id', 1)]).batch_size(1000)
+    
+    @staticmethod
+    def find(query: Dict, projection: Dict = None) -> list:
+        """Run a query against every archive collection"""
+        results = []
+        for collection in TransactionArchive._collections():
+            results.extend(collection.find(query, projection))
+        return results
+
+class StatelessSessions:
+    """Session state derived from the USSD text chain.
+
+    The aggregator sends every input of the session so far in ``text``
+    (``1234*2*0712345678``), so the current step and collected data can be
+    rebuilt by replaying those inputs through the normal flow handlers. The
+    state after each prefix is memoised per process, so a hop normally
+    replays nothing and only runs its own input. Nothing is read from or
+    written to ``sessions_collection``.
+
+    While a session is being rebuilt, any step in SENSITIVE_STEPS aborts the
+    replay, so transfers, deposits, registrations and PIN changes only ever
+    execute on the hop that submits them. Gateways may resend that hop, to
+    this worker or another, so it first claims its (session, text) key in
+    ``stateless_results_collection``; a resent hop gets the stored response
+    instead of running again. Finished chains are also memoised, so a warm
+    worker answers a resend without the round trip. PINs in the replayed inputs go
+    through ``authenticate_user`` like any other attempt: a chain holding a
+    wrong PIN cannot come from a real session (a wrong PIN ends it), so every
+    guess made by crafting ``text`` counts toward the lockout.
+    """
+    
+    _memo = OrderedDict()
+    _lock = threading.Lock()
+    _local = threading.local()
+    
+    @staticmethod
+    def current(session_id: str) -> Optional[Dict]:
+        """The session being processed by this thread, if it is stateless"""
+        session = getattr(StatelessSessions._local, 'session', None)
+        if session is not None and session['session_id'] == session_id:
+            return session
+        return None
+    
+    @staticmethod
+    def _key(session_id: str, prefix: list) -> Tuple[str, str]:
+        # Prefixes contain PINs, so only a digest is kept in memory
+        return session_id, hashlib.sha256('*'.join(prefix).encode()).hexdigest()
+    
+    @staticmethod
+    def recall(session_id: str, prefix: list) -> Optional[Dict]:
+        """Memoised state after ``prefix``, if still fresh"""
+        key = StatelessSessions._key(session_id, prefix)
+        with StatelessSessions._lock:
+            entry = StatelessSessions._memo.get(key)
+            if not entry:
+                return None
+            expires_at, session = entry
+            if expires_at < datetime.utcnow():
+                del StatelessSessions._memo[key]
+                return None
+            StatelessSessions._memo.move_to_end(key)
+        return copy.deepcopy(session)
+    
+    @staticmethod
+    def remember(session_id: str, prefix: list, session: Dict) -> None:
+        """Memoise the state after ``prefix``"""
+        key = StatelessSessions._key(session_id, prefix)
+        expires_at = datetime.utcnow() + timedelta(minutes=SESSION_TIMEOUT)
+        with StatelessSessions._lock:
+            StatelessSessions._memo[key] = (expires_at, copy.deepcopy(session))
+            StatelessSessions._memo.move_to_end(key)
+            while len(StatelessSessions._memo) > STATELESS_MEMO_SIZE:
+                StatelessSessions._memo.popitem(last=False)
+    
+    @staticmethod
+    def claim(session_id: str, chain: list) -> Tuple[bool, Optional[str]]:
+        """Claim the single run of a sensitive hop.
+
+        Returns (True, None) for the first claim, otherwise (False, the stored
+        response), which is None while the first run has not finished.
+        """
+        claim_id = ':'.join(StatelessSessions._key(session_id, chain))
+        try:
+            stateless_results_collection.insert_one({
+                '_id': claim_id,
+                'response': None,
+                'expires_at': datetime.utcnow() + timedelta(seconds=STATELESS_RESULT_TTL)
+            })
+            return True, None
+        except DuplicateKeyError:
+            stored = stateless_results_collection.find_one({'_id': claim_id}, {'response': 1})
+            return False, (stored or {}).get('response')
+    
+    @staticmethod
+    def record(session_id: str, chain: list, response: str) -> None:
+        """Store the response of a claimed hop for resends"""
+        claim_id = ':'.join(StatelessSessions._key(session_id, chain))
+        try:
+            stateless_results_collection.update_one({'_id': claim_id}, {'$set': {'response': response}})
+        except Exception as e:
+            # The claim still stops a second run; a resend just gets a generic answer
+            logger.error(f"Failed to record stateless result {session_id}: {e}")
+    
+    @staticmethod
+    def initial(session_id: str, phone_number: str, user: Optional[Dict]) -> Dict:
+        """State at the start of a session, as create_session would store it"""
+        return {
+            'session_id': session_id,
+            'phone_number': phone_number,
+            'data': {} if user else {'step': 'registration'},
+            'step': 'main_menu'
+        }
+    
+    @staticmethod
+    def step_name(session: Dict) -> str:
+        """The step the next input will be applied to"""
+        data_step = session.get('data', {}).get('step')
+        return data_step if data_step in REGISTRATION_STEPS else session.get('step', 'main_menu')
+    
+    @staticmethod
+    def handle(session_id: str, phone_number: str, text: str, user: Optional[Dict]) -> str:
+        """Process one hop without touching sessions_collection"""
+        if not text:
+            return USSDMenus.login_menu() if user else USSDMenus.registration_menu()
+        
+        input_parts = text.split('*')
+        
+        # A resend of a hop that finished the session gets the same answer
+        finished = StatelessSessions.recall(session_id, input_parts)
+        if finished and 'finished' in finished:
+            return finished['finished']
+        
+        # Resume from the longest memoised prefix of the earlier inputs
+        session, start = None, 0
+        for length in range(len(input_parts) - 1, 0, -1):
+            session = StatelessSessions.recall(session_id, input_parts[:length])
+            if session:
+                start = length
+                break
+        if session and 'finished' in session:
+            # Nothing follows a finished hop in a real session
+            return USSDMenus.error_menu("Session expired")
+        if session is None:
+            session = StatelessSessions.initial(session_id, phone_number, user)
+        
+        local = StatelessSessions._local
+        response = USSDMenus.error_menu("Invalid session state")
+        try:
+            local.session = session
+            for i in range(start, len(input_parts)):
+                local.replaying = i < len(input_parts) - 1
+                sensitive = StatelessSessions.step_name(session) in SENSITIVE_STEPS
+                if local.replaying and sensitive:
+                    return USSDMenus.error_menu("Session expired")
+                if sensitive:
+                    claimed, stored = StatelessSessions.claim(session_id, input_parts)
+                    if not claimed:
+                        return stored or USSDMenus.error_menu("Request already received")
+                
+                response = dispatch_session_input(session, input_parts[i], input_parts[:i + 1], phone_number, user)
+                
+                if sensitive:
+                    StatelessSessions.record(session_id, input_parts, response)
+                if session.get('deleted'):
+                    # A finished session cannot take further input
+                    if local.replaying:
+                        return USSDMenus.error_menu("Session expired")
+                    StatelessSessions.remember(session_id, input_parts, {'finished': response})
+                    return response
+                StatelessSessions.remember(session_id, input_parts[:i + 1], session)
+            return response
+        finally:
+            local.session = None
+            local.replaying = False
+
+class TransferJournal:
+    """Durable transfer intents applied to MongoDB asynchronously.
+
+    ``submit`` appends the intent to a local write-ahead journal (see
+    journal.py) and returns once it is fsynced together with any other
+    transfers committed in the same group. A background thread applies
+    intents in order through ``WalletManager.apply_transfer``, whose writes
+    are idempotent, and marks them applied. On startup, anything not marked
+    applied is replayed.
+
+    Each worker process claims its own journal slot under MONEY_JOURNAL_DIR
+    with an exclusive lock, so slots left by a crashed worker are picked up
+    and replayed by the next process that starts.
+
+    Intents that can never be applied are failed or refunded by
+    ``apply_transfer``. One that keeps failing while MongoDB is reachable
+    is written to ``dead-letter.jsonl`` in the slot after
+    JOURNAL_APPLY_MAX_ATTEMPTS tries, so it cannot hold up the intents
+    behind it; an operator replays or refunds those by hand, and their
+    holds on the sender stay in place until then.
+    """
+    
+    journal = None
+    _pending = queue.Queue()
+    _slot_lock = None
+    
+    @staticmethod
+    def enabled() -> bool:
+        return TransferJournal.journal is not None
+    
+    @staticmethod
+    def _claim_slot(directory: str) -> str:
+        for slot in range(JOURNAL_MAX_SLOTS):
+            path = os.path.join(directory, f"slot-{slot}")
+            os.makedirs(path, exist_ok=True)
+            lock = open(os.path.join(path, 'lock'), 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+            TransferJournal._slot_lock = lock
+            return path
+        raise RuntimeError(f"No free journal slot under {directory}")
+    
+    @staticmethod
+    def start(directory: str = MONEY_JOURNAL_DIR, fsync=None) -> None:
+        """Open this process's journal, queue unapplied intents and start applying"""
+        if not directory or TransferJournal.journal:
+            return
+        from journal import Journal
+        
+        options = {'max_delay': JOURNAL_GROUP_COMMIT_MS / 1000}
+        if fsync is None and COOPERATIVE:
+            # fsync would block the event loop for the whole group commit
+            fsync = lambda fd: run_in_thread(os.fsync, fd)
+        if fsync:
+            options['fsync'] = fsync
+        TransferJournal.journal = Journal(TransferJournal._claim_slot(directory), **options)
+        
+        replayed = 0
+        for seq, payload in TransferJournal.journal.replay():
+            TransferJournal._pending.put((seq, json.loads(payload)))
+            replayed += 1
+        if replayed:
+            logger.info(f"Replaying {replayed} journalled transfers")
+        
+        threading.Thread(target=TransferJournal._apply_loop, name='journal-applier', daemon=True).start()
+    
+    @staticmethod
+    def submit(intent: Dict) -> None:
+        """Make a transfer intent durable and queue it for application"""
+        seq = TransferJournal.journal.append(json.dumps(intent).encode())
+        TransferJournal._pending.put((seq, intent))
+    
+    @staticmethod
+    def _apply_loop() -> None:
+        while True:
+            seq, intent = TransferJournal._pending.get()
+            delay, attempts = 0.1, 0
+            # Retry transient failures in place so intents stay in order
+            while not WalletManager.apply_transfer(intent):
+                if not mongo_breaker.is_open:
+                    # An outage clears by itself; other failures may not
+                    attempts += 1
+                    if attempts >= JOURNAL_APPLY_MAX_ATTEMPTS and TransferJournal._dead_letter(seq, intent):
+                        break
+                threading.Event().wait(delay)
+                delay = min(delay * 2, 30)
+            TransferJournal.journal.mark_applied(seq)
+    
+    @staticmethod
+    def _dead_letter(seq: int, intent: Dict) -> bool:
+        """Set aside an intent that keeps failing; False if it could not be stored"""
+        path = os.path.join(TransferJournal.journal.directory, 'dead-letter.jsonl')
+        try:
+            with open(path, 'a') as f:
+                f.write(json.dumps({'seq': seq, 'intent': intent}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.error(f"Failed to dead-letter transfer {intent['transfer_id']}: {e}")
+            return False
+        logger.critical(f"Transfer {intent['transfer_id']} failed {JOURNAL_APPLY_MAX_ATTEMPTS} times; "
+                        f"dead-lettered to {path}")
+        return True
+
+class BatchWriter:
+    """Coalesces inserts from concurrent requests into one insert_many.
+
+    ``insert`` queues a document and blocks until the batch holding it is
+    written. A flusher thread takes the first queued document, gathers more
+    for up to ``window`` seconds or ``max_docs`` documents, and writes them
+    unordered so one bad document does not fail its neighbours. Per-document
+    write errors are raised in the caller that submitted the document.
+
+    Each insert_many runs under MONGO_OP_DEADLINE_MS, and callers wait at
+    most that plus the window. A document whose caller gave up is still
+    written: the caller has already moved a balance and falls back to an
+    idempotent upsert keyed on the unique transaction_id, so a late batch
+    write cannot duplicate it.
+    """
+    
+    def __init__(self, collection, window: float, max_docs: int):
+        self.collection = collection
+        self.window = window
+        self.max_docs = max_docs
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._flusher = None
+    
+    def insert(self, document: Dict) -> None:
+        """Insert a document, batched with any concurrent inserts"""
+        if self.window <= 0:
+            self.collection.insert_one(document)
+            return
+        
+        # Started lazily so each forked worker runs its own flusher
+        with self._lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_loop, name='batch-writer', daemon=True)
+                self._flusher.start()
+        
+        waiter = {'document': document, 'event': threading.Event(), 'error': None}
+        self._queue.put(waiter)
+        timeout = self.window + MONGO_OP_DEADLINE_MS / 1000 + 1 if MONGO_OP_DEADLINE_MS else None
+        if not waiter['event'].wait(timeout):
+            raise ExecutionTimeout(f"Batched insert into {self.collection.name} did not complete in time")
+        if waiter['error']:
+            raise waiter['error']
+    
+    def _gather(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_docs:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _flush_loop(self) -> None:
+        deadline = MONGO_OP_DEADLINE_MS / 1000 if MONGO_OP_DEADLINE_MS else None
+        while True:
+            batch = self._gather()
+            try:
+                with pymongo.timeout(deadline):
+                    self.collection.insert_many([w['document'] for w in batch], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    waiter = batch[error['index']]
+                    error_class = DuplicateKeyError if error.get('code') == 11000 else WriteError
+                    waiter['error'] = error_class(error.get('errmsg'), error.get('code'), error)
+            except Exception as e:
+                logger.error(f"Batched insert into {self.collection.name} failed: {e}")
+                for waiter in batch:
+                    waiter['error'] = e
+            for waiter in batch:
+                waiter['event'].set()
+
+transaction_writer = BatchWriter(transactions_collection, TXN_BATCH_WINDOW_MS / 1000, TXN_BATCH_MAX_DOCS)
+
 class WalletManager:
     """Handles wallet operations"""
     
@@ -154,7 +1670,7 @@ class WalletManager:
     def validate_phone_number(phone_number: str) -> bool:
         """Validate phone number format"""
         # Remove any non-digit characters
-        clean_phone = re.sub(r'[^\d]', '', phone_number)
+        clean_phone = NON_DIGITS.sub('', phone_number)
         
         # Check if it's a valid Kenyan/African number format
         if clean_phone.startswith('0') and len(clean_phone) == 10:
@@ -169,7 +1685,7 @@ class WalletManager:
     @staticmethod
     def normalize_phone_number(phone_number: str) -> str:
         """Normalize phone number to +254 format"""
-        clean_phone = re.sub(r'[^\d]', '', phone_number)
+        clean_phone = NON_DIGITS.sub('', phone_number)
         
         if clean_phone.startswith('0'):
             return '+254' + clean_phone[1:]
@@ -183,20 +1699,24 @@ class WalletManager:
     @staticmethod
     def validate_pin(pin: str) -> bool:
         """Validate PIN format (4 digits)"""
-        return bool(re.match(r'^\d{4}$', pin))
+        return bool(PIN_FORMAT.match(pin))
     
     @staticmethod
-    def validate_amount(amount_str: str) -> Tuple[bool, Optional[Decimal]]:
-        """Validate transaction amount"""
+    def validate_amount(amount_str: str) -> Tuple[bool, Optional[int]]:
+        """Validate transaction amount and parse it into minor units"""
         try:
             amount = Decimal(amount_str)
             if amount <= 0:
                 return False, None
-            if amount < MIN_TRANSACTION_AMOUNT:
+            # Reject fractions of the minor unit instead of silently rounding
+            if amount != amount.quantize(Decimal('0.01')):
+                return False, None
+            minor = Money.to_minor(amount)
+            if minor < MIN_TRANSACTION_AMOUNT:
                 return False, None
-            if amount > MAX_TRANSACTION_AMOUNT:
+            if minor > MAX_TRANSACTION_AMOUNT:
                 return False, None
-            return True, amount
+            return True, minor
         except (InvalidOperation, ValueError):
             return False, None
     
@@ -217,18 +1737,17 @@ class WalletManager:
                 'phone_number': normalized_phone,
                 'pin_hash': hashed_pin,
                 'name': name or f"User {normalized_phone[-4:]}",
-                'balance': Decimal('0.00'),
+                'balance': 0,
                 'is_active': True,
                 'created_at': datetime.utcnow(),
                 'last_login': datetime.utcnow(),
                 'failed_pin_attempts': 0,
-                'is_locked': False
+                'is_locked': False,
+                'recent_activity': []
             }
             
-            # Convert Decimal to float for MongoDB
-            user_data['balance'] = float(user_data['balance'])
-            
             users_collection.insert_one(user_data)
+            phone_filter.add(normalized_phone)
             logger.info(f"User created successfully: {normalized_phone}")
             return True, "Account created successfully"
             
@@ -239,132 +1758,327 @@ class WalletManager:
             return False, "Registration failed. Please try again"
     
     @staticmethod
-    def authenticate_user(phone_number: str, pin: str) -> Tuple[bool, Optional[Dict]]:
-        """Authenticate user with phone number and PIN"""
+    def authenticate_user(phone_number: str, pin: str, fields: Dict = None) -> Tuple[bool, Optional[Dict]]:
+        """Authenticate user with phone number and PIN.
+
+        One atomic find_one_and_update compares the PIN and, in the same
+        statement, either resets the failure counter and stamps last_login
+        or counts the failure and locks at MAX_PIN_ATTEMPTS, so concurrent
+        attempts cannot race past the lock. Attempts on a locked account are
+        still counted. The returned user is the
+        post-image (authentication fields plus ``fields``); the login
+        succeeded exactly when it is unlocked with no failed attempts.
+        """
         try:
             normalized_phone = WalletManager.normalize_phone_number(phone_number)
-            user = users_collection.find_one({'phone_number': normalized_phone})
+            locked = {'$eq': ['$is_locked', True]}
+            user = users_collection.find_one_and_update(
+                {'phone_number': normalized_phone},
+                [
+                    {'$set': {'_pin_ok': {'$and': [
+                        {'$not': [locked]},
+                        {'$eq': ['$pin_hash', WalletManager.hash_pin(pin)]}
+                    ]}}},
+                    {'$set': {
+                        'failed_pin_attempts': {'$cond': [
+                            '$_pin_ok', 0, {'$add': [{'$ifNull': ['$failed_pin_attempts', 0]}, 1]}
+                        ]},
+                        'last_login': {'$cond': ['$_pin_ok', '$$NOW', '$last_login']}
+                    }},
+                    {'$set': {'is_locked': {'$or': [
+                        locked, {'$gte': ['$failed_pin_attempts', MAX_PIN_ATTEMPTS]}
+                    ]}}},
+                    {'$unset': '_pin_ok'}
+                ],
+                projection={**USER_AUTH_FIELDS, **(fields or {})},
+                return_document=ReturnDocument.AFTER
+            )
             
             if not user:
                 return False, None
             
-            if user.get('is_locked', False):
-                return False, user
+            user_lookups.forget(normalized_phone)
             
-            hashed_pin = WalletManager.hash_pin(pin)
-            
-            if user['pin_hash'] == hashed_pin:
-                # Reset failed attempts and update last login
-                users_collection.update_one(
-                    {'_id': user['_id']},
-                    {
-                        '$set': {'last_login': datetime.utcnow(), 'failed_pin_attempts': 0}
-                    }
-                )
+            if not user.get('is_locked') and user.get('failed_pin_attempts', 0) == 0:
                 return True, user
-            else:
-                # Increment failed attempts
-                failed_attempts = user.get('failed_pin_attempts', 0) + 1
-                update_data = {'failed_pin_attempts': failed_attempts}
-                
-                if failed_attempts >= 3:
-                    update_data['is_locked'] = True
-                    logger.warning(f"Account locked due to failed PIN attempts: {normalized_phone}")
-                
-                users_collection.update_one(
-                    {'_id': user['_id']},
-                    {'$set': update_data}
-                )
-                
-                return False, user
+            if user.get('is_locked'):
+                # A locked account must not be served from the outage cache either
+                DegradedService.forget(normalized_phone)
+            
+            # Failures keep counting while locked, so only the locking attempt
+            # lands exactly on the limit
+            if user.get('failed_pin_attempts') == MAX_PIN_ATTEMPTS:
+                logger.warning(f"Account locked due to failed PIN attempts: {normalized_phone}")
+            return False, user
                 
         except Exception as e:
             logger.error(f"Authentication failed: {e}")
             return False, None
     
     @staticmethod
-    def get_user_by_phone(phone_number: str) -> Optional[Dict]:
-        """Get user by phone number"""
+    def get_user_by_phone(phone_number: str, fields: Dict = None) -> Optional[Dict]:
+        """Get user by phone number (only ``fields``; None for the whole document)"""
         try:
             normalized_phone = WalletManager.normalize_phone_number(phone_number)
-            return users_collection.find_one({'phone_number': normalized_phone})
+            return user_lookups.do(
+                (normalized_phone, projection_key(fields)),
+                lambda: users_collection.find_one({'phone_number': normalized_phone}, fields),
+                USER_LOOKUP_TTL
+            )
         except Exception as e:
+            # An outage must not look like an unregistered number
+            if isinstance(e, ServiceUnavailable) or CircuitBreaker.is_outage(e):
+                raise
             logger.error(f"Failed to get user: {e}")
             return None
     
     @staticmethod
-    def update_balance(phone_number: str, amount: Decimal, transaction_type: str, 
-                      description: str, reference: str = None) -> Tuple[bool, str]:
-        """Update user balance and create transaction record"""
+    def user_exists(phone_number: str) -> bool:
+        """Whether a user is registered, without decoding the document"""
+        normalized_phone = WalletManager.normalize_phone_number(phone_number)
+        if not phone_filter.might_contain(normalized_phone):
+            return False
+        return user_lookups.do(
+            (normalized_phone, 'exists'),
+            lambda: raw_users_collection.find_one({'phone_number': normalized_phone}, {'_id': 1}) is not None,
+            USER_EXISTS_TTL
+        )
+    
+    @staticmethod
+    def get_balance(user: Dict) -> int:
+        """Spendable balance in minor units, including stripes for hot accounts"""
+        if StripedBalance.is_striped(user):
+            return StripedBalance.get_balance(user)
+        return user['balance']
+    
+    @staticmethod
+    def new_transaction_id() -> str:
+        """Generate a transaction ID"""
+        return f"TXN{datetime.utcnow().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(4)}"
+    
+    @staticmethod
+    def held_amount(user: Dict) -> int:
+        """Total reserved for journalled transfers not yet applied"""
+        return sum(hold['amount'] for hold in user.get('held_transfers') or [])
+    
+    @staticmethod
+    def within_daily_limit(normalized_phone: str, amount: int) -> bool:
+        """Whether a debit of ``amount`` keeps today's outflow within the daily limit"""
+        return WalletManager.daily_debit_total(normalized_phone) + amount <= DAILY_TRANSACTION_LIMIT
+    
+    @staticmethod
+    def daily_debit_total(normalized_phone: str) -> int:
+        """Completed debits since midnight UTC"""
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        daily_transactions = transactions_collection.aggregate([
+            {
+                '$match': {
+                    'user_phone': normalized_phone,
+                    'created_at': {'$gte': today},
+                    'type': {'$in': list(DEBIT_TRANSACTION_TYPES)},
+                    'status': 'completed'
+                }
+            },
+            {
+                '$group': {
+                    '_id': None,
+                    'total': {'$sum': '$amount'}
+                }
+            }
+        ])
+        
+        daily_total = 0
+        for result in daily_transactions:
+            daily_total = result['total']
+        
+        return daily_total
+    
+    @staticmethod
+    def _apply_delta(normalized_phone: str, delta: int, is_debit: bool,
+                     idempotency_key: str = None, summary: Dict = None) -> Optional[Dict]:
+        """$inc the user balance, refusing debits that would overdraw it and legacy double balances.
+
+        With an idempotency key the change is applied at most once per key.
+        A summary is appended to the user's recent activity in the same write.
+        """
+        balance_filter = {'phone_number': normalized_phone, 'balance': dict(MINOR_UNIT_BALANCE)}
+        update = {'$inc': {'balance': delta}}
+        push = {}
+        if is_debit and idempotency_key:
+            # A journalled transfer spends, and releases, its own hold
+            balance_filter['balance']['$gte'] = -delta
+            update['$pull'] = {'held_transfers': {'transfer_id': idempotency_key}}
+        elif is_debit:
+            # Amounts held for queued transfers are not spendable
+            balance_filter['$expr'] = {'$gte': [{'$subtract': ['$balance', HELD_TRANSFERS_TOTAL]}, -delta]}
+        if idempotency_key:
+            balance_filter['applied_txns'] = {'$ne': idempotency_key}
+            push['applied_txns'] = {'$each': [idempotency_key], '$slice': -APPLIED_TXN_MEMORY}
+        if summary:
+            push['recent_activity'] = {'$each': [summary], '$slice': -RECENT_ACTIVITY_SIZE}
+        if push:
+            update['$push'] = push
+        
+        return users_collection.find_one_and_update(
+            balance_filter,
+            update,
+            projection={'balance': 1},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    @staticmethod
+    def _upsert_transaction(transaction_data: Dict) -> None:
+        """Write a transaction record unless one with its ID already exists"""
+        transactions_collection.update_one(
+            {'transaction_id': transaction_data['transaction_id']},
+            {'$setOnInsert': transaction_data},
+            upsert=True
+        )
+    
+    @staticmethod
+    def _reverse_delta(normalized_phone: str, delta: int, transaction_id: str,
+                       balance_after: Optional[int]) -> None:
+        """Undo an applied balance change whose transaction record could not be written"""
+        try:
+            users_collection.update_one(
+                {'phone_number': normalized_phone, 'balance': MINOR_UNIT_BALANCE},
+                {'$inc': {'balance': -delta}, '$pull': {'recent_activity': {'transaction_id': transaction_id}}}
+            )
+            user_lookups.forget(normalized_phone)
+            if balance_after is not None:
+                DegradedService.update_balance(normalized_phone, balance_after - delta)
+            logger.warning(f"Reversed {transaction_id} for {normalized_phone}: its record could not be written")
+        except Exception as e:
+            logger.critical(f"Transaction {transaction_id} changed {normalized_phone}'s balance by {delta} "
+                            f"with no record and could not be reversed: {e}")
+    
+    @staticmethod
+    def update_balance(phone_number: str, amount: int, transaction_type: str, 
+                      description: str, reference: str = None,
+                      transaction_id: str = None, transfer_from: str = None) -> Tuple[bool, str]:
+        """Update user balance (amount in minor units) and create transaction record.
+
+        ``transfer_from`` marks the credit leg of a transfer from that account,
+        whose record then carries the transfer's ledger journal.
+
+        Passing ``transaction_id`` makes the call idempotent for journal
+        replays: the balance change and the record are applied at most once,
+        and the balance and daily-limit pre-checks are skipped because they
+        were done when the transfer was accepted.
+        """
         try:
+            idempotent = transaction_id is not None
             normalized_phone = WalletManager.normalize_phone_number(phone_number)
-            user = users_collection.find_one({'phone_number': normalized_phone})
+            user = users_collection.find_one({'phone_number': normalized_phone}, BALANCE_FIELDS)
             
             if not user:
                 return False, "User not found"
             
-            current_balance = Decimal(str(user['balance']))
+            if isinstance(user.get('balance'), float):
+                # Legacy major-unit balance: adding minor units to it would
+                # mix units, so refuse until migrate_money.py has run
+                logger.error(f"Refusing balance update for {normalized_phone}: balance is not migrated to minor units")
+                return False, "Account temporarily unavailable"
             
-            if transaction_type in ['withdraw', 'send'] and current_balance < amount:
-                return False, "Insufficient balance"
+            is_debit = transaction_type in DEBIT_TRANSACTION_TYPES
+            striped = StripedBalance.is_striped(user)
             
-            # Check daily transaction limit
-            today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-            daily_transactions = transactions_collection.aggregate([
-                {
-                    '$match': {
-                        'user_phone': normalized_phone,
-                        'created_at': {'$gte': today},
-                        'type': {'$in': ['withdraw', 'send']},
-                        'status': 'completed'
-                    }
-                },
-                {
-                    '$group': {
-                        '_id': None,
-                        'total': {'$sum': '$amount'}
-                    }
-                }
-            ])
+            if is_debit and not idempotent:
+                held = WalletManager.held_amount(user)
+                if WalletManager.get_balance(user) - held < amount:
+                    return False, "Insufficient balance"
+                
+                # Check daily transaction limit; queued transfers count toward it
+                if not WalletManager.within_daily_limit(normalized_phone, amount + held):
+                    return False, "Daily transaction limit exceeded"
             
-            daily_total = Decimal('0.00')
-            for result in daily_transactions:
-                daily_total = Decimal(str(result['total']))
+            # Generate transaction ID
+            transaction_id = transaction_id or WalletManager.new_transaction_id()
+            idempotency_key = transaction_id if idempotent else None
             
-            if transaction_type in ['withdraw', 'send'] and (daily_total + amount) > DAILY_TRANSACTION_LIMIT:
-                return False, "Daily transaction limit exceeded"
+            delta = -amount if is_debit else amount
+            balance_before = balance_after = None
+            created_at = datetime.utcnow()
+            summary = {
+                'transaction_id': transaction_id,
+                'type': transaction_type,
+                'amount': amount,
+                'created_at': created_at
+            }
             
-            # Calculate new balance
-            if transaction_type in ['deposit', 'receive']:
-                new_balance = current_balance + amount
+            if striped and not is_debit:
+                # Credits to hot accounts land on a stripe; the combined balance
+                # is not materialised so the before/after snapshot is omitted
+                StripedBalance.credit(user, amount, transaction_id, idempotent)
             else:
-                new_balance = current_balance - amount
-            
-            # Generate transaction ID
-            transaction_id = f"TXN{datetime.utcnow().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(4)}"
+                # Apply the change with $inc; debits are guarded so the balance
+                # can never go below zero between the check above and the write
+                updated = WalletManager._apply_delta(normalized_phone, delta, is_debit, idempotency_key, summary)
+                if not updated and striped:
+                    StripedBalance.compact(normalized_phone)
+                    updated = WalletManager._apply_delta(normalized_phone, delta, is_debit, idempotency_key, summary)
+                
+                if updated:
+                    balance_after = updated['balance']
+                    balance_before = balance_after - delta
+                    DegradedService.update_balance(normalized_phone, balance_after)
+                elif not (idempotent and users_collection.find_one(
+                        {'phone_number': normalized_phone, 'applied_txns': transaction_id}, {'_id': 1})):
+                    # Old code still running during a rollout can turn the balance back into a double
+                    if users_collection.find_one({'phone_number': normalized_phone, 'balance': {'$type': 'double'}},
+                                                 {'_id': 1}):
+                        return False, "Account temporarily unavailable"
+                    return False, "Insufficient balance"
             
             # Create transaction record
             transaction_data = {
                 'transaction_id': transaction_id,
                 'user_phone': normalized_phone,
                 'type': transaction_type,
-                'amount': float(amount),
+                'amount': amount,
                 'description': description,
                 'reference': reference,
-                'balance_before': float(current_balance),
-                'balance_after': float(new_balance),
+                'balance_before': balance_before,
+                'balance_after': balance_after,
                 'status': 'completed',
-                'created_at': datetime.utcnow()
+                'created_at': created_at
             }
             
-            # Update balance and create transaction atomically
-            users_collection.update_one(
-                {'phone_number': normalized_phone},
-                {'$set': {'balance': float(new_balance)}}
-            )
+            # Deposits and withdrawals move money against the cash account;
+            # a transfer is journalled once, with its credit leg
+            if transaction_type == 'deposit':
+                ledger = {'journal_id': transaction_id, 'from': SYSTEM_CASH_ACCOUNT, 'to': normalized_phone}
+            elif transaction_type == 'withdraw':
+                ledger = {'journal_id': transaction_id, 'from': normalized_phone, 'to': SYSTEM_CASH_ACCOUNT}
+            elif transfer_from:
+                ledger = {'journal_id': reference, 'from': transfer_from, 'to': normalized_phone}
+            else:
+                ledger = None
+            if ledger:
+                ledger['description'] = 'Transfer' if transfer_from else description
+                transaction_data['ledger'] = ledger
+            
+            if idempotent:
+                WalletManager._upsert_transaction(transaction_data)
+            else:
+                try:
+                    transaction_writer.insert(transaction_data)
+                except Exception as e:
+                    # The balance has already moved, so the record must not be
+                    # lost: write it directly (the batch may still land it too),
+                    # or undo the change before reporting failure
+                    logger.warning(f"Batched insert of {transaction_id} failed, writing it directly: {e}")
+                    try:
+                        WalletManager._upsert_transaction(transaction_data)
+                    except Exception:
+                        WalletManager._reverse_delta(normalized_phone, delta, transaction_id, balance_after)
+                        raise
             
-            transactions_collection.insert_one(transaction_data)
+            # The record holds the journal, so a failed post is retried by the repairer
+            if ledger and not LedgerManager.post_recorded(ledger, amount):
+                logger.warning(f"Ledger journal {ledger['journal_id']} left for the repairer")
             
+            user_lookups.forget(normalized_phone)
             logger.info(f"Transaction completed: {transaction_id} for {normalized_phone}")
             return True, transaction_id
             
@@ -373,47 +2087,53 @@ class WalletManager:
             return False, "Transaction failed"
     
     @staticmethod
-    def transfer_money(sender_phone: str, recipient_phone: str, amount: Decimal, 
+    def transfer_money(sender_phone: str, recipient_phone: str, amount: int, 
                       sender_pin: str) -> Tuple[bool, str]:
         """Transfer money between users"""
         try:
             # Authenticate sender
-            auth_success, sender_user = WalletManager.authenticate_user(sender_phone, sender_pin)
+            auth_success, sender_user = WalletManager.authenticate_user(sender_phone, sender_pin, BALANCE_FIELDS)
             if not auth_success:
                 return False, "Invalid PIN"
             
             # Check if recipient exists
-            recipient_user = WalletManager.get_user_by_phone(recipient_phone)
-            if not recipient_user:
+            if not WalletManager.user_exists(recipient_phone):
                 return False, "Recipient not found"
             
+            sender = WalletManager.normalize_phone_number(sender_phone)
+            recipient = WalletManager.normalize_phone_number(recipient_phone)
+            
+            if TransferJournal.enabled():
+                # Reserve the amount, make the intent durable, apply asynchronously
+                ref = WalletManager.new_transaction_id()
+                held, message = WalletManager._hold_transfer(sender, ref, amount)
+                if not held:
+                    return False, message
+                
+                # The intent is durable but not yet applied: the caller must
+                # report it as pending, since applying can still fail
+                TransferJournal.submit({
+                    'transfer_id': ref,
+                    'sender': sender,
+                    'recipient': recipient,
+                    'amount': amount,
+                    'created_at': datetime.utcnow().isoformat()
+                })
+                return True, ref
+            
             # Deduct from sender
             success, ref = WalletManager.update_balance(
-                sender_phone, amount, 'send',
-                f"Transfer to {WalletManager.normalize_phone_number(recipient_phone)}"
+                sender, amount, 'send', f"Transfer to {recipient}"
             )
             
             if not success:
                 return False, ref
             
-            # Add to recipient
-            WalletManager.update_balance(
-                recipient_phone, amount, 'receive',
-                f"Transfer from {WalletManager.normalize_phone_number(sender_phone)}",
-                ref
-            )
-            
-            # Send SMS notifications if available
-            if sms:
-                try:
-                    sender_msg = f"Transfer successful. Sent KSH {amount} to {recipient_phone}. Ref: {ref}"
-                    recipient_msg = f"Money received. KSH {amount} from {sender_phone}. Ref: {ref}"
-                    
-                    sms.send(sender_msg, [sender_phone])
-                    sms.send(recipient_msg, [recipient_phone])
-                except Exception as e:
-                    logger.error(f"SMS notification failed: {e}")
-            
+            settled, _ = WalletManager._settle_transfer(sender, recipient, amount, ref)
+            if not settled:
+                # Give the sender their money back rather than leave it debited
+                WalletManager._refund_transfer(sender, recipient, amount, ref)
+                return False, "Transfer failed"
             return True, ref
             
         except Exception as e:
@@ -421,21 +2141,364 @@ class WalletManager:
             return False, "Transfer failed"
     
     @staticmethod
-    def get_transaction_history(phone_number: str, limit: int = 10) -> list:
-        """Get user transaction history"""
+    def _hold_transfer(sender: str, ref: str, amount: int) -> Tuple[bool, str]:
+        """Reserve a queued transfer against the sender's balance and daily limit.
+
+        The hold sits on the user document until the debit applies (which
+        releases it in the same write) or the transfer fails, so concurrent
+        accepts and direct debits all see it.
+        """
+        daily_total = WalletManager.daily_debit_total(sender)
+        hold_filter = {'phone_number': sender, '$expr': {'$and': [
+            {'$gte': [{'$subtract': ['$balance', HELD_TRANSFERS_TOTAL]}, amount]},
+            {'$lte': [{'$add': [HELD_TRANSFERS_TOTAL, daily_total, amount]}, DAILY_TRANSACTION_LIMIT]}
+        ]}}
+        hold = {'$push': {'held_transfers': {'transfer_id': ref, 'amount': amount, 'created_at': datetime.utcnow()}}}
+        
+        for attempt in range(2):
+            if users_collection.find_one_and_update(hold_filter, hold, projection={'_id': 1}):
+                return True, ref
+            user = users_collection.find_one({'phone_number': sender}, BALANCE_FIELDS)
+            if not user:
+                return False, "User not found"
+            if WalletManager.held_amount(user) + daily_total + amount > DAILY_TRANSACTION_LIMIT:
+                return False, "Daily transaction limit exceeded"
+            if attempt or not StripedBalance.is_striped(user):
+                return False, "Insufficient balance"
+            # Credits parked on stripes only count once folded in
+            StripedBalance.compact(sender)
+        return False, "Insufficient balance"
+    
+    @staticmethod
+    def _release_hold(sender: str, ref: str) -> None:
+        users_collection.update_one({'phone_number': sender}, {'$pull': {'held_transfers': {'transfer_id': ref}}})
+    
+    @staticmethod
+    def _settle_transfer(sender: str, recipient: str, amount: int, ref: str,
+                         receive_id: str = None) -> Tuple[bool, str]:
+        """Credit the recipient of a debited transfer, journal it and notify both parties"""
+        # The credit record carries the one journal linking both legs
+        credited, message = WalletManager.update_balance(
+            recipient, amount, 'receive', f"Transfer from {sender}", ref, receive_id, transfer_from=sender
+        )
+        
+        if not credited:
+            logger.error(f"Transfer {ref} debited sender but failed to credit recipient: {message}")
+            return False, message
+        
+        # Send SMS notifications if available
+        if sms:
+            try:
+                sender_msg = f"Transfer successful. Sent KSH {Money.format(amount)} to {recipient}. Ref: {ref}"
+                recipient_msg = f"Money received. KSH {Money.format(amount)} from {sender}. Ref: {ref}"
+                
+                sms.send(sender_msg, [sender])
+                sms.send(recipient_msg, [recipient])
+            except Exception as e:
+                logger.error(f"SMS notification failed: {e}")
+        return True, ref
+    
+    @staticmethod
+    def _refund_transfer(sender: str, recipient: str, amount: int, ref: str) -> bool:
+        """Credit a debited sender back when the recipient leg cannot complete"""
+        refunded, _ = WalletManager.update_balance(
+            sender, amount, 'receive', f"Refund of failed transfer to {recipient}", ref, f"{ref}F"
+        )
+        if not refunded:
+            logger.error(f"Transfer {ref} debited {sender} and could not be refunded yet")
+        return refunded
+    
+    @staticmethod
+    def apply_transfer(intent: Dict) -> bool:
+        """Apply a journalled transfer intent; safe to call more than once.
+
+        Returns False on a transient failure so the caller can retry. A
+        recipient that can never be credited gets the sender refunded.
+        """
+        ref = intent['transfer_id']
+        sender, recipient, amount = intent['sender'], intent['recipient'], intent['amount']
+        
+        if intent.get('refunding'):
+            # A retry must not credit the recipient after the refund was decided
+            return WalletManager._refund_failed_transfer(intent)
+        
+        success, message = WalletManager.update_balance(
+            sender, amount, 'send', f"Transfer to {recipient}", transaction_id=ref
+        )
+        if not success:
+            if message not in PERMANENT_BALANCE_FAILURES:
+                return False
+            WalletManager._release_hold(sender, ref)            # The transfer was accepted but can no longer be honoured
+            transactions_collection.update_one(
+                {'transaction_id': ref},
+                {'$setOnInsert': {
+                    'transaction_id': ref,
+                    'user_phone': sender,
+                    'type': 'send',
+                    'amount': amount,
+                    'description': f"Transfer to {recipient}",
+                    'reference': None,
+                    'status': 'failed',
+                    'failure_reason': message,
+                    'created_at': datetime.utcnow()
+                }},
+                upsert=True
+            )
+            WalletManager._notify_failed_transfer(intent, message)
+            return True
+        
+        settled, message = WalletManager._settle_transfer(sender, recipient, amount, ref, f"{ref}R")
+        if settled or message not in PERMANENT_BALANCE_FAILURES:
+            return settled
+        intent['refunding'] = message
+        return WalletManager._refund_failed_transfer(intent)
+    
+    @staticmethod
+    def _refund_failed_transfer(intent: Dict) -> bool:
+        """Refund a journalled transfer whose recipient cannot be credited"""
+        if not WalletManager._refund_transfer(intent['sender'], intent['recipient'], intent['amount'],
+                                              intent['transfer_id']):
+            return False
+        WalletManager._notify_failed_transfer(intent, intent['refunding'])
+        return True
+    
+    @staticmethod
+    def _notify_failed_transfer(intent: Dict, reason: str) -> None:
+        logger.warning(f"Journalled transfer {intent['transfer_id']} failed: {reason}")
+        if sms:
+            try:
+                sms.send(f"Transfer of KSH {Money.format(intent['amount'])} to {intent['recipient']} failed: {reason}. "
+                         f"Ref: {intent['transfer_id']}", [intent['sender']])
+            except Exception as e:
+                logger.error(f"SMS notification failed: {e}")
+    
+    @staticmethod
+    def get_transaction_history(phone_number: str, limit: int = 10, since: datetime = None) -> list:
+        """Get user transaction history (``since``: when the user was created, if known)"""
         try:
             normalized_phone = WalletManager.normalize_phone_number(phone_number)
             transactions = list(
-                transactions_collection.find(
+                history_transactions_collection.find(
                     {'user_phone': normalized_phone},
                     {'_id': 0}
                 ).sort('created_at', DESCENDING).limit(limit)
             )
+            
+            # Reach into the archive only when the hot window runs out
+            if len(transactions) < limit:
+                before = transactions[-1]['created_at'] if transactions else None
+                transactions.extend(
+                    TransactionArchive.find_recent(normalized_phone, limit - len(transactions), before, since)
+                )
             return transactions
         except Exception as e:
             logger.error(f"Failed to get transaction history: {e}")
             return []
 
+    @staticmethod
+    def get_recent_activity(user: Dict) -> list:
+        """Latest transactions for the history menu, newest first.
+
+        Served from the summaries on the already-loaded user document. Striped
+        accounts (whose credits bypass the user document) and users created
+        before the summaries existed fall back to querying transactions; the
+        latter are backfilled so later hops skip the query.
+        """
+        if 'recent_activity' in user and not StripedBalance.is_striped(user):
+            return list(reversed(user['recent_activity']))
+        
+        transactions = WalletManager.get_transaction_history(
+            user['phone_number'], RECENT_ACTIVITY_SIZE, user.get('created_at')
+        )
+        if 'recent_activity' not in user and not StripedBalance.is_striped(user):
+            try:
+                summaries = [{
+                    'transaction_id': txn['transaction_id'],
+                    'type': txn['type'],
+                    'amount': txn['amount'],
+                    'created_at': txn['created_at']
+                } for txn in reversed(transactions) if txn.get('status', 'completed') == 'completed']
+                # Only seed a missing field so concurrent $pushes are never overwritten
+                users_collection.update_one(
+                    {'phone_number': user['phone_number'], 'recent_activity': {'$exists': False}},
+                    {'$set': {'recent_activity': summaries}}
+                )
+            except Exception as e:
+                logger.error(f"Failed to backfill recent activity: {e}")
+        return transactions
+
+class DegradedService:
+    """Read-only USSD answers while the MongoDB circuit is open.
+
+    Each process keeps the last balance, name and PIN hash it saw for
+    recent USSD users. During an outage a user can enter their PIN, which
+    is checked against the cached hash (with its own attempt limit), to see
+    that last known balance and when it was read. Striped accounts are not
+    cached because their user document does not hold the full balance, and
+    locked accounts are dropped from the cache, as they get no balance on
+    the normal path either.
+    """
+    
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+    
+    @staticmethod
+    def remember(user: Dict) -> None:
+        """Cache what a healthy hop read about the user"""
+        if not user:
+            return
+        if user.get('is_locked'):
+            DegradedService.forget(user['phone_number'])
+            return
+        if StripedBalance.is_striped(user) or 'pin_hash' not in user:
+            return
+        with DegradedService._lock:
+            DegradedService._cache[user['phone_number']] = {
+                'balance': user['balance'],
+                'name': user.get('name'),
+                'pin_hash': user['pin_hash'],
+                'as_of': datetime.utcnow(),
+                'failed_pin_attempts': user.get('failed_pin_attempts', 0)
+            }
+            DegradedService._cache.move_to_end(user['phone_number'])
+            while len(DegradedService._cache) > DEGRADED_CACHE_SIZE:
+                DegradedService._cache.popitem(last=False)
+    
+    @staticmethod
+    def forget(phone_number: str) -> None:
+        """Drop a user's cached answer (e.g. once the account is locked)"""
+        with DegradedService._lock:
+            DegradedService._cache.pop(phone_number, None)
+    
+    @staticmethod
+    def update_balance(phone_number: str, balance: int) -> None:
+        """Refresh a cached balance after a write"""
+        with DegradedService._lock:
+            entry = DegradedService._cache.get(phone_number)
+            if entry:
+                entry['balance'] = balance
+                entry['as_of'] = datetime.utcnow()
+    
+    @staticmethod
+    def cached(phone_number: str) -> Optional[Dict]:
+        return DegradedService._cache.get(phone_number)
+    
+    @staticmethod
+    def handle(phone_number: str, text: str) -> str:
+        """Answer a USSD hop without MongoDB"""
+        entry = DegradedService.cached(phone_number)
+        if not entry:
+            return SERVICE_UNAVAILABLE_RESPONSE
+        
+        if not text:
+            return "CON Service is limited right now.\nEnter PIN to see your last known balance:"
+        
+        pin = text.split('*')[-1]
+        if '*' in text or not WalletManager.validate_pin(pin):
+            return SERVICE_UNAVAILABLE_RESPONSE
+        
+        with DegradedService._lock:
+            if entry['failed_pin_attempts'] >= MAX_PIN_ATTEMPTS:
+                return SERVICE_UNAVAILABLE_RESPONSE
+            if not secrets.compare_digest(entry['pin_hash'], WalletManager.hash_pin(pin)):
+                entry['failed_pin_attempts'] += 1
+                return USSDMenus.error_menu("Invalid PIN")
+            entry['failed_pin_attempts'] = 0
+        
+        return (f"END Service is limited right now.\n"
+                f"Last known balance: KSH {Money.format(entry['balance'])}\n"
+                f"as of {entry['as_of'].strftime('%d/%m %H:%M')} UTC")
+
+class HistoryPager:
+    """Keyset-paged transaction history for the USSD menu.
+
+    Pages are ordered by ``(created_at, transaction_id)`` descending and the
+    session keeps the last row shown as the cursor, so every page is one
+    small query on the (user_phone, created_at, transaction_id) index,
+    falling back to the archive once the hot collection runs out. After a
+    page is shown the next one is fetched in the background; with session
+    affinity the following hop lands on the same process and picks it up.
+    """
+    
+    _executor = ThreadPoolExecutor(max_workers=HISTORY_PREFETCH_WORKERS, thread_name_prefix='history-prefetch')
+    _prefetched = OrderedDict()
+    _lock = threading.Lock()
+    
+    @staticmethod
+    def cursor_of(txn: Dict) -> Dict:
+        """Session cursor pointing just past a row"""
+        return {'created_at': txn['created_at'], 'transaction_id': txn['transaction_id']}
+    
+    @staticmethod
+    def fetch(phone_number: str, cursor: Optional[Dict], limit: int = HISTORY_FETCH_SIZE,
+              since: datetime = None) -> list:
+        """Up to ``limit`` transactions after the cursor (``since``: when the user was created)"""
+        query = {'user_phone': phone_number}
+        if cursor:
+            query['$or'] = [
+                {'created_at': {'$lt': cursor['created_at']}},
+                {'created_at': cursor['created_at'], 'transaction_id': {'$lt': cursor['transaction_id']}}
+            ]
+        transactions = list(
+            history_transactions_collection.find(
+                query,
+                {'_id': 0, 'transaction_id': 1, 'type': 1, 'amount': 1, 'status': 1, 'created_at': 1}
+            ).sort([('created_at', DESCENDING), ('transaction_id', DESCENDING)]).limit(limit)
+        )
+        
+        if len(transactions) < limit:
+            last = transactions[-1] if transactions else cursor
+            transactions.extend(TransactionArchive.find_recent(
+                phone_number, limit - len(transactions), last['created_at'] if last else None, since
+            ))
+        return transactions
+    
+    @staticmethod
+    def _key(phone_number: str, cursor: Dict) -> tuple:
+        return (phone_number, cursor['created_at'], cursor['transaction_id'])
+    
+    @staticmethod
+    def prefetch(phone_number: str, cursor: Dict, since: datetime = None) -> None:
+        """Start fetching the page after ``cursor``"""
+        future = HistoryPager._executor.submit(HistoryPager.fetch, phone_number, cursor, HISTORY_FETCH_SIZE + 1, since)
+        with HistoryPager._lock:
+            HistoryPager._prefetched[HistoryPager._key(phone_number, cursor)] = future
+            while len(HistoryPager._prefetched) > HISTORY_PREFETCH_CACHE_SIZE:
+                HistoryPager._prefetched.popitem(last=False)
+    
+    @staticmethod
+    def next_page(phone_number: str, cursor: Dict, since: datetime = None) -> list:
+        """The page after ``cursor`` (one row extra to tell whether more follow)"""
+        with HistoryPager._lock:
+            future = HistoryPager._prefetched.pop(HistoryPager._key(phone_number, cursor), None)
+        if future:
+            try:
+                return future.result(timeout=2)
+            except Exception as e:
+                logger.error(f"History prefetch failed: {e}")
+        return HistoryPager.fetch(phone_number, cursor, HISTORY_FETCH_SIZE + 1, since)
+    
+    @staticmethod
+    def show(session: Dict, session_data: Dict, phone_number: str, transactions: list,
+             more: bool, start: int = 1, since: datetime = None) -> str:
+        """Render a page, remember where it ended and prefetch the next one"""
+        if not transactions:
+            USSDSession.delete_session(session['session_id'])
+            return "END No transactions found" if start == 1 else "END No more transactions"
+        
+        response, shown = USSDMenus.transaction_history_menu(transactions, start, more)
+        more = more or shown < len(transactions)
+        if not more:
+            USSDSession.delete_session(session['session_id'])
+            return response
+        
+        cursor = HistoryPager.cursor_of(transactions[shown - 1])
+        session_data['history_cursor'] = cursor
+        session_data['history_shown'] = start - 1 + shown
+        USSDSession.update_session(session['session_id'], session_data, 'transaction_history')
+        HistoryPager.prefetch(phone_number, cursor, since)
+        return response
+
 class USSDMenus:
     """USSD menu responses and navigation"""
     
@@ -472,9 +2535,9 @@ class USSDMenus:
         return "CON Enter your 4-digit PIN:"
     
     @staticmethod
-    def balance_menu(balance: Decimal, name: str) -> str:
+    def balance_menu(balance: int, name: str) -> str:
         """Balance display"""
-        return f"END Hello {name}\nYour balance is KSH {balance:.2f}"
+        return f"END Hello {name}\nYour balance is KSH {Money.format(balance)}"
     
     @staticmethod
     def send_money_phone_menu() -> str:
@@ -487,9 +2550,9 @@ class USSDMenus:
         return "CON Enter amount to send (KSH):"
     
     @staticmethod
-    def send_money_pin_menu(phone: str, amount: Decimal) -> str:
+    def send_money_pin_menu(phone: str, amount: int) -> str:
         """Send money - PIN confirmation"""
-        return f"CON Send KSH {amount:.2f} to {phone}?\nEnter your PIN to confirm:"
+        return f"CON Send KSH {Money.format(amount)} to {phone}?\nEnter your PIN to confirm:"
     
     @staticmethod
     def deposit_amount_menu() -> str:
@@ -497,9 +2560,9 @@ class USSDMenus:
         return "CON Enter deposit amount (KSH):"
     
     @staticmethod
-    def deposit_confirm_menu(amount: Decimal) -> str:
+    def deposit_confirm_menu(amount: int) -> str:
         """Deposit confirmation"""
-        return f"CON Deposit KSH {amount:.2f}?\nEnter your PIN to confirm:"
+        return f"CON Deposit KSH {Money.format(amount)}?\nEnter your PIN to confirm:"
     
     @staticmethod
     def change_pin_current_menu() -> str:
@@ -517,29 +2580,44 @@ class USSDMenus:
         return "CON Confirm your new PIN:"
     
     @staticmethod
-    def account_info_menu(user: Dict) -> str:
+    def account_info_menu(user: Dict, balance: int) -> str:
         """Account information"""
         created_date = user['created_at'].strftime('%Y-%m-%d')
         return (f"END Account Information\n"
                 f"Name: {user['name']}\n"
                 f"Phone: {user['phone_number']}\n"
-                f"Balance: KSH {user['balance']:.2f}\n"
+                f"Balance: KSH {Money.format(balance)}\n"
                 f"Joined: {created_date}")
     
     @staticmethod
-    def transaction_history_menu(transactions: list) -> str:
-        """Transaction history"""
-        if not transactions:
-            return "END No transactions found"
-        
-        response = "END Recent Transactions:\n"
-        for i, txn in enumerate(transactions[:5], 1):
+    def transaction_history_menu(transactions: list, start: int = 1, more: bool = False) -> Tuple[str, int]:
+        """Transaction history page cut to one USSD screen; returns (response, rows shown)"""
+        header = "Recent Transactions:\n"
+        footer = f"{HISTORY_NEXT_OPTION}. More\n0. Back"
+        # Leave room for the navigation footer in case rows remain
+        budget = USSD_MAX_CHARS - len("CON " + header) - len(footer)
+        lines = []
+        for i, txn in enumerate(transactions, start):
             date = txn['created_at'].strftime('%m/%d')
             amount = txn['amount']
             txn_type = txn['type'].capitalize()
-            response += f"{i}. {date} {txn_type} KSH {amount:.2f}\n"
-        
-        return response
+            line = f"{i}. {date} {txn_type} KSH {Money.format(amount)}\n"
+            if lines and len(''.join(lines)) + len(line) > budget:
+                more = True
+                break
+            lines.append(line)
+        
+        if more or len(lines) < len(transactions):
+            return "CON " + header + ''.join(lines) + footer, len(lines)
+        return "END " + header + ''.join(lines), len(lines)
+    
+    @staticmethod
+    def invalid_amount_menu() -> str:
+        """Invalid amount with the allowed range"""
+        return USSDMenus.error_menu(
+            f"Invalid amount. Min: {Money.format(MIN_TRANSACTION_AMOUNT)}, "
+            f"Max: {Money.format(MAX_TRANSACTION_AMOUNT)}"
+        )
     
     @staticmethod
     def error_menu(message: str) -> str:
@@ -584,8 +2662,19 @@ def ussd_callback():
         # Normalize phone number
         normalized_phone = WalletManager.normalize_phone_number(phone_number)
         
-        # Check if user exists
-        user = WalletManager.get_user_by_phone(normalized_phone)
+        # Fail fast while MongoDB is unreachable
+        if mongo_breaker.is_open:
+            return DegradedService.handle(normalized_phone, text)
+        
+        # Check if user exists; the hop reads only the fields the flows use,
+        # and numbers the Bloom filter rules out skip the query entirely
+        user = None
+        if phone_filter.might_contain(normalized_phone):
+            user = WalletManager.get_user_by_phone(normalized_phone, USER_HOP_FIELDS)
+        DegradedService.remember(user)
+        
+        if USSD_STATELESS_MODE:
+            return StatelessSessions.handle(session_id, normalized_phone, text, user)
         
         # Handle empty text (first request)
         if not text:
@@ -607,24 +2696,33 @@ def ussd_callback():
         input_parts = text.split('*')
         current_input = input_parts[-1] if input_parts else ''
         
-        # Handle registration flow
-        if session.get('data', {}).get('step') == 'registration':
-            return handle_registration_flow(session, current_input, input_parts, normalized_phone)
-        
-        # Handle authenticated user flow
-        if user and not session.get('data', {}).get('authenticated'):
-            return handle_authentication_flow(session, current_input, normalized_phone, user)
-        
-        # Handle main menu navigation
-        if session.get('data', {}).get('authenticated'):
-            return handle_main_menu_flow(session, current_input, input_parts, normalized_phone, user)
-        
-        return USSDMenus.error_menu("Invalid session state")
+        return dispatch_session_input(session, current_input, input_parts, normalized_phone, user)
         
+    except (ServiceUnavailable, ConnectionFailure, ExecutionTimeout):
+        return SERVICE_UNAVAILABLE_RESPONSE
     except Exception as e:
         logger.error(f"USSD callback error: {e}")
         return USSDMenus.error_menu("Service temporarily unavailable")
 
+def dispatch_session_input(session: Dict, current_input: str, input_parts: list, phone_number: str,
+                           user: Optional[Dict]) -> str:
+    """Route one input to the flow handler for the session's current state"""
+    session_data = session.get('data', {})
+    
+    # Handle registration flow
+    if session_data.get('step') in REGISTRATION_STEPS:
+        return handle_registration_flow(session, current_input, input_parts, phone_number)
+    
+    # Handle authenticated user flow
+    if user and not session_data.get('authenticated'):
+        return handle_authentication_flow(session, current_input, phone_number, user)
+    
+    # Handle main menu navigation
+    if session_data.get('authenticated'):
+        return handle_main_menu_flow(session, current_input, input_parts, phone_number, user)
+    
+    return USSDMenus.error_menu("Invalid session state")
+
 def handle_registration_flow(session: Dict, current_input: str, input_parts: list, phone_number: str) -> str:
     """Handle user registration flow"""
     try:
@@ -696,12 +2794,13 @@ def handle_authentication_flow(session: Dict, current_input: str, phone_number:
             return USSDMenus.main_menu()
         else:
             USSDSession.delete_session(session['session_id'])
-            failed_attempts = user.get('failed_pin_attempts', 0) + 1
+            # The post-image already counts this attempt
+            failed_attempts = (auth_user or user).get('failed_pin_attempts', 0)
             
-            if failed_attempts >= 3:
+            if (auth_user or user).get('is_locked') or failed_attempts >= MAX_PIN_ATTEMPTS:
                 return USSDMenus.error_menu("Account locked due to multiple failed attempts")
             else:
-                return USSDMenus.error_menu(f"Invalid PIN. {3 - failed_attempts} attempts remaining")
+                return USSDMenus.error_menu(f"Invalid PIN. {MAX_PIN_ATTEMPTS - failed_attempts} attempts remaining")
     
     except Exception as e:
         logger.error(f"Authentication error: {e}")
@@ -717,8 +2816,7 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
         if current_step == 'main_menu':
             if current_input == '1':
                 # Check Balance
-                balance = Decimal(str(user['balance']))
-                return USSDMenus.balance_menu(balance, user['name'])
+                return USSDMenus.balance_menu(WalletManager.get_balance(user), user['name'])
             
             elif current_input == '2':
                 # Send Money
@@ -733,9 +2831,17 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
                 return USSDMenus.deposit_amount_menu()
             
             elif current_input == '4':
-                # Transaction History
-                transactions = WalletManager.get_transaction_history(phone_number)
-                return USSDMenus.transaction_history_menu(transactions)
+                # Transaction History: the first page comes from the user
+                # document; only a full one needs a one-row probe for older rows
+                transactions = sorted(
+                    WalletManager.get_recent_activity(user),
+                    key=lambda txn: (txn['created_at'], txn['transaction_id']), reverse=True
+                )
+                more = len(transactions) >= RECENT_ACTIVITY_SIZE and bool(HistoryPager.fetch(
+                    phone_number, HistoryPager.cursor_of(transactions[-1]), 1, user.get('created_at')
+                ))
+                return HistoryPager.show(session, session_data, phone_number, transactions, more,
+                                         since=user.get('created_at'))
             
             elif current_input == '5':
                 # Change PIN
@@ -745,7 +2851,7 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
             
             elif current_input == '6':
                 # My Account
-                return USSDMenus.account_info_menu(user)
+                return USSDMenus.account_info_menu(user, WalletManager.get_balance(user))
             
             elif current_input == '0':
                 # Exit
@@ -755,6 +2861,24 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
             else:
                 return USSDMenus.error_menu("Invalid option. Please try again.")
         
+        # Transaction History paging
+        elif current_step == 'transaction_history':
+            if current_input == HISTORY_NEXT_OPTION and session_data.get('history_cursor'):
+                transactions = HistoryPager.next_page(phone_number, session_data['history_cursor'],
+                                                      user.get('created_at'))
+                more = len(transactions) > HISTORY_FETCH_SIZE
+                return HistoryPager.show(session, session_data, phone_number, transactions[:HISTORY_FETCH_SIZE],
+                                         more, session_data.get('history_shown', 0) + 1, user.get('created_at'))
+            
+            elif current_input == '0':
+                session_data.pop('history_cursor', None)
+                session_data.pop('history_shown', None)
+                USSDSession.update_session(session['session_id'], session_data, 'main_menu')
+                return USSDMenus.main_menu()
+            
+            else:
+                return USSDMenus.error_menu("Invalid option. Please try again.")
+        
         # Send Money Flow
         elif current_step == 'send_money_phone':
             if not WalletManager.validate_phone_number(current_input):
@@ -765,8 +2889,7 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
             if recipient_phone == phone_number:
                 return USSDMenus.error_menu("Cannot send money to yourself")
             
-            recipient = WalletManager.get_user_by_phone(recipient_phone)
-            if not recipient:
+            if not WalletManager.user_exists(recipient_phone):
                 return USSDMenus.error_menu("Recipient not registered")
             
             session_data['recipient_phone'] = recipient_phone
@@ -776,15 +2899,15 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
         elif current_step == 'send_money_amount':
             valid, amount = WalletManager.validate_amount(current_input)
             if not valid:
-                return USSDMenus.error_menu(f"Invalid amount. Min: {MIN_TRANSACTION_AMOUNT}, Max: {MAX_TRANSACTION_AMOUNT}")
+                return USSDMenus.invalid_amount_menu()
             
-            session_data['amount'] = str(amount)
+            session_data['amount'] = amount
             USSDSession.update_session(session['session_id'], session_data, 'send_money_pin')
             return USSDMenus.send_money_pin_menu(session_data['recipient_phone'], amount)
         
         elif current_step == 'send_money_pin':
             recipient_phone = session_data['recipient_phone']
-            amount = Decimal(session_data['amount'])
+            amount = session_data['amount']
             
             success, reference = WalletManager.transfer_money(
                 phone_number, recipient_phone, amount, current_input
@@ -792,8 +2915,12 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
             
             USSDSession.delete_session(session['session_id'])
             
-            if success:
-                return USSDMenus.success_menu(f"Transfer successful!\nSent KSH {amount:.2f} to {recipient_phone}\nReference: {reference}")
+            if success and TransferJournal.enabled():
+                # Only queued; the SMS reports whether it went through
+                return USSDMenus.success_menu(f"Transfer accepted!\nSending KSH {Money.format(amount)} to {recipient_phone}. "
+                                              f"You will get an SMS when it completes.\nReference: {reference}")
+            elif success:
+                return USSDMenus.success_menu(f"Transfer successful!\nSent KSH {Money.format(amount)} to {recipient_phone}\nReference: {reference}")
             else:
                 return USSDMenus.error_menu(f"Transfer failed: {reference}")
         
@@ -801,9 +2928,9 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
         elif current_step == 'deposit_amount':
             valid, amount = WalletManager.validate_amount(current_input)
             if not valid:
-                return USSDMenus.error_menu(f"Invalid amount. Min: {MIN_TRANSACTION_AMOUNT}, Max: {MAX_TRANSACTION_AMOUNT}")
+                return USSDMenus.invalid_amount_menu()
             
-            session_data['amount'] = str(amount)
+            session_data['amount'] = amount
             USSDSession.update_session(session['session_id'], session_data, 'deposit_confirm')
             return USSDMenus.deposit_confirm_menu(amount)
         
@@ -815,7 +2942,7 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
                 USSDSession.delete_session(session['session_id'])
                 return USSDMenus.error_menu("Invalid PIN")
             
-            amount = Decimal(session_data['amount'])
+            amount = session_data['amount']
             success, reference = WalletManager.update_balance(
                 phone_number, amount, 'deposit', 'Mobile money deposit'
             )
@@ -823,8 +2950,8 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
             USSDSession.delete_session(session['session_id'])
             
             if success:
-                new_balance = Decimal(str(user['balance'])) + amount
-                return USSDMenus.success_menu(f"Deposit successful!\nKSH {amount:.2f} deposited\nNew balance: KSH {new_balance:.2f}\nReference: {reference}")
+                new_balance = WalletManager.get_balance(user) + amount
+                return USSDMenus.success_menu(f"Deposit successful!\nKSH {Money.format(amount)} deposited\nNew balance: KSH {Money.format(new_balance)}\nReference: {reference}")
             else:
                 return USSDMenus.error_menu(f"Deposit failed: {reference}")
         
@@ -862,6 +2989,7 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
                     {'phone_number': phone_number},
                     {'$set': {'pin_hash': new_pin_hash, 'failed_pin_attempts': 0, 'is_locked': False}}
                 )
+                user_lookups.forget(phone_number)
                 
                 USSDSession.delete_session(session['session_id'])
                 return USSDMenus.success_menu("PIN changed successfully!")
@@ -882,8 +3010,17 @@ def handle_main_menu_flow(session: Dict, current_input: str, input_parts: list,
 def health_check():
     """Health check endpoint"""
     try:
+        if mongo_breaker.is_open:
+            return jsonify({
+                'status': 'unhealthy',
+                'timestamp': datetime.utcnow().isoformat(),
+                'database': 'circuit_open',
+                'circuit_opened_at': mongo_breaker.opened_at.isoformat()
+            }), 503
+        
         # Test database connection
-        db.command('ping')
+        with pymongo.timeout(MONGO_OP_DEADLINE_MS / 1000):
+            db.command('ping')
         return jsonify({
             'status': 'healthy',
             'timestamp': datetime.utcnow().isoformat(),
@@ -907,20 +3044,26 @@ def get_stats():
             return jsonify({'error': 'Unauthorized'}), 401
         
         # Get statistics
-        total_users = users_collection.count_documents({'is_active': True})
-        total_transactions = transactions_collection.count_documents({'status': 'completed'})
+        total_users = stats_users_collection.count_documents({'is_active': True})
+        total_transactions = stats_transactions_collection.count_documents({'status': 'completed'})
         
         # Get total balance
         pipeline = [
             {'$match': {'is_active': True}},
             {'$group': {'_id': None, 'total_balance': {'$sum': '$balance'}}}
         ]
-        balance_result = list(users_collection.aggregate(pipeline))
+        balance_result = list(stats_users_collection.aggregate(pipeline))
         total_balance = balance_result[0]['total_balance'] if balance_result else 0
         
+        # Add credits still held on hot-account stripes
+        stripe_result = list(stats_balance_stripes_collection.aggregate([
+            {'$group': {'_id': None, 'total': {'$sum': {'$add': ['$balance', {'$ifNull': ['$pending', 0]}]}}}}
+        ]))
+        total_balance += stripe_result[0]['total'] if stripe_result else 0
+        
         # Get today's transactions
         today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_transactions = transactions_collection.count_documents({
+        today_transactions = stats_transactions_collection.count_documents({
             'created_at': {'$gte': today},
             'status': 'completed'
         })
@@ -933,15 +3076,15 @@ def get_stats():
             }},
             {'$group': {'_id': None, 'volume': {'$sum': '$amount'}}}
         ]
-        volume_result = list(transactions_collection.aggregate(volume_pipeline))
+        volume_result = list(stats_transactions_collection.aggregate(volume_pipeline))
         today_volume = volume_result[0]['volume'] if volume_result else 0
         
         return jsonify({
             'total_users': total_users,
             'total_transactions': total_transactions,
-            'total_balance': float(total_balance),
+            'total_balance': float(Money.to_major(total_balance)),
             'today_transactions': today_transactions,
-            'today_volume': float(today_volume),
+            'today_volume': float(Money.to_major(today_volume)),
             'timestamp': datetime.utcnow().isoformat()
         })
         
@@ -974,21 +3117,68 @@ def get_user_balance_api(phone_number: str):
         if api_key != os.environ.get('API_KEY', 'your_api_key_here'):
             return jsonify({'error': 'Unauthorized'}), 401
         
-        user = WalletManager.get_user_by_phone(phone_number)
+        user = WalletManager.get_user_by_phone(phone_number, USER_PROFILE_FIELDS)
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
+        # Optional point-in-time balance rebuilt from the ledger
+        as_of = request.args.get('as_of')
+        if as_of:
+            try:
+                as_of_time = datetime.fromisoformat(as_of)
+            except ValueError:
+                return jsonify({'error': 'Invalid as_of timestamp'}), 400
+            balance = LedgerManager.get_balance(user['phone_number'], as_of_time)
+            return jsonify({
+                'phone_number': user['phone_number'],
+                'balance': float(Money.to_major(balance)),
+                'as_of': as_of_time.isoformat()
+            })
+        
         return jsonify({
             'phone_number': user['phone_number'],
-            'balance': float(user['balance']),
+            'balance': float(Money.to_major(WalletManager.get_balance(user))),
             'name': user['name'],
             'is_active': user['is_active']
         })
         
+    except (ServiceUnavailable, ConnectionFailure, ExecutionTimeout):
+        # Degraded: last balance this process saw, clearly marked as stale
+        cached = DegradedService.cached(WalletManager.normalize_phone_number(phone_number))
+        body = {'error': 'Service temporarily unavailable'}
+        if cached:
+            body.update({
+                'cached_balance': float(Money.to_major(cached['balance'])),
+                'cached_as_of': cached['as_of'].isoformat()
+            })
+        return jsonify(body), 503
     except Exception as e:
         logger.error(f"Balance API error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/user/<phone_number>/striping', methods=['POST'])
+def enable_striping_api(phone_number: str):
+    """Admin endpoint to flag a hot payee account for balance striping"""
+    try:
+        api_key = request.headers.get('X-API-Key')
+        if api_key != os.environ.get('ADMIN_API_KEY', 'admin_key_123'):
+            return jsonify({'error': 'Unauthorized'}), 401
+        
+        data = request.get_json(silent=True) or {}
+        stripe_count = int(data.get('stripe_count', BALANCE_STRIPE_COUNT))
+        if not 1 < stripe_count <= 64:
+            return jsonify({'error': 'stripe_count must be between 2 and 64'}), 400
+        
+        normalized_phone = WalletManager.normalize_phone_number(phone_number)
+        if not StripedBalance.enable(normalized_phone, stripe_count):
+            return jsonify({'error': 'User not found'}), 404
+        
+        return jsonify({'phone_number': normalized_phone, 'striped': True, 'stripe_count': stripe_count})
+        
+    except Exception as e:
+        logger.error(f"Striping API error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/api/transaction', methods=['POST'])
 def create_transaction_api():
     """API endpoint to create transactions - for integration purposes"""
@@ -1017,8 +3207,7 @@ def create_transaction_api():
         if not valid:
             return jsonify({'error': 'Invalid amount'}), 400
         
-        user = WalletManager.get_user_by_phone(phone_number)
-        if not user:
+        if not WalletManager.user_exists(phone_number):
             return jsonify({'error': 'User not found'}), 404
         
         # Process transaction
@@ -1051,16 +3240,19 @@ def get_user_transactions_api(phone_number: str):
         limit = int(request.args.get('limit', 20))
         limit = min(limit, 100)  # Cap at 100 transactions
         
-        user = WalletManager.get_user_by_phone(phone_number)
+        user = WalletManager.get_user_by_phone(phone_number, {'created_at': 1})
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        transactions = WalletManager.get_transaction_history(phone_number, limit)
+        transactions = WalletManager.get_transaction_history(phone_number, limit, user.get('created_at'))
         
-        # Convert datetime objects to ISO format
+        # Convert datetime objects to ISO format and minor units to major units
         for txn in transactions:
             if 'created_at' in txn:
                 txn['created_at'] = txn['created_at'].isoformat()
+            for field in ('amount', 'balance_before', 'balance_after'):
+                if txn.get(field) is not None:
+                    txn[field] = float(Money.to_major(txn[field]))
         
         return jsonify({
             'phone_number': phone_number,
@@ -1089,6 +3281,36 @@ def handle_exception(error):
     logger.error(f"Unhandled exception: {error}")
     return jsonify({'error': 'Service temporarily unavailable'}), 500
 
+def partition_id_ranges(collection, partitions: int) -> list:
+    """Split a collection into roughly equal ``_id`` ranges.
+
+    Returns a list of ``(lower, upper)`` bounds where lower is inclusive and
+    upper is exclusive; ``None`` means unbounded. Used by batch jobs that scan
+    a collection with parallel cursors.
+    """
+    buckets = list(collection.aggregate([
+        {'$project': {'_id': 1}},
+        {'$bucketAuto': {'groupBy': '$_id', 'buckets': max(1, partitions)}}
+    ], allowDiskUse=True))
+    
+    if not buckets:
+        return []
+    
+    # Bucket boundaries are shared: each bucket's max is the next bucket's min
+    bounds = [bucket['_id']['min'] for bucket in buckets[1:]]
+    lowers = [None] + bounds
+    uppers = bounds + [None]
+    return list(zip(lowers, uppers))
+
+def id_range_filter(lower, upper) -> Dict:
+    """Query filter for a partition returned by partition_id_ranges"""
+    id_filter = {}
+    if lower is not None:
+        id_filter['$gte'] = lower
+    if upper is not None:
+        id_filter['$lt'] = upper
+    return {'_id': id_filter} if id_filter else {}
+
 # Cleanup function to remove expired sessions
 def cleanup_expired_sessions():
     """Remove expired sessions from database"""
@@ -1096,11 +3318,113 @@ def cleanup_expired_sessions():
         result = sessions_collection.delete_many({
             'expires_at': {'$lt': datetime.utcnow()}
         })
-        if result.deleted_count > 0:
+        if result.acknowledged and result.deleted_count > 0:
             logger.info(f"Cleaned up {result.deleted_count} expired sessions")
     except Exception as e:
         logger.error(f"Session cleanup error: {e}")
 
+class WarmUp:
+    """Boot-time warm-up, so a worker is fast from its first real request.
+
+    Opens MONGO_MIN_POOL_SIZE connections, reads the leading entries of the
+    hot indexes with covered scans so MongoDB has them cached, and sends a
+    synthetic USSD session through the app so the request path has run
+    once. Only opening connections runs while the worker boots; the other
+    steps, and retries of any that fail, run on a background thread every
+    WARMUP_RETRY_INTERVAL seconds until all have succeeded. /ready is
+    computed live from the steps still pending, the registered-number
+    filter and the MongoDB circuit; /health stays a liveness check.
+    """
+    
+    STEPS = ('connections', 'indexes', 'ussd_session')
+    pending = set(STEPS)
+    errors = {}
+    seconds = None
+    
+    @staticmethod
+    def open_connections() -> None:
+        """Check out MONGO_MIN_POOL_SIZE connections at once so each is opened"""
+        count = max(MONGO_MIN_POOL_SIZE, 1)
+        with ThreadPoolExecutor(max_workers=count, thread_name_prefix='warm-up') as pool:
+            list(pool.map(lambda _: client.admin.command('ping'), range(count)))
+    
+    @staticmethod
+    def touch_indexes() -> None:
+        """Read the hot indexes without fetching any documents"""
+        for collection, keys in (
+            (users_collection, [('phone_number', 1)]),
+            (sessions_collection, [('session_id', 1)]),
+            (transactions_collection, [('transaction_id', 1)]),
+            (transactions_collection, [('user_phone', 1), ('created_at', -1), ('transaction_id', -1)])
+        ):
+            fields = {'_id': 0, **{key: 1 for key, _ in keys}}
+            cursor = collection.find({}, fields).hint(keys).limit(WARMUP_INDEX_SCAN_LIMIT).batch_size(10000)
+            for _ in cursor:
+                pass
+    
+    @staticmethod
+    def synthetic_session() -> None:
+        """Run the first hops of a USSD session, stopping before any PIN is entered"""
+        session_id = f"warm-up-{os.getpid()}"
+        form = {'sessionId': session_id, 'serviceCode': '*384#', 'phoneNumber': WARMUP_PHONE_NUMBER}
+        try:
+            with app.test_client() as test_client:
+                response = test_client.post('/ussd', data={**form, 'text': ''}).get_data(as_text=True)
+                if response == USSDMenus.registration_menu():
+                    test_client.post('/ussd', data={**form, 'text': 'Warm up'})
+        finally:
+            USSDSession.delete_session(session_id)
+    
+    @staticmethod
+    def _run_step(name: str) -> bool:
+        step = {'connections': WarmUp.open_connections, 'indexes': WarmUp.touch_indexes,
+                'ussd_session': WarmUp.synthetic_session}[name]
+        try:
+            step()
+        except Exception as e:
+            logger.error(f"Warm-up step {name} failed: {e}")
+            WarmUp.errors[name] = str(e)
+            return False
+        WarmUp.errors.pop(name, None)
+        WarmUp.pending.discard(name)
+        return True
+    
+    @staticmethod
+    def run() -> None:
+        """Open connections now; warm the rest, retrying failures, in the background"""
+        if not WARMUP_ENABLED:
+            WarmUp.pending.clear()
+            return
+        started = time.monotonic()
+        WarmUp._run_step('connections')
+        
+        def background():
+            while True:
+                for name in WarmUp.STEPS:
+                    if name in WarmUp.pending and not WarmUp._run_step(name) and name == 'connections':
+                        # Everything else needs MongoDB
+                        break
+                if not WarmUp.pending:
+                    break
+                threading.Event().wait(WARMUP_RETRY_INTERVAL)
+            WarmUp.seconds = round(time.monotonic() - started, 3)
+            logger.info(f"Warm-up finished in {WarmUp.seconds}s")
+        
+        threading.Thread(target=background, name='warm-up', daemon=True).start()
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness endpoint: warmed up, registered-number filter built and MongoDB reachable"""
+    pending = sorted(WarmUp.pending)
+    ready = not pending and phone_filter.ready and not mongo_breaker.is_open
+    return jsonify({
+        'status': 'ready' if ready else 'not_ready',
+        'timestamp': datetime.utcnow().isoformat(),
+        'warm_up': {'pending_steps': pending, 'errors': dict(WarmUp.errors), 'seconds': WarmUp.seconds},
+        'phone_filter': 'ready' if phone_filter.ready else 'building',
+        'database': 'circuit_open' if mongo_breaker.is_open else 'available'
+    }), 200 if ready else 503
+
 # Initialize database constraints and cleanup
 def initialize_app():
     """Initialize application with database constraints"""
@@ -1108,20 +3432,44 @@ def initialize_app():
         # Ensure database constraints
         users_collection.create_index("phone_number", unique=True)
         transactions_collection.create_index("transaction_id", unique=True)
-        sessions_collection.create_index("session_id", unique=True)
+        db.sessions.create_index("session_id", unique=True)
+        ledger_entries_collection.create_index([("journal_id", 1), ("account", 1), ("side", 1)], unique=True)
+        balance_checkpoints_collection.create_index([("account", 1), ("as_of", -1)], unique=True)
         
         # Set up TTL index for sessions
-        sessions_collection.create_index("expires_at", expireAfterSeconds=0)
+        db.sessions.create_index("expires_at", expireAfterSeconds=0)
         
         # Clean up any existing expired sessions
         cleanup_expired_sessions()
         
+        # Fold hot-account stripes back into their user documents periodically
+        StripedBalance.start_compactor()
+        
+        # Post ledger journals whose first attempt failed
+        LedgerManager.start_repairer()
+        
+        # Open the transfer journal and replay anything not yet applied
+        TransferJournal.start()
+        
+        # Load registered numbers so first hops and recipient checks can skip misses
+        phone_filter.start()
+        
+        # Open connections, warm caches and exercise the request path
+        WarmUp.run()
+        
         logger.info("Application initialized successfully")
         
     except Exception as e:
         logger.error(f"Application initialization failed: {e}")
         raise
 
+# Multi-node deployments: forward each USSD hop to the node owning its session
+if os.environ.get('CLUSTER_NODES'):
+    from router import SessionAffinityMiddleware
+    app.wsgi_app = SessionAffinityMiddleware.from_env(app.wsgi_app)
+
+# Development server; production runs under gunicorn with gunicorn_conf.py,
+# which calls initialize_app in each worker
 if __name__ == '__main__':
     # Initialize the application
     initialize_app()
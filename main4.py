@@ -1,10 +1,12 @@
-import random
 import os
 import re
 import datetime
 import secrets
+import threading
 from dotenv import load_dotenv
 from flask import Flask, render_template, request, redirect
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 
@@ -16,21 +18,71 @@ app = Flask(__name__)
 app.config["MONGO_URI"] = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
 uri = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
 
-# Create a new client and connect to the server
-client = MongoClient(uri, server_api=ServerApi('1'))
+if os.environ.get('PYWALLET_STORAGE') == 'memory':
+    # In-process collections for scripted replays (see replay.py)
+    from memory_store import MemoryDatabase
+    db = MemoryDatabase()
+else:
+    # Create a new client and connect to the server
+    client = MongoClient(uri, server_api=ServerApi('1'))
 
-db = client["USSD_Wallet"]  # Database name
+    db = client["USSD_Wallet"]  # Database name
 
 # Access collections
 users_db = db["users_db"]  # 'users_db' collection
 transactions_db = db["transactions_db"]  # 'transactions_db' collection
+counters_db = db["counters_db"]  # atomic sequence counters
+
+# Transactions are stored in fixed-size buckets per account instead of one
+# ever-growing array; the last few are also kept on the user document
+TXN_BUCKET_SIZE = 50
+RECENT_TXN_COUNT = 5
+
+transactions_db.create_index([("acct_num", 1), ("count", 1)])
+transactions_db.create_index([("acct_num", 1), ("end", -1)])
+
+# Account numbers are a 9-digit sequence plus a Luhn check digit. Each process
+# reserves a block of sequence values from an atomic counter and hands them
+# out locally, so allocation never has to probe the collection.
+ACCT_SEQ_START = 10**8
+ACCT_BLOCK_SIZE = 100
+
+users_db.create_index("acct_num", unique=True)
+
+_acct_block_lock = threading.Lock()
+_acct_block = {"next": 0, "end": 0}
+
+def luhn_check_digit(digits):
+    total = 0
+    # Double every second digit from the right, starting with the rightmost
+    for i, d in enumerate(reversed(digits)):
+        n = int(d)
+        if i % 2 == 0:
+            n *= 2
+            if n > 9:
+                n -= 9
+        total += n
+    return str((10 - total % 10) % 10)
+
+def reserve_account_block():
+    counter = counters_db.find_one_and_update(
+        {"_id": "acct_num"},
+        {"$inc": {"seq": ACCT_BLOCK_SIZE}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    end = ACCT_SEQ_START + counter["seq"]
+    _acct_block["next"] = end - ACCT_BLOCK_SIZE
+    _acct_block["end"] = end
 
 def generate_account_number():
-    # Generates a unique 10-digit account number
-    while True:
-        acct_num = str(random.randint(10**9, 10**10 - 1))
-        if not users_db.find_one({"acct_num": acct_num}):
-            return acct_num
+    # Allocates the next unique 10-digit, check-digit-validated account number
+    with _acct_block_lock:
+        if _acct_block["next"] >= _acct_block["end"]:
+            reserve_account_block()
+        body = str(_acct_block["next"])
+        _acct_block["next"] += 1
+    return body + luhn_check_digit(body)
 
 def validate_bvn(bvn):
     return re.fullmatch(r"\d{11}", bvn) is not None
@@ -42,6 +94,10 @@ def validate_pin(pin):
     return re.fullmatch(r"\d{4,6}", pin) is not None
 
 def get_user_by_acct(acct_num):
+    # Malformed input never needs a round trip. Only the length is checked:
+    # legacy random numbers carry no check digit
+    if not re.fullmatch(r"\d{10}", acct_num or ""):
+        return None
     return users_db.find_one({"acct_num": acct_num})
 
 def authenticate(acct_num, pin):
@@ -49,12 +105,39 @@ def authenticate(acct_num, pin):
     return user and user['pin'] == pin
 
 def record_transaction(acct_num, txn):
+    # Append to the account's open bucket; once it is full the filter stops
+    # matching and the upsert starts a new one
     transactions_db.update_one(
-        {"acct_num": acct_num},
-        {"$push": {"txns": txn}},
+        {"acct_num": acct_num, "count": {"$lt": TXN_BUCKET_SIZE}},
+        {
+            "$push": {"txns": txn},
+            "$inc": {"count": 1},
+            "$setOnInsert": {"start": txn["date"]},
+            "$set": {"end": txn["date"]}
+        },
         upsert=True
     )
-    # Optionally, keep only last 5 transactions (not enforced here)
+    # Capped "recent" view on the user document for the last-5 menu, plus a
+    # total so the menu knows whether the view holds every transaction.
+    # Accounts created before the count existed never get one: counting
+    # from here on would undercount their history
+    recent = {"$push": {"recent_txns": {"$each": [txn], "$slice": -RECENT_TXN_COUNT}}}
+    result = users_db.update_one(
+        {"acct_num": acct_num, "txn_count": {"$exists": True}},
+        dict(recent, **{"$inc": {"txn_count": 1}})
+    )
+    if not result.matched_count:
+        users_db.update_one({"acct_num": acct_num}, recent)
+
+def get_transactions(acct_num, limit=None):
+    # Full history, newest first, walking buckets from the most recent.
+    # Legacy single-document histories have no "end" and sort last
+    txns = []
+    for bucket in transactions_db.find({"acct_num": acct_num}).sort("end", -1):
+        txns.extend(reversed(bucket.get("txns", [])))
+        if limit and len(txns) >= limit:
+            return txns[:limit]
+    return txns
 
 def main_menu():
     return (
@@ -100,16 +183,24 @@ def create_account_flow(session):
         errors.append("PIN must be 4-6 digits.")
     if pin != pin_confirm:
         errors.append("PINs do not match.")
-    acct_num = generate_account_number()
-    users_db.insert_one({
+    user = {
         "name": name,
         "dob": dob,
         "bvn": bvn,
         "nin": nin,
         "pin": pin,
         "balance": 0.0,
-        "acct_num": acct_num
-    })
+        "txn_count": 0
+    }
+    # Sequential numbers never collide with each other; a duplicate can only
+    # be a legacy randomly generated number, so just take the next one
+    while True:
+        acct_num = generate_account_number()
+        try:
+            users_db.insert_one(dict(user, acct_num=acct_num))
+            break
+        except DuplicateKeyError:
+            continue
     return f"Account created successfully! Your account number is {acct_num}. Keep it safe."
 
 def check_balance_flow(session):
@@ -202,8 +293,15 @@ def enquiry_services_flow(session):
     elif step == 2 and session.get('txn_history_step') == 1:
         acct_num = session['acct_num']
         pin = session['pin']
-        if authenticate(acct_num, pin):
-            txns = transactions_db.get(acct_num, [])
+        # One read returns both the PIN and the capped recent-transactions view
+        user = users_db.find_one({"acct_num": acct_num}, {"pin": 1, "recent_txns": 1, "txn_count": 1})
+        if user and user['pin'] == pin:
+            txns = list(reversed(user.get('recent_txns', [])))
+            total = user.get('txn_count')
+            if len(txns) < RECENT_TXN_COUNT and (total is None or total > len(txns)):
+                # Only accounts older than the view can have transactions
+                # missing from it; the buckets hold the full history
+                txns = get_transactions(acct_num, RECENT_TXN_COUNT)
             if not txns:
                 return "No recent transactions."
             lines = [f"{t['date'][:10]}: {t['type'].capitalize()} ₦{t['amount']:.2f}" for t in txns]
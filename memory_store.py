@@ -0,0 +1,232 @@
+"""In-process stand-in for the small part of the pymongo collection API used by main4.py.
+
+Used by the replay driver (replay.py) to run thousands of scripted USSD
+sessions without a MongoDB server. Enable it with ``PYWALLET_STORAGE=memory``
+before importing main4. Supported:
+
+* filters: field equality plus ``$lt``, ``$lte``, ``$gt``, ``$gte``, ``$ne``,
+  ``$in`` and ``$exists``
+* updates: ``$set``, ``$unset``, ``$inc``, ``$min``, ``$max``,
+  ``$setOnInsert`` and ``$push`` (with ``$each``/``$slice``), with upserts
+* single-field unique indexes, projections, sort and limit
+
+Every operation takes one lock per database, so documents are never seen
+half-updated by concurrent sessions.
+"""
+import copy
+import threading
+from types import SimpleNamespace
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+def _compare(value, op, operand):
+    if op == '$ne':
+        return value != operand
+    if op == '$in':
+        return value in operand
+    if op == '$exists':
+        return (value is not _MISSING) == bool(operand)
+    if value is _MISSING or value is None:
+        return False
+    if op == '$lt':
+        return value < operand
+    if op == '$lte':
+        return value <= operand
+    if op == '$gt':
+        return value > operand
+    if op == '$gte':
+        return value >= operand
+    raise NotImplementedError(f"Unsupported query operator {op}")
+
+def matches(doc, query):
+    for field, condition in (query or {}).items():
+        value = doc.get(field, _MISSING)
+        if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+            if not all(_compare(value, op, operand) for op, operand in condition.items()):
+                return False
+        elif value is _MISSING or value != condition:
+            return False
+    return True
+
+def project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    include = {k for k, v in projection.items() if v and k != '_id'}
+    if include:
+        result = {k: copy.deepcopy(doc[k]) for k in include if k in doc}
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    return {k: copy.deepcopy(v) for k, v in doc.items() if projection.get(k, 1)}
+
+def apply_update(doc, update, inserting=False):
+    for op, fields in update.items():
+        if op == '$setOnInsert':
+            if inserting:
+                doc.update(copy.deepcopy(fields))
+        elif op == '$set':
+            doc.update(copy.deepcopy(fields))
+        elif op == '$unset':
+            for field in fields:
+                doc.pop(field, None)
+        elif op == '$inc':
+            for field, amount in fields.items():
+                doc[field] = doc.get(field, 0) + amount
+        elif op == '$min':
+            for field, value in fields.items():
+                if field not in doc or value < doc[field]:
+                    doc[field] = value
+        elif op == '$max':
+            for field, value in fields.items():
+                if field not in doc or value > doc[field]:
+                    doc[field] = value
+        elif op == '$push':
+            for field, value in fields.items():
+                items = doc.setdefault(field, [])
+                if isinstance(value, dict) and '$each' in value:
+                    items.extend(copy.deepcopy(value['$each']))
+                    if '$slice' in value:
+                        limit = value['$slice']
+                        items[:] = items[limit:] if limit < 0 else items[:limit]
+                else:
+                    items.append(copy.deepcopy(value))
+        else:
+            raise NotImplementedError(f"Unsupported update operator {op}")
+
+class MemoryCursor:
+    def __init__(self, docs, projection):
+        self._docs = docs
+        self._projection = projection
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, order in reversed(keys):
+            self._docs.sort(key=lambda d: (d.get(field) is not None, d.get(field)), reverse=order < 0)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def __iter__(self):
+        docs = self._docs[:self._limit] if self._limit else self._docs
+        return (project(doc, self._projection) for doc in docs)
+
+class MemoryCollection:
+    def __init__(self, name, lock):
+        self.name = name
+        self._lock = lock
+        self._docs = []
+        self._unique = set()
+
+    def create_index(self, keys, unique=False, **kwargs):
+        if unique and isinstance(keys, str):
+            self._unique.add(keys)
+        return keys if isinstance(keys, str) else '_'.join(f"{k}_{d}" for k, d in keys)
+
+    def _check_unique(self, candidate, ignore=None):
+        for field in self._unique:
+            if field in candidate and any(
+                doc is not ignore and doc.get(field) == candidate[field] for doc in self._docs
+            ):
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {field}")
+
+    def _find(self, query):
+        return [doc for doc in self._docs if matches(doc, query)]
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        with self._lock:
+            docs = self._find(filter)
+            if sort:
+                docs = list(MemoryCursor(docs, None).sort(sort))
+            return project(docs[0], projection) if docs else None
+
+    def find(self, filter=None, projection=None):
+        with self._lock:
+            return MemoryCursor([copy.deepcopy(doc) for doc in self._find(filter)], projection)
+
+    def count_documents(self, filter):
+        with self._lock:
+            return len(self._find(filter))
+
+    def insert_one(self, document):
+        with self._lock:
+            doc = copy.deepcopy(document)
+            doc.setdefault('_id', ObjectId())
+            self._check_unique(doc)
+            self._docs.append(doc)
+            document.setdefault('_id', doc['_id'])
+            return SimpleNamespace(inserted_id=doc['_id'], acknowledged=True)
+
+    def _upsert(self, filter, update):
+        doc = {k: copy.deepcopy(v) for k, v in filter.items() if not isinstance(v, dict)}
+        apply_update(doc, update, inserting=True)
+        doc.setdefault('_id', ObjectId())
+        self._check_unique(doc)
+        self._docs.append(doc)
+        return doc
+
+    def _update(self, filter, update, upsert):
+        docs = self._find(filter)
+        if docs:
+            doc = docs[0]
+            before = copy.deepcopy(doc)
+            candidate = copy.deepcopy(doc)
+            apply_update(candidate, update)
+            self._check_unique(candidate, ignore=doc)
+            doc.clear()
+            doc.update(candidate)
+            return before, doc, None
+        if upsert:
+            doc = self._upsert(filter, update)
+            return None, doc, doc['_id']
+        return None, None, None
+
+    def update_one(self, filter, update, upsert=False):
+        with self._lock:
+            before, after, upserted_id = self._update(filter, update, upsert)
+            matched = 1 if before is not None else 0
+            return SimpleNamespace(
+                matched_count=matched,
+                modified_count=int(matched and before != after),
+                upserted_id=upserted_id,
+                acknowledged=True
+            )
+
+    def find_one_and_update(self, filter, update, projection=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        with self._lock:
+            before, after, _ = self._update(filter, update, upsert)
+            doc = after if return_document == ReturnDocument.AFTER else before
+            return project(doc, projection) if doc is not None else None
+
+    def delete_one(self, filter):
+        with self._lock:
+            docs = self._find(filter)
+            if docs:
+                self._docs.remove(docs[0])
+            return SimpleNamespace(deleted_count=len(docs[:1]), acknowledged=True)
+
+class MemoryDatabase:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._collections = {}
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(name, self._lock)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
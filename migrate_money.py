@@ -0,0 +1,53 @@
+"""One-off migration: convert float money fields to integer minor units.
+
+Older documents store ``balance``, ``amount``, ``balance_before`` and
+``balance_after`` as floats in major units (KSH). The wallet now keeps money
+as int64 minor units (cents). Only fields that are still stored as doubles
+are rewritten, so the migration is safe to run more than once.
+
+Run it with money traffic stopped, before the minor-unit code serves any
+request. New code adding int cents onto a legacy double balance would leave
+a mixed-unit double that this migration then multiplies by 100 again. As a
+backstop, ``WalletManager.update_balance`` refuses to touch a balance that
+is still a double.
+
+Usage:
+    python migrate_money.py
+"""
+import logging
+from typing import Dict
+
+from main2 import users_collection, transactions_collection, MINOR_UNITS_PER_MAJOR
+
+logger = logging.getLogger(__name__)
+
+MONEY_FIELDS = {
+    'users': (users_collection, ['balance']),
+    'transactions': (transactions_collection, ['amount', 'balance_before', 'balance_after']),
+}
+
+def to_minor_units_expr(field: str) -> Dict:
+    """Server-side expression converting a double major-unit field to int64 minor units"""
+    return {'$toLong': {'$round': [{'$multiply': [f'${field}', MINOR_UNITS_PER_MAJOR]}, 0]}}
+
+def migrate_field(collection, field: str) -> int:
+    """Convert one field on every document where it is still a double"""
+    result = collection.update_many(
+        {field: {'$type': 'double'}},
+        [{'$set': {field: to_minor_units_expr(field)}}]
+    )
+    return result.modified_count
+
+def migrate() -> Dict[str, int]:
+    """Run the migration over all money fields"""
+    converted = {}
+    for name, (collection, fields) in MONEY_FIELDS.items():
+        for field in fields:
+            count = migrate_field(collection, field)
+            converted[f"{name}.{field}"] = count
+            logger.info(f"Converted {count} {name}.{field} values to minor units")
+    return converted
+
+if __name__ == '__main__':
+    for key, count in migrate().items():
+        print(f"{key}: {count} documents converted")
@@ -0,0 +1,202 @@
+"""Nightly ledger reconciliation.
+
+Checks every account in parallel:
+
+* the ``balance_before``/``balance_after`` chain of its transactions is
+  unbroken: every ``balance_before`` is some other transaction's
+  ``balance_after``, except the opening balance, and the chain ends at the
+  current balance. Links are matched by value rather than by ``created_at``,
+  which is stamped before the balance update and so can order concurrent
+  updates differently from how they were applied. Accounts that are or
+  were striped are skipped, since stripe folds move the balance without a
+  transaction row,
+* its balance (including hot-account stripes) equals the net of its
+  completed transactions,
+* every ``send`` has a matching ``receive`` (same reference and amount) and
+  every ``receive`` points at an existing ``send``.
+
+Accounts are partitioned by ``_id`` range and each partition is reconciled in
+its own process with its own MongoDB connection. Transactions are streamed
+per account so memory stays bounded regardless of history length.
+
+Usage:
+    python reconcile.py [--workers 8] [--partitions 64] [--report discrepancies.jsonl]
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+from main2 import (
+    users_collection, transactions_collection, partition_id_ranges, id_range_filter,
+    WalletManager, StripedBalance, TransactionArchive, CREDIT_TRANSACTION_TYPES, DEBIT_TRANSACTION_TYPES
+)
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_FIELDS = {
+    '_id': 0, 'transaction_id': 1, 'type': 1, 'amount': 1, 'reference': 1,
+    'balance_before': 1, 'balance_after': 1, 'status': 1, 'created_at': 1
+}
+
+def discrepancy(phone_number: str, kind: str, **details) -> Dict:
+    """Build a report row"""
+    row = {'phone_number': phone_number, 'kind': kind}
+    row.update(details)
+    return row
+
+def check_transfer_pairs(phone_number: str, sends: Dict[str, int], receives: Dict[str, int]) -> List[Dict]:
+    """Match this account's sends and receives against their counterparts"""
+    issues = []
+    
+    if sends:
+        query = {'type': 'receive', 'reference': {'$in': list(sends)}}
+        projection = {'_id': 0, 'reference': 1, 'amount': 1}
+        matched = {txn['reference']: txn['amount'] for txn in transactions_collection.find(query, projection)}
+        if len(matched) < len(sends):
+            query['reference'] = {'$in': [ref for ref in sends if ref not in matched]}
+            matched.update((txn['reference'], txn['amount']) for txn in TransactionArchive.find(query, projection))
+        for transaction_id, amount in sends.items():
+            if transaction_id not in matched:
+                issues.append(discrepancy(phone_number, 'unmatched_send', transaction_id=transaction_id))
+            elif matched[transaction_id] != amount:
+                issues.append(discrepancy(phone_number, 'transfer_amount_mismatch', transaction_id=transaction_id,
+                                          expected=amount, actual=matched[transaction_id]))
+    
+    if receives:
+        query = {'type': 'send', 'transaction_id': {'$in': list(receives)}}
+        projection = {'_id': 0, 'transaction_id': 1}
+        found = {txn['transaction_id'] for txn in transactions_collection.find(query, projection)}
+        if len(found) < len(receives):
+            query['transaction_id'] = {'$in': [ref for ref in receives if ref not in found]}
+            found.update(txn['transaction_id'] for txn in TransactionArchive.find(query, projection))
+        for reference in receives:
+            if reference not in found:
+                issues.append(discrepancy(phone_number, 'orphan_receive', reference=reference))
+    
+    return issues
+
+def reconcile_account(user: Dict) -> Tuple[int, List[Dict]]:
+    """Reconcile one account, returning (transactions checked, discrepancies)"""
+    phone_number = user['phone_number']
+    issues = []
+    checked = 0
+    net = 0
+    # balance value -> times it starts a link minus times it ends one
+    unmatched = Counter()
+    check_chain = not StripedBalance.is_striped(user) and not user.get('fold_tokens')
+    sends, receives = {}, {}
+    
+    # Archived history is strictly older than anything still in the hot collection
+    cursor = itertools.chain(
+        TransactionArchive.iter_history(phone_number, TRANSACTION_FIELDS),
+        transactions_collection.find(
+            {'user_phone': phone_number}, TRANSACTION_FIELDS
+        ).sort([('created_at', 1), ('transaction_id', 1)]).batch_size(1000)
+    )
+    
+    for txn in cursor:
+        if txn.get('status') != 'completed':
+            continue
+        checked += 1
+        
+        if txn['type'] in CREDIT_TRANSACTION_TYPES:
+            net += txn['amount']
+        elif txn['type'] in DEBIT_TRANSACTION_TYPES:
+            net -= txn['amount']
+        
+        before, after = txn.get('balance_before'), txn.get('balance_after')
+        if check_chain and before is not None and after is not None:
+            for value, step in ((before, 1), (after, -1)):
+                unmatched[value] += step
+                if not unmatched[value]:
+                    del unmatched[value]
+        
+        if txn['type'] == 'send':
+            sends[txn['transaction_id']] = txn['amount']
+        elif txn['type'] == 'receive' and txn.get('reference'):
+            receives[txn['reference']] = txn['amount']
+        
+        # Keep the per-account pairing batches bounded for very long histories
+        if len(sends) + len(receives) >= 1000:
+            issues.extend(check_transfer_pairs(phone_number, sends, receives))
+            sends, receives = {}, {}
+    
+    issues.extend(check_transfer_pairs(phone_number, sends, receives))
+    
+    # An unbroken chain leaves only its opening balance and its final
+    # balance unmatched, and the final one is the current balance
+    starts = sorted(value for value, count in unmatched.items() for _ in range(max(count, 0)))
+    ends = sorted(value for value, count in unmatched.items() for _ in range(max(-count, 0)))
+    if len(starts) > 1 or ends not in ([], [user['balance']]):
+        issues.append(discrepancy(phone_number, 'chain_break', unmatched_before=starts, unmatched_after=ends))
+    
+    balance = WalletManager.get_balance(user)
+    if balance != net:
+        issues.append(discrepancy(phone_number, 'balance_mismatch', expected=net, actual=balance))
+    
+    return checked, issues
+
+def reconcile_partition(lower, upper) -> Dict:
+    """Reconcile every account in one _id range"""
+    started = time.monotonic()
+    accounts = 0
+    transactions = 0
+    issues = []
+    
+    cursor = users_collection.find(
+        id_range_filter(lower, upper),
+        {'phone_number': 1, 'balance': 1, 'striped': 1, 'stripe_count': 1, 'fold_tokens': 1}
+    ).sort('_id', 1).batch_size(1000)
+    
+    for user in cursor:
+        checked, account_issues = reconcile_account(user)
+        accounts += 1
+        transactions += checked
+        issues.extend(account_issues)
+    
+    return {
+        'accounts': accounts,
+        'transactions': transactions,
+        'issues': issues,
+        'seconds': time.monotonic() - started
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile balances against the transaction log")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--partitions', type=int, default=None,
+                        help="Number of _id ranges (default: 4 per worker)")
+    parser.add_argument('--report', default='discrepancies.jsonl')
+    args = parser.parse_args()
+    
+    started = time.monotonic()
+    ranges = partition_id_ranges(users_collection, args.partitions or args.workers * 4)
+    
+    totals = {'accounts': 0, 'transactions': 0, 'issues': 0}
+    # Spawn so every worker opens its own MongoDB connection
+    context = multiprocessing.get_context('spawn')
+    with open(args.report, 'w') as report, \
+            ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as pool:
+        futures = [pool.submit(reconcile_partition, lower, upper) for lower, upper in ranges]
+        for future in as_completed(futures):
+            result = future.result()
+            totals['accounts'] += result['accounts']
+            totals['transactions'] += result['transactions']
+            totals['issues'] += len(result['issues'])
+            for issue in result['issues']:
+                report.write(json.dumps(issue, default=str) + '\n')
+    
+    elapsed = time.monotonic() - started
+    print(f"Reconciled {totals['accounts']} accounts and {totals['transactions']} transactions "
+          f"in {elapsed:.1f}s with {totals['issues']} discrepancies (report: {args.report})")
+    return 1 if totals['issues'] else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,175 @@
+"""Headless replay driver for the main4.py ussd_handler state machine.
+
+Replays scripted USSD sessions concurrently and reports per-flow throughput,
+latency and any output that does not match the transcript. Use it as a
+regression suite (non-zero exit on mismatches) or as a benchmark for the
+create-account, send-money and enquiry flows.
+
+Transcripts are JSONL, one session per line::
+
+    {"name": "balance-ok", "flow": "check_balance",
+     "session": {"acct_num": "1000000008"},
+     "steps": [{"input": "2", "expect": "Enter your account number"},
+               {"input": "1000000008"},
+               {"input": "1234", "expect": "Your balance is"}]}
+
+``expect`` is a regular expression searched in the handler's response; steps
+without one are only timed. ``session`` optionally seeds the session dict
+(main4's send-money flow reads the sender account from it). ``flow`` defaults
+to the flow chosen by the first main-menu input.
+
+Fixtures (a JSON list of user documents) are loaded before the run. By
+default sessions run against the in-memory store; pass ``--backend mongo`` to
+use the database configured by MONGO_URI.
+
+Usage:
+    python replay.py transcripts.jsonl [--fixtures users.json] [--concurrency 200] [--repeat 10]
+    python replay.py transcripts.jsonl --record recorded.jsonl   # capture current outputs as expectations
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+FLOW_BY_INPUT = {
+    '1': 'create_account',
+    '2': 'check_balance',
+    '3': 'send_money',
+    '4': 'enquiry_services',
+    '5': 'exit'
+}
+
+def load_transcripts(path):
+    transcripts = []
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            transcript = json.loads(line)
+            transcript.setdefault('name', f"{os.path.basename(path)}:{line_no}")
+            if not transcript.get('flow'):
+                first = transcript['steps'][0]['input'] if transcript['steps'] else ''
+                transcript['flow'] = FLOW_BY_INPUT.get(first, 'main_menu')
+            transcripts.append(transcript)
+    return transcripts
+
+def load_fixtures(main4, path):
+    with open(path) as f:
+        users = json.load(f)
+    for user in users:
+        main4.users_db.update_one({"acct_num": user["acct_num"]}, {"$set": user}, upsert=True)
+    return len(users)
+
+def run_session(main4, transcript):
+    """Replay one session, returning per-step latencies, mismatches and outputs"""
+    session = {'menu': 'main'}
+    session.update(transcript.get('session', {}))
+    latencies = []
+    mismatches = []
+    outputs = []
+
+    for i, step in enumerate(transcript['steps']):
+        started = time.perf_counter()
+        try:
+            response = main4.ussd_handler(session, step['input'])
+        except Exception as e:
+            response = f"<exception {type(e).__name__}: {e}>"
+        latencies.append(time.perf_counter() - started)
+        response = response if response is not None else ''
+        outputs.append(response)
+
+        expect = step.get('expect')
+        if expect is not None and not re.search(expect, response):
+            mismatches.append({
+                'transcript': transcript['name'],
+                'step': i,
+                'input': step['input'],
+                'expect': expect,
+                'actual': response
+            })
+
+    return latencies, mismatches, outputs
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def print_report(stats, elapsed):
+    print(f"{'flow':<18}{'sessions':>10}{'steps':>10}{'mismatch':>10}{'steps/s':>12}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for flow in sorted(stats):
+        s = stats[flow]
+        lat = sorted(s['latencies'])
+        print(f"{flow:<18}{s['sessions']:>10}{len(lat):>10}{s['mismatches']:>10}"
+              f"{len(lat) / elapsed:>12.0f}"
+              f"{percentile(lat, 50) * 1000:>10.2f}{percentile(lat, 95) * 1000:>10.2f}"
+              f"{percentile(lat, 99) * 1000:>10.2f}")
+    total_steps = sum(len(s['latencies']) for s in stats.values())
+    total_sessions = sum(s['sessions'] for s in stats.values())
+    all_lat = [x for s in stats.values() for x in s['latencies']]
+    mean = statistics.mean(all_lat) * 1000 if all_lat else 0.0
+    print(f"\n{total_sessions} sessions, {total_steps} steps in {elapsed:.2f}s "
+          f"({total_sessions / elapsed:.0f} sessions/s, {total_steps / elapsed:.0f} steps/s, mean {mean:.2f} ms/step)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay scripted USSD sessions against main4.ussd_handler")
+    parser.add_argument('transcripts', nargs='+', help="JSONL transcript files")
+    parser.add_argument('--fixtures', help="JSON list of user documents to load first")
+    parser.add_argument('--backend', choices=['memory', 'mongo'], default='memory')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=1, help="Replay each transcript this many times")
+    parser.add_argument('--record', help="Write transcripts with the actual outputs as expectations")
+    parser.add_argument('--show', type=int, default=10, help="Mismatches to print")
+    args = parser.parse_args()
+
+    # main4 picks its storage at import time
+    if args.backend == 'memory':
+        os.environ['PYWALLET_STORAGE'] = 'memory'
+    import main4
+
+    transcripts = [t for path in args.transcripts for t in load_transcripts(path)]
+    if args.fixtures:
+        print(f"Loaded {load_fixtures(main4, args.fixtures)} fixture users")
+
+    jobs = [t for t in transcripts for _ in range(args.repeat)]
+    stats = defaultdict(lambda: {'sessions': 0, 'mismatches': 0, 'latencies': []})
+    mismatches = []
+    recorded = {}
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for transcript, (latencies, session_mismatches, outputs) in zip(
+                jobs, pool.map(lambda t: run_session(main4, t), jobs)):
+            flow_stats = stats[transcript['flow']]
+            flow_stats['sessions'] += 1
+            flow_stats['latencies'].extend(latencies)
+            flow_stats['mismatches'] += len(session_mismatches)
+            mismatches.extend(session_mismatches)
+            recorded.setdefault(transcript['name'], (transcript, outputs))
+    elapsed = time.perf_counter() - started
+
+    print_report(stats, elapsed)
+
+    for mismatch in mismatches[:args.show]:
+        print(f"\nMISMATCH {mismatch['transcript']} step {mismatch['step']} (input {mismatch['input']!r})\n"
+              f"  expected /{mismatch['expect']}/\n  got {mismatch['actual']!r}")
+
+    if args.record:
+        with open(args.record, 'w') as f:
+            for transcript, outputs in recorded.values():
+                steps = [dict(step, expect=re.escape(output)) for step, output in zip(transcript['steps'], outputs)]
+                f.write(json.dumps(dict(transcript, steps=steps), ensure_ascii=False) + '\n')
+        print(f"\nRecorded {len(recorded)} transcripts to {args.record}")
+
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
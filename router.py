@@ -0,0 +1,311 @@
+"""Session-affinity routing for multi-node deployments.
+
+Every hop of a USSD session must reach the node that holds its in-memory
+state (the stateless-mode memo in main2.py, or any other per-process cache).
+Nodes are placed on a consistent-hash ring and each ``sessionId`` is owned by
+the first node clockwise from its hash. Adding or removing a node therefore
+moves only the sessions in that node's arcs, about 1/N of them.
+
+Two deployment shapes are supported:
+
+* Embedded: ``SessionAffinityMiddleware`` wraps main2's WSGI app on every
+  node. A hop that lands on the wrong node is forwarded internally to its
+  owner. main2 enables it when ``CLUSTER_NODES`` is set.
+* Standalone: ``python router.py proxy`` runs a front proxy that forwards
+  every request to the owning node.
+
+Membership comes from ``CLUSTER_NODES`` (``id=url`` pairs separated by
+commas) and, if ``CLUSTER_MEMBERS_FILE`` is set, from that file (one
+``id=url`` per line), which is re-read whenever it changes.
+
+A forwarded hop carries ``X-Session-Routed-By``, signed with the shared
+``CLUSTER_SECRET`` over the forwarding node and the ``sessionId``. Only a
+valid signature makes a node handle the hop without routing it, so a client
+cannot set the header itself to pick a node. Without a secret the header is
+never trusted.
+
+Local testing:
+    python router.py local --nodes 3          # three main2 nodes on 5001-5003 with embedded routing
+    python router.py proxy --port 8000 --nodes-spec "a=http://127.0.0.1:5001,b=http://127.0.0.1:5002"
+"""
+import argparse
+import bisect
+import errno
+import hashlib
+import hmac
+import io
+import logging
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+ROUTED_HEADER = 'X-Session-Routed-By'
+ROUTED_ENVIRON_KEY = 'HTTP_' + ROUTED_HEADER.upper().replace('-', '_')
+CLUSTER_SECRET = os.environ.get('CLUSTER_SECRET', '')
+VIRTUAL_NODES = int(os.environ.get('CLUSTER_VIRTUAL_NODES', 128))
+FORWARD_TIMEOUT = float(os.environ.get('CLUSTER_FORWARD_TIMEOUT', 3))
+MEMBERS_POLL_INTERVAL = 5  # seconds
+
+def parse_members(spec: str) -> Dict[str, str]:
+    """Parse ``id=url`` pairs separated by commas or newlines"""
+    members = {}
+    for item in spec.replace('\n', ',').split(','):
+        item = item.strip()
+        if not item or item.startswith('#'):
+            continue
+        node_id, _, url = item.partition('=')
+        members[node_id.strip()] = url.strip().rstrip('/')
+    return members
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes"""
+
+    def __init__(self, members: Dict[str, str], virtual_nodes: int = VIRTUAL_NODES):
+        self.members = dict(members)
+        self.virtual_nodes = virtual_nodes
+        points = []
+        for node_id in self.members:
+            for i in range(virtual_nodes):
+                points.append((self._hash(f"{node_id}#{i}"), node_id))
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def node_for(self, key: str) -> Optional[str]:
+        """Node owning a key"""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+class Membership:
+    """Current ring, rebuilt when the members file changes"""
+
+    def __init__(self, members: Dict[str, str], members_file: str = None):
+        self.members_file = members_file
+        self._static = dict(members)
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.ring = HashRing(members)
+        if members_file:
+            self.reload()
+            threading.Thread(target=self._watch, name='cluster-members', daemon=True).start()
+
+    def update(self, members: Dict[str, str]) -> None:
+        """Swap in a new membership"""
+        with self._lock:
+            if members != self.ring.members:
+                logger.info(f"Cluster membership changed: {sorted(self.ring.members)} -> {sorted(members)}")
+                self.ring = HashRing(members)
+
+    def reload(self) -> None:
+        """Re-read the members file if it changed"""
+        try:
+            mtime = os.path.getmtime(self.members_file)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        with open(self.members_file) as f:
+            members = dict(self._static)
+            members.update(parse_members(f.read()))
+        self.update(members)
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(MEMBERS_POLL_INTERVAL)
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error(f"Failed to reload cluster members: {e}")
+
+def read_body(environ: Dict) -> bytes:
+    """Read the request body and put it back so the app can read it again"""
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    body = environ['wsgi.input'].read(length) if length else b''
+    environ['wsgi.input'] = io.BytesIO(body)
+    return body
+
+def session_id_of(environ: Dict, body: bytes) -> str:
+    """sessionId from the form body or query string"""
+    values = parse_qs(body.decode('utf-8', 'replace'))
+    values.update(parse_qs(environ.get('QUERY_STRING', '')))
+    return (values.get('sessionId') or [''])[0]
+
+def sign_route(routed_by: str, session_id: str) -> str:
+    """Routed-by header value: the forwarding node and an HMAC binding it to the session"""
+    digest = hmac.new(CLUSTER_SECRET.encode(), f"{routed_by}:{session_id}".encode(), hashlib.sha256).hexdigest()
+    return f"{routed_by}:{digest}"
+
+def is_routed(environ: Dict, session_id: str) -> bool:
+    """Whether another node or the proxy already routed this hop (a client cannot forge it)"""
+    value = environ.get(ROUTED_ENVIRON_KEY, '')
+    if not CLUSTER_SECRET or not value:
+        return False
+    routed_by = value.rpartition(':')[0]
+    return hmac.compare_digest(value, sign_route(routed_by, session_id))
+
+def forward(url: str, environ: Dict, body: bytes, routed_by: str, start_response):
+    """Forward a request to another node and relay its response"""
+    target = url + environ.get('PATH_INFO', '')
+    if environ.get('QUERY_STRING'):
+        target += '?' + environ['QUERY_STRING']
+    headers = {ROUTED_HEADER: sign_route(routed_by, session_id_of(environ, body))}
+    if environ.get('CONTENT_TYPE'):
+        headers['Content-Type'] = environ['CONTENT_TYPE']
+
+    req = urllib.request.Request(target, data=body, headers=headers, method=environ['REQUEST_METHOD'])
+    try:
+        with urllib.request.urlopen(req, timeout=FORWARD_TIMEOUT) as resp:
+            payload = resp.read()
+            status = f"{resp.status} {resp.reason}"
+            response_headers = [(k, v) for k, v in resp.getheaders()
+                                if k.lower() not in ('connection', 'transfer-encoding')]
+    except urllib.error.HTTPError as e:
+        payload = e.read()
+        status = f"{e.code} {e.reason}"
+        response_headers = [(k, v) for k, v in e.headers.items()
+                            if k.lower() not in ('connection', 'transfer-encoding')]
+    start_response(status, response_headers)
+    return [payload]
+
+def is_connect_error(error: Exception) -> bool:
+    """Whether forwarding failed before the owner could have received the request.
+
+    Only then is it safe to run the hop locally instead. After a timeout or a
+    reset, the owner may be running it already, and for a transfer or deposit
+    step that would make it happen twice.
+    """
+    reason = error.reason if isinstance(error, urllib.error.URLError) else error
+    if isinstance(reason, (ConnectionRefusedError, socket.gaierror)):
+        return True
+    return isinstance(reason, OSError) and reason.errno in (errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+class SessionAffinityMiddleware:
+    """WSGI middleware forwarding USSD hops to the node that owns the session"""
+
+    def __init__(self, app, node_id: str, membership: Membership, path: str = '/ussd'):
+        self.app = app
+        self.node_id = node_id
+        self.membership = membership
+        self.path = path
+
+    @classmethod
+    def from_env(cls, app) -> 'SessionAffinityMiddleware':
+        members = parse_members(os.environ.get('CLUSTER_NODES', ''))
+        node_id = os.environ.get('NODE_ID') or next(iter(members), '')
+        if not CLUSTER_SECRET:
+            logger.warning("CLUSTER_SECRET is not set; forwarded hops cannot be told apart from client requests")
+        return cls(app, node_id, Membership(members, os.environ.get('CLUSTER_MEMBERS_FILE')))
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != self.path or environ.get('REQUEST_METHOD') != 'POST':
+            return self.app(environ, start_response)
+
+        body = read_body(environ)
+        session_id = session_id_of(environ, body)
+        # Already forwarded once: always handle locally to avoid loops while
+        # nodes briefly disagree about membership. An unsigned header came
+        # from a client and is dropped.
+        if is_routed(environ, session_id):
+            return self.app(environ, start_response)
+        environ.pop(ROUTED_ENVIRON_KEY, None)
+
+        ring = self.membership.ring
+        owner = ring.node_for(session_id)
+        if owner is None or owner == self.node_id or owner not in ring.members:
+            return self.app(environ, start_response)
+
+        try:
+            return forward(ring.members[owner], environ, body, self.node_id, start_response)
+        except Exception as e:
+            logger.error(f"Forwarding session hop to {owner} failed: {e}")
+            if not is_connect_error(e):
+                start_response('504 Gateway Timeout', [('Content-Type', 'text/plain')])
+                return [b'END Service temporarily unavailable']
+            # The owner is unreachable; serve locally; session state is
+            # rebuilt from the text chain in stateless mode
+            environ['wsgi.input'] = io.BytesIO(body)
+            return self.app(environ, start_response)
+
+class RoutingProxy:
+    """Standalone front proxy: forwards every request to the session's owner"""
+
+    def __init__(self, membership: Membership):
+        self.membership = membership
+
+    def __call__(self, environ, start_response):
+        body = read_body(environ)
+        ring = self.membership.ring
+        owner = ring.node_for(session_id_of(environ, body) or environ.get('PATH_INFO', ''))
+        if owner is None:
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain')])
+            return [b'END Service temporarily unavailable']
+        try:
+            return forward(ring.members[owner], environ, body, 'proxy', start_response)
+        except Exception as e:
+            logger.error(f"Proxying to {owner} failed: {e}")
+            start_response('502 Bad Gateway', [('Content-Type', 'text/plain')])
+            return [b'END Service temporarily unavailable']
+
+def run_local_cluster(count: int, base_port: int) -> None:
+    """Start ``count`` main2 nodes on consecutive ports with embedded routing"""
+    members = {f"node{i}": f"http://127.0.0.1:{base_port + i}" for i in range(count)}
+    spec = ','.join(f"{k}={v}" for k, v in members.items())
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main2.py')
+    secret = CLUSTER_SECRET or secrets.token_hex(32)
+    processes = []
+    for i, node_id in enumerate(members):
+        env = dict(os.environ, NODE_ID=node_id, CLUSTER_NODES=spec, CLUSTER_SECRET=secret, PORT=str(base_port + i))
+        processes.append(subprocess.Popen([sys.executable, script], env=env))
+    print(f"Started {count} nodes: {spec}")
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+def main():
+    parser = argparse.ArgumentParser(description="USSD session-affinity routing")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    local = sub.add_parser('local', help="Run several main2 nodes locally")
+    local.add_argument('--nodes', type=int, default=3)
+    local.add_argument('--base-port', type=int, default=5001)
+
+    proxy = sub.add_parser('proxy', help="Run a standalone front proxy")
+    proxy.add_argument('--port', type=int, default=8000)
+    proxy.add_argument('--nodes-spec', default=os.environ.get('CLUSTER_NODES', ''))
+    proxy.add_argument('--members-file', default=os.environ.get('CLUSTER_MEMBERS_FILE'))
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'local':
+        run_local_cluster(args.nodes, args.base_port)
+    else:
+        from werkzeug.serving import run_simple
+        membership = Membership(parse_members(args.nodes_spec), args.members_file)
+        run_simple('0.0.0.0', args.port, RoutingProxy(membership), threaded=True)
+
+if __name__ == '__main__':
+    main()
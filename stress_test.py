@@ -0,0 +1,204 @@
+"""Concurrency stress test for the money path.
+
+Runs interleaved transfers, deposits and withdrawals between a small set of
+hot accounts from many threads (optionally in several processes) through
+``WalletManager``, then checks that:
+
+* money is conserved: the sum of balances equals the opening total plus
+  successful deposits minus successful withdrawals,
+* no balance is negative,
+* every balance equals the net of its completed transactions (a lost update
+  shows up here),
+* every completed send has a completed receive.
+
+It reports throughput and how often operations were refused or failed.
+
+The test uses its own database (``DATABASE_NAME``, default
+``ussd_wallet_stress``), which it clears first, and never sends SMS.
+
+Usage:
+    python stress_test.py [--accounts 8] [--threads 32] [--processes 1] [--operations 500] [--striped 2]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List
+
+os.environ.setdefault('DATABASE_NAME', 'ussd_wallet_stress')
+
+import main2
+from main2 import WalletManager, StripedBalance, CREDIT_TRANSACTION_TYPES, DEBIT_TRANSACTION_TYPES
+
+PIN = '4321'
+OPENING_BALANCE = 1_000_000          # minor units per account
+MIN_AMOUNT, MAX_AMOUNT = 100, 50_000
+OPERATION_MIX = [('transfer', 0.6), ('deposit', 0.2), ('withdraw', 0.2)]
+
+# Outcomes that are the money path correctly refusing an operation
+REFUSALS = ('Insufficient balance', 'Daily transaction limit exceeded')
+
+def account_phones(count: int) -> List[str]:
+    return [f"+254799{i:06d}" for i in range(count)]
+
+def setup(accounts: int, striped: int) -> List[str]:
+    """Clear the stress database and create funded accounts"""
+    for collection in (main2.users_collection, main2.transactions_collection,
+                       main2.ledger_entries_collection, main2.balance_checkpoints_collection,
+                       main2.balance_stripes_collection):
+        collection.delete_many({})
+    
+    phones = account_phones(accounts)
+    for i, phone in enumerate(phones):
+        WalletManager.create_user(phone, PIN, f"Stress {i}")
+        WalletManager.update_balance(phone, OPENING_BALANCE, 'deposit', 'Opening balance')
+        if i < striped:
+            StripedBalance.enable(phone)
+    return phones
+
+def run_operation(phones: List[str], rng: random.Random) -> tuple:
+    """Run one random operation, returning (kind, outcome, credited, debited)"""
+    kind = rng.choices([k for k, _ in OPERATION_MIX], [w for _, w in OPERATION_MIX])[0]
+    amount = rng.randint(MIN_AMOUNT, MAX_AMOUNT)
+    phone = rng.choice(phones)
+    
+    if kind == 'transfer':
+        recipient = rng.choice([p for p in phones if p != phone])
+        success, message = WalletManager.transfer_money(phone, recipient, amount, PIN)
+    else:
+        success, message = WalletManager.update_balance(phone, amount, kind, f"Stress {kind}")
+    
+    if success:
+        outcome = 'ok'
+    elif message in REFUSALS:
+        outcome = 'refused'
+    else:
+        outcome = 'failed'
+    credited = amount if success and kind == 'deposit' else 0
+    debited = amount if success and kind == 'withdraw' else 0
+    return kind, outcome, credited, debited
+
+def run_worker(phones: List[str], threads: int, operations: int, seed: int) -> Dict:
+    """Run ``threads`` threads of ``operations`` operations each"""
+    # Spawned processes import main2 afresh
+    main2.sms = None
+    outcomes = Counter()
+    totals = {'credited': 0, 'debited': 0}
+    lock = threading.Lock()
+    
+    def thread_body(thread_index: int):
+        rng = random.Random(seed * 100003 + thread_index)
+        local = Counter()
+        credited = debited = 0
+        for _ in range(operations):
+            kind, outcome, c, d = run_operation(phones, rng)
+            local[(kind, outcome)] += 1
+            credited += c
+            debited += d
+        with lock:
+            outcomes.update(local)
+            totals['credited'] += credited
+            totals['debited'] += debited
+    
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(thread_body, range(threads)))
+    
+    return {'outcomes': dict(outcomes), **totals}
+
+def verify(phones: List[str], expected_total: int) -> List[str]:
+    """Check the invariants, returning a list of violations"""
+    violations = []
+    StripedBalance.compact_all()
+    
+    balances = {}
+    for user in main2.users_collection.find({'phone_number': {'$in': phones}}):
+        balances[user['phone_number']] = WalletManager.get_balance(user)
+    
+    total = sum(balances.values())
+    if total != expected_total:
+        violations.append(f"Money not conserved: balances sum to {total}, expected {expected_total} "
+                          f"(difference {total - expected_total})")
+    
+    for phone, balance in balances.items():
+        if balance < 0:
+            violations.append(f"{phone} has a negative balance {balance}")
+    
+    net = Counter()
+    sends, receives = set(), set()
+    for txn in main2.transactions_collection.find(
+            {'user_phone': {'$in': phones}, 'status': 'completed'},
+            {'_id': 0, 'user_phone': 1, 'type': 1, 'amount': 1, 'transaction_id': 1, 'reference': 1}):
+        if txn['type'] in CREDIT_TRANSACTION_TYPES:
+            net[txn['user_phone']] += txn['amount']
+        elif txn['type'] in DEBIT_TRANSACTION_TYPES:
+            net[txn['user_phone']] -= txn['amount']
+        if txn['type'] == 'send':
+            sends.add(txn['transaction_id'])
+        elif txn['type'] == 'receive':
+            receives.add(txn['reference'])
+    
+    for phone, balance in balances.items():
+        if balance != net[phone]:
+            violations.append(f"{phone} balance {balance} != transaction net {net[phone]} (lost update)")
+    
+    for transaction_id in sorted(sends - receives):
+        violations.append(f"Send {transaction_id} has no matching receive")
+    
+    return violations
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress the money path and check its invariants")
+    parser.add_argument('--accounts', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=32, help="Threads per process")
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--operations', type=int, default=500, help="Operations per thread")
+    parser.add_argument('--striped', type=int, default=0, help="Stripe this many of the accounts")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    
+    if main2.DATABASE_NAME == 'ussd_wallet':
+        parser.error("Refusing to run against the default application database; set DATABASE_NAME")
+    
+    phones = setup(args.accounts, args.striped)
+    opening_total = OPENING_BALANCE * len(phones)
+    
+    started = time.monotonic()
+    if args.processes > 1:
+        # Spawn so every process opens its own MongoDB connection
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=args.processes, mp_context=context) as pool:
+            results = list(pool.map(run_worker, [phones] * args.processes, [args.threads] * args.processes,
+                                    [args.operations] * args.processes,
+                                    [args.seed + i for i in range(args.processes)]))
+    else:
+        results = [run_worker(phones, args.threads, args.operations, args.seed)]
+    elapsed = time.monotonic() - started
+    
+    outcomes = Counter()
+    for result in results:
+        outcomes.update(result['outcomes'])
+    expected_total = (opening_total + sum(r['credited'] for r in results)
+                      - sum(r['debited'] for r in results))
+    
+    operations = sum(outcomes.values())
+    print(f"{operations} operations in {elapsed:.2f}s ({operations / elapsed:.0f} ops/s) "
+          f"over {len(phones)} accounts from {args.processes * args.threads} threads")
+    print(f"{'operation':<12}{'ok':>10}{'refused':>10}{'failed':>10}{'refused %':>12}")
+    for kind, _ in OPERATION_MIX:
+        ok, refused, failed = (outcomes[(kind, o)] for o in ('ok', 'refused', 'failed'))
+        count = ok + refused + failed
+        print(f"{kind:<12}{ok:>10}{refused:>10}{failed:>10}{(refused / count * 100 if count else 0):>11.1f}%")
+    
+    violations = verify(phones, expected_total)
+    for violation in violations[:50]:
+        print(f"VIOLATION {violation}")
+    print(f"{len(violations)} invariant violations")
+    return 1 if violations else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""Unit tests for journal.py"""
+import os
+
+import pytest
+
+from journal import Journal, JournalError, HEADER
+
+def records(directory: str, **options) -> list:
+    """Reopen the journal and return everything it would replay"""
+    journal = Journal(directory, **options)
+    try:
+        return list(journal.replay())
+    finally:
+        journal.close()
+
+def log_files(directory: str) -> list:
+    return sorted(name for name in os.listdir(directory) if name.endswith('.log'))
+
+class FlakyFsync:
+    """fsync that fails the next ``failures`` calls"""
+
+    def __init__(self):
+        self.failures = 0
+
+    def __call__(self, fd: int) -> None:
+        if self.failures:
+            self.failures -= 1
+            raise OSError(5, "Injected fsync failure")
+        os.fsync(fd)
+
+def test_append_and_replay(tmp_path):
+    journal = Journal(str(tmp_path))
+    assert [journal.append(p) for p in (b'one', b'two', b'three')] == [1, 2, 3]
+    journal.close()
+
+    assert records(str(tmp_path)) == [(1, b'one'), (2, b'two'), (3, b'three')]
+
+@pytest.mark.parametrize('tail', [
+    HEADER.pack(100, 0, 3)[:7],          # torn header
+    HEADER.pack(100, 0, 3) + b'short',   # torn payload
+])
+def test_torn_tail_is_truncated(tmp_path, tail):
+    journal = Journal(str(tmp_path))
+    journal.append(b'one')
+    journal.append(b'two')
+    journal.close()
+    path = os.path.join(str(tmp_path), log_files(str(tmp_path))[-1])
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(tail)
+
+    journal = Journal(str(tmp_path))
+    assert os.path.getsize(path) == size
+    assert journal.append(b'three') == 3
+    journal.close()
+    assert records(str(tmp_path)) == [(1, b'one'), (2, b'two'), (3, b'three')]
+
+def test_corrupt_last_record_is_dropped(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.append(b'one')
+    journal.append(b'two')
+    journal.close()
+    path = os.path.join(str(tmp_path), log_files(str(tmp_path))[-1])
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'X')
+
+    assert records(str(tmp_path)) == [(1, b'one')]
+
+def test_failed_commit_is_never_replayed(tmp_path):
+    fsync = FlakyFsync()
+    journal = Journal(str(tmp_path), fsync=fsync)
+    assert journal.append(b'one') == 1
+    fsync.failures = 1
+    with pytest.raises(JournalError):
+        journal.append(b'two')
+    # The failed record's sequence number is reused
+    assert journal.append(b'three') == 2
+    journal.close()
+
+    assert records(str(tmp_path)) == [(1, b'one'), (2, b'three')]
+
+def test_failed_commit_leaves_no_gap_below_the_watermark(tmp_path):
+    fsync = FlakyFsync()
+    journal = Journal(str(tmp_path), fsync=fsync)
+    journal.append(b'one')
+    fsync.failures = 1
+    with pytest.raises(JournalError):
+        journal.append(b'two')
+    journal.append(b'three')
+    journal.mark_applied(1)
+    journal.mark_applied(2)
+    journal.close()
+
+    assert records(str(tmp_path)) == []
+
+def test_failed_rollback_refuses_further_appends(tmp_path):
+    fsync = FlakyFsync()
+    journal = Journal(str(tmp_path), fsync=fsync)
+    journal.append(b'one')
+    # The commit and the rollback's own fsync both fail
+    fsync.failures = 10
+    with pytest.raises(JournalError):
+        journal.append(b'two')
+    fsync.failures = 0
+    with pytest.raises(JournalError, match='unusable'):
+        journal.append(b'three')
+    journal.close()
+
+def test_watermark_only_advances_contiguously(tmp_path):
+    journal = Journal(str(tmp_path))
+    for payload in (b'one', b'two', b'three'):
+        journal.append(payload)
+    journal.mark_applied(2)
+    journal.mark_applied(3)
+    journal.close()
+    # Nothing is persisted past the gap at 1
+    assert [seq for seq, _ in records(str(tmp_path))] == [1, 2, 3]
+
+    journal = Journal(str(tmp_path))
+    for seq, _ in list(journal.replay()):
+        journal.mark_applied(seq)
+    journal.close()
+    assert records(str(tmp_path)) == []
+
+def test_applied_segments_are_purged(tmp_path):
+    journal = Journal(str(tmp_path), segment_bytes=64)
+    seqs = [journal.append(b'x' * 40) for _ in range(6)]
+    assert len(log_files(str(tmp_path))) > 1
+    for seq in seqs:
+        journal.mark_applied(seq)
+    journal.close()
+
+    # Only the active segment is kept
+    assert len(log_files(str(tmp_path))) == 1
+    journal = Journal(str(tmp_path))
+    assert journal.append(b'next') == 7
+    journal.close()
@@ -0,0 +1,81 @@
+"""Stateless-mode tests: PINs replayed from the text chain.
+
+Needs a MongoDB at MONGO_URI. Uses its own database (``DATABASE_NAME``,
+default ``ussd_wallet_test``), which it clears, and is skipped when no
+server answers.
+"""
+import os
+import uuid
+
+import pymongo
+import pytest
+
+os.environ.setdefault('DATABASE_NAME', 'ussd_wallet_test')
+
+try:
+    pymongo.MongoClient(os.environ.get('MONGO_URI', 'mongodb://localhost:27017/'),
+                        serverSelectionTimeoutMS=500).admin.command('ping')
+except pymongo.errors.PyMongoError:
+    pytest.skip("MongoDB is not reachable", allow_module_level=True)
+
+import main2
+from main2 import WalletManager, StatelessSessions, MAX_PIN_ATTEMPTS
+
+if main2.DATABASE_NAME == 'ussd_wallet':
+    pytest.skip("Refusing to run against the default application database", allow_module_level=True)
+
+PHONE = '+254788000001'
+PIN = '4321'
+
+@pytest.fixture(autouse=True)
+def user(monkeypatch):
+    monkeypatch.setattr(main2, 'USSD_STATELESS_MODE', True)
+    main2.sms = None
+    main2.users_collection.delete_many({})
+    main2.stateless_results_collection.delete_many({})
+    StatelessSessions._memo.clear()
+    WalletManager.create_user(PHONE, PIN, 'Replay')
+    yield
+    main2.users_collection.delete_many({})
+
+def hop(text: str, session_id: str = None) -> str:
+    """Send one hop on a session this worker has never seen"""
+    response = main2.app.test_client().post('/ussd', data={
+        'sessionId': session_id or uuid.uuid4().hex,
+        'serviceCode': '*384#',
+        'phoneNumber': PHONE,
+        'text': text
+    })
+    return response.get_data(as_text=True)
+
+def stored_user() -> dict:
+    return main2.users_collection.find_one({'phone_number': PHONE})
+
+def test_replayed_right_pin_continues_the_session():
+    assert 'Your balance' in hop(f"{PIN}*1")
+    assert stored_user()['failed_pin_attempts'] == 0
+
+def test_replayed_wrong_pins_count_toward_lockout():
+    for attempt in range(1, MAX_PIN_ATTEMPTS + 1):
+        assert hop(f"{attempt:04d}*1") == "END Error: Session expired"
+        assert stored_user()['failed_pin_attempts'] == attempt
+
+    assert stored_user()['is_locked'] is True
+    # Locked: the right PIN no longer opens a replayed session either
+    assert 'Your balance' not in hop(f"{PIN}*1")
+    # Attempts that still reach a locked account count, so only the locking one hits the limit
+    assert WalletManager.authenticate_user(PHONE, PIN)[0] is False
+    assert stored_user()['failed_pin_attempts'] == MAX_PIN_ATTEMPTS + 1
+
+@pytest.mark.parametrize('cold', [False, True])
+def test_resent_final_hop_runs_once(cold):
+    session_id = uuid.uuid4().hex
+    chain = f"{PIN}*3*50*{PIN}"
+    first = hop(chain, session_id)
+    assert 'Deposit successful' in first
+
+    if cold:
+        # Another worker, or this one after its memo was evicted
+        StatelessSessions._memo.clear()
+    assert hop(chain, session_id) == first
+    assert stored_user()['balance'] == 5000